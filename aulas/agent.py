@@ -143,15 +143,16 @@ chain = RunnableWithMessageHistory(
     history_messages_key="chat_history"
 )
 
-while True:
-    user_input = input("> ")
-    if user_input.lower() in ('sair', 'exit', 'quit', 'tchau'):
-        break
-    try:
-        resposta = chain.invoke(
-            {"input": user_input},
-            config={"configurable": {"session_id": "PRECISA_MAS_NÃO_IMPORTA"}}
-        )
-        print(resposta['output'])
-    except Exception as e:
-        print("Erro ao consumir a API: ", e)
+if __name__ == "__main__":
+    while True:
+        user_input = input("> ")
+        if user_input.lower() in ('sair', 'exit', 'quit', 'tchau'):
+            break
+        try:
+            resposta = chain.invoke(
+                {"input": user_input},
+                config={"configurable": {"session_id": "PRECISA_MAS_NÃO_IMPORTA"}}
+            )
+            print(resposta['output'])
+        except Exception as e:
+            print("Erro ao consumir a API: ", e)
@@ -419,20 +419,21 @@ def executar_fluxo_acessor(pergunta_usuario: str, session_id: str) -> str:
         # resposta direta do roteador (saudação ou fora de escopo)
         return chain
 
-while True:
-    try:
-        user_input = input("> ")
-        if user_input.lower() in ('sair', 'exit', 'quit', 'tchau'):
-            print("Encerrando a conversa.")
-            break
-
-        resposta = executar_fluxo_acessor(
-            pergunta_usuario=user_input,
-            session_id="PRECISA_MAS_NÃO_IMPORTA"
-        )
-
-        print(resposta)
-
-    except Exception as e:
-        print("Erro ao consumir a API: ", e)
-        continue
\ No newline at end of file
+if __name__ == "__main__":
+    while True:
+        try:
+            user_input = input("> ")
+            if user_input.lower() in ('sair', 'exit', 'quit', 'tchau'):
+                print("Encerrando a conversa.")
+                break
+
+            resposta = executar_fluxo_acessor(
+                pergunta_usuario=user_input,
+                session_id="PRECISA_MAS_NÃO_IMPORTA"
+            )
+
+            print(resposta)
+
+        except Exception as e:
+            print("Erro ao consumir a API: ", e)
+            continue
\ No newline at end of file
@@ -13,12 +13,18 @@ from langchain_core.prompts import (
 )
 from langchain.prompts.few_shot import FewShotChatMessagePromptTemplate
 from langchain.agents import create_tool_calling_agent, AgentExecutor
-from pg_tools import TOOLS
+from pg_tools import TOOLS, cancel_session, replay_spool, set_session, start_change_feed, warm_analytics_pool
 from datetime import datetime
 from zoneinfo import ZoneInfo
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import uuid
 
 load_dotenv()
 
+# dono dos dados da conversa: escolhe o shard e filtra as linhas nas tools (sem ele: banco único, sem filtro)
+USER_ID = os.getenv("ASSESSOR_USER_ID")
+
 TZ = ZoneInfo("America/Sao_Paulo")
 today = datetime.now(TZ).date()
 
@@ -437,8 +443,12 @@ orquestrador_chain = RunnableWithMessageHistory(
     history_messages_key="chat_history"
 )
 
-def executar_fluxo_acessor(pergunta_usuario: str, session_id: str) -> str:
-    
+def executar_fluxo_acessor(pergunta_usuario: str, session_id: str, user_id: Optional[str] = None) -> str:
+    # as tools usam a sessão para ler da réplica sem perder as próprias escritas
+    # o turno entra na chave de idempotência do add_transaction (retries não duplicam lançamentos)
+    # e define o prazo (TURN_DEADLINE_SECONDS) que cada consulta das tools herda como statement_timeout
+    set_session(session_id, turn_id=uuid.uuid4().hex, user_id=user_id)
+
     chain = router_chain.invoke(
         {"input": pergunta_usuario},
         config={"configurable": {"session_id": session_id}}
@@ -460,20 +470,45 @@ def executar_fluxo_acessor(pergunta_usuario: str, session_id: str) -> str:
         # resposta direta do roteador (saudação ou fora de escopo)
         return chain
 
-while True:
-    try:
-        user_input = input("> ")
-        if user_input.lower() in ('sair', 'exit', 'quit', 'tchau'):
-            print("Encerrando a conversa.")
-            break
-
-        resposta = executar_fluxo_acessor(
-            pergunta_usuario=user_input,
-            session_id="PRECISA_MAS_NÃO_IMPORTA"
-        )
-
-        print(resposta)
-
-    except Exception as e:
-        print("Erro ao consumir a API: ", e)
-        continue
\ No newline at end of file
+# o pool de análises do pg_tools (spawn) reimporta este módulo nos workers:
+# change feed, spool e o chat só rodam no processo principal
+if __name__ == "__main__":
+    # mudanças feitas por outros processos invalidam o cache das tools de leitura
+    start_change_feed()
+    # os workers do pool de análises sobem agora, não dentro do prazo do primeiro turno que usar um
+    warm_analytics_pool()
+    # escritas que ficaram no spool local numa queda anterior do banco; as que pareceram
+    # duplicadas não foram gravadas e ficam para o usuário confirmar
+    for pendente in replay_spool()["needs_confirmation"]:
+        args = pendente["args"]
+        print(f"Não gravado (possível duplicata, registrado em {pendente['spooled_at']}): "
+              f"{args.get('source_text')} — R$ {args.get('amount')}. Repita o pedido para confirmar.")
+
+    turn_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="turno")
+    while True:
+        try:
+            user_input = input("> ")
+            if user_input.lower() in ('sair', 'exit', 'quit', 'tchau'):
+                print("Encerrando a conversa.")
+                break
+
+            # o turno roda em outra thread: Ctrl+C interrompe só a espera aqui, e cancel_session
+            # cancela no banco o que a thread do turno estiver executando (e o que ela tentar depois)
+            turno = turn_executor.submit(
+                executar_fluxo_acessor,
+                pergunta_usuario=user_input,
+                session_id="PRECISA_MAS_NÃO_IMPORTA",
+                user_id=USER_ID,
+            )
+            try:
+                resposta = turno.result()
+            except KeyboardInterrupt:
+                cancel_session("PRECISA_MAS_NÃO_IMPORTA")
+                print("Turno cancelado.")
+                continue
+
+            print(resposta)
+
+        except Exception as e:
+            print("Erro ao consumir a API: ", e)
+            continue
\ No newline at end of file
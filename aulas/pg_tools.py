@@ -1,16 +1,881 @@
 import os
+import re
+import glob
+import select
+import logging
+import json
+import datetime as dt
+from decimal import Decimal
+import time
+import hashlib
+import calendar
+import copy
+import math
+import base64
+import itertools
+import queue
+import threading
+import contextvars
+import functools
+import inspect
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 import psycopg2
-from typing import Optional
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from typing import List, Optional
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL")  
+# Réplica de leitura (opcional); sem ela, tudo vai para o primário
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+READ_POOL_MAX = int(os.getenv("READ_POOL_MAX", "5"))
+# Segundos após uma escrita em que a sessão continua lendo do primário (read-your-writes)
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "5"))
+# Write-behind: add_transaction enfileira e um writer em background faz group commit
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_FLUSH_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "5"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_TIMEOUT = float(os.getenv("WRITE_BEHIND_TIMEOUT", "10"))
+# Cache de resultados das tools de leitura (0 desativa)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
+# Formato compacto (colunar) para resultados em lista enviados ao LLM; desligado, as tools
+# de lista devolvem "data" (lista de dicts) como antes
+COMPACT_RESULTS = os.getenv("COMPACT_RESULTS", "0") == "1"
+RESULT_TOKEN_BUDGET = int(os.getenv("RESULT_TOKEN_BUDGET", "1500"))
+TEXT_MAX_CHARS = int(os.getenv("TEXT_MAX_CHARS", "80"))
+# Detecção de quase-duplicados no add_transaction (mesmo valor, janela de tempo, texto parecido)
+NEAR_DUP_WINDOW_MINUTES = int(os.getenv("NEAR_DUP_WINDOW_MINUTES", "720"))
+NEAR_DUP_SIMILARITY = float(os.getenv("NEAR_DUP_SIMILARITY", "0.3"))
+# Limite de segurança das tools em lote (bulk_update_transactions / delete_transactions)
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "50"))
+BULK_MAX_ROWS_LIMIT = int(os.getenv("BULK_MAX_ROWS_LIMIT", "500"))
+# Arquivo frio: transações mais antigas que o horizonte vão para Parquet mensal
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_HORIZON_MONTHS = int(os.getenv("ARCHIVE_HORIZON_MONTHS", "24"))
+# Canal do LISTEN/NOTIFY disparado pelos triggers de transactions/events (ver sql.txt)
+CHANGE_FEED_CHANNEL = os.getenv("CHANGE_FEED_CHANNEL", "assessor_changes")
+
+# Sharding por usuário (opcional): DSNs separados por vírgula; réplicas na mesma ordem
+SHARD_DATABASE_URLS = [u.strip() for u in os.getenv("SHARD_DATABASE_URLS", "").split(",") if u.strip()]
+SHARD_READ_URLS = [u.strip() for u in os.getenv("SHARD_READ_URLS", "").split(",") if u.strip()]
+# Segundos que cada processo confia no shard_directory em cache (o resharding espera esse tempo)
+SHARD_DIRECTORY_TTL = float(os.getenv("SHARD_DIRECTORY_TTL", "30"))
+# Prazo de cada turno do agente; cada statement recebe o que resta como statement_timeout (0 desativa)
+TURN_DEADLINE_SECONDS = float(os.getenv("TURN_DEADLINE_SECONDS", "15"))
+# Modo degradado: disjuntor por banco, snapshots das leituras e spool local das escritas
+CONNECT_TIMEOUT = int(os.getenv("CONNECT_TIMEOUT", "3"))
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "3"))
+CIRCUIT_PROBE_SECONDS = float(os.getenv("CIRCUIT_PROBE_SECONDS", "5"))
+SNAPSHOT_SIZE = int(os.getenv("SNAPSHOT_SIZE", "256"))
+SPOOL_PATH = os.getenv("SPOOL_PATH", os.path.join("spool", "writes.jsonl"))
+# Previsão de saldo: janela de histórico, horizonte máximo e mínimo de meses para um lançamento ser recorrente
+FORECAST_HISTORY_DAYS = int(os.getenv("FORECAST_HISTORY_DAYS", "365"))
+FORECAST_MAX_DAYS = int(os.getenv("FORECAST_MAX_DAYS", "730"))
+RECURRING_MIN_MONTHS = int(os.getenv("RECURRING_MIN_MONTHS", "3"))
+# Simulação de compra (Monte Carlo): cenários por chamada e semente fixa (resultado reprodutível)
+SIMULATION_PATHS = int(os.getenv("SIMULATION_PATHS", "5000"))
+SIMULATION_SEED = int(os.getenv("SIMULATION_SEED", "42"))
+# Anomalias de gasto: janelas (dias/semanas anteriores), limiar do z-score robusto e diferença mínima em R$
+ANOMALY_HISTORY_DAYS = int(os.getenv("ANOMALY_HISTORY_DAYS", "365"))
+ANOMALY_DAILY_WINDOW = int(os.getenv("ANOMALY_DAILY_WINDOW", "28"))
+ANOMALY_WEEKLY_WINDOW = int(os.getenv("ANOMALY_WEEKLY_WINDOW", "8"))
+ANOMALY_Z = float(os.getenv("ANOMALY_Z", "3.5"))
+ANOMALY_MIN_DELTA = float(os.getenv("ANOMALY_MIN_DELTA", "30"))
+# Pool de processos das análises pesadas (modelo de fluxo, Monte Carlo, varredura de anomalias):
+# workers (0 = roda na própria thread), máximo de tarefas em andamento + na fila (acima disso a
+# tool responde "busy") e segundos por tarefa (limitados também pelo prazo do turno)
+ANALYTICS_PROCESSES = int(os.getenv("ANALYTICS_PROCESSES", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+ANALYTICS_QUEUE = int(os.getenv("ANALYTICS_QUEUE", "8"))
+ANALYTICS_TASK_TIMEOUT = float(os.getenv("ANALYTICS_TASK_TIMEOUT", "20"))
+# Jobs fora do turno (detect_anomalies) não respondem a ninguém em tempo real: prazo próprio, maior
+ANALYTICS_JOB_TIMEOUT = float(os.getenv("ANALYTICS_JOB_TIMEOUT", "600"))
+# Captura de workload (desligada por padrão): cada statement vai para um log JSONL (forma, tipos dos
+# parâmetros, duração, linhas); os mais lentos que SLOW_QUERY_MS ganham o plano (EXPLAIN, sem literais
+# de texto), no máximo um por forma a cada EXPLAIN_INTERVAL_SECONDS
+QUERY_LOG = os.getenv("QUERY_LOG", "0") == "1"
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH", os.path.join("logs", "queries.jsonl"))
+QUERY_LOG_MAX_MB = float(os.getenv("QUERY_LOG_MAX_MB", "50"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))
+EXPLAIN_INTERVAL_SECONDS = float(os.getenv("EXPLAIN_INTERVAL_SECONDS", "600"))
+
+
+# Sessão, turno e usuário correntes (definidos pelo fluxo do agente a cada turno)
+_session_id = contextvars.ContextVar("pg_session_id", default=None)
+_turn_id = contextvars.ContextVar("pg_turn_id", default=None)
+_user_id = contextvars.ContextVar("pg_user_id", default=None)
+_deadline = contextvars.ContextVar("pg_deadline", default=None)  # instante (time.monotonic) limite do turno
+_tool_name = contextvars.ContextVar("pg_tool_name", default=None)  # tool em execução (para o log de consultas)
+
+_read_pools = {}  # DSN da réplica -> pool
+_read_pool_lock = threading.Lock()
+_pooled_conns = {}  # id(conn) -> pool de origem
+_last_write = {}  # session_id -> (instante da escrita, LSN do primário)
+_shard_directory = {}  # user_id -> (shard, moving, carregado_em)
+_active_queries = {}  # session_id -> conexões com statement em execução
+_cancelled_sessions = set()  # sessões cujo turno foi abandonado (até o próximo set_session)
+_active_queries_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """O prazo do turno acabou antes de a consulta começar."""
+
+
+class DatabaseUnavailable(Exception):
+    """Disjuntor aberto: o banco falhou repetidamente e ainda não respondeu ao teste de recuperação."""
+
+
+class ShardMoving(Exception):
+    """Os dados do usuário estão sendo copiados para outro shard; escritas esperam o fim da cópia."""
+
+
+class AnalyticsBusy(Exception):
+    """Fila do pool de análises cheia (ou worker perdido): a tool recusa na hora em vez de esperar."""
+
+
+class AnalyticsTimeout(Exception):
+    """A tarefa no pool de análises passou do prazo (ANALYTICS_TASK_TIMEOUT, ou o do job) ou do prazo do turno."""
+
+
+def set_session(
+    session_id: Optional[str],
+    turn_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    deadline_seconds: Optional[float] = None,
+) -> None:
+    """
+    Define a sessão, o turno e o usuário correntes.
+    A sessão roteia leituras logo após escritas; o turno entra na chave de idempotência;
+    o usuário escolhe o shard e filtra as linhas (sem usuário: banco único, sem filtro).
+    O prazo do turno (deadline_seconds, padrão TURN_DEADLINE_SECONDS) limita cada statement.
+    """
+    _session_id.set(session_id)
+    _turn_id.set(turn_id)
+    _user_id.set(user_id)
+    with _active_queries_lock:
+        _cancelled_sessions.discard(session_id)
+    seconds = TURN_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    _deadline.set(time.monotonic() + seconds if seconds > 0 else None)
+
+
+def _remaining_ms() -> Optional[int]:
+    """Milissegundos até o fim do turno (None = sem prazo); levanta DeadlineExceeded se já acabou."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining = int((deadline - time.monotonic()) * 1000)
+    if remaining <= 0:
+        raise DeadlineExceeded("Prazo do turno esgotado.")
+    return remaining
+
+
+def _sql_shape(query) -> str:
+    """Forma do statement: literais viram ?, listas de VALUES colapsam e espaços são normalizados."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    shape = re.sub(r"'(?:[^']|'')*'", "?", query)
+    shape = re.sub(r"\b\d+(?:\.\d+)?\b", "?", shape)
+    shape = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+", "(...)", shape)
+    return re.sub(r"\s+", " ", shape).strip()
+
+
+def _loggable(value):
+    """Só os tipos dos parâmetros: valores (texto do usuário, user_id, valores) não vão para o log."""
+    if isinstance(value, dict):
+        return {k: _loggable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_loggable(v) for v in value[:20]]
+    return None if value is None else type(value).__name__
+
+
+def _redact_plan(node):
+    """Plano do EXPLAIN sem literais de texto (Filter/Index Cond trazem os valores dos parâmetros)."""
+    if isinstance(node, dict):
+        return {k: _redact_plan(v) for k, v in node.items()}
+    if isinstance(node, list):
+        return [_redact_plan(v) for v in node]
+    if isinstance(node, str):
+        return re.sub(r"'(?:[^']|'')*'", "'?'", node)
+    return node
+
+
+class _QueryLog:
+    """
+    Log de workload (JSONL, uma linha por statement) gravado por uma thread em background:
+    o statement só paga um queue.put. Para os lentos, a mesma thread captura o plano numa conexão
+    própria: EXPLAIN (ANALYZE, BUFFERS) para leituras; só EXPLAIN para escritas e SELECT ... FOR UPDATE,
+    que não podem ser reexecutados.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._explained = {}  # fingerprint -> instante do último EXPLAIN
+        self._explain_conns = {}  # DSN -> conexão da thread de log
+
+    def record(self, query, params, duration_ms: float, rows: int) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="pg-query-log", daemon=True)
+                    self._thread.start()
+        dsn = None
+        if duration_ms >= SLOW_QUERY_MS:
+            try:
+                dsn = _read_dsn() or _shard_dsn(write=False)
+            except Exception:
+                pass
+        self._queue.put((query, params, duration_ms, rows, _tool_name.get(), time.time(), dsn))
+
+    def _run(self) -> None:
+        while True:
+            query, params, duration_ms, rows, tool_name, at, dsn = self._queue.get()
+            try:
+                shape = _sql_shape(query)
+                fingerprint = hashlib.sha1(shape.encode("utf-8")).hexdigest()[:12]
+                entry = {
+                    "at": dt.datetime.fromtimestamp(at, dt.timezone.utc).isoformat(timespec="milliseconds"),
+                    "tool": tool_name,
+                    "fingerprint": fingerprint,
+                    "shape": shape,
+                    "params": _loggable(params),
+                    "duration_ms": round(duration_ms, 2),
+                    "rows": rows,
+                }
+                if dsn and time.monotonic() - self._explained.get(fingerprint, -math.inf) >= EXPLAIN_INTERVAL_SECONDS:
+                    self._explained[fingerprint] = time.monotonic()
+                    entry["plan"] = _redact_plan(self._explain(dsn, query, params, duration_ms))
+                self._write(entry)
+            except Exception:
+                logger.exception("Falha ao registrar consulta no log de workload")
+
+    def _explain(self, dsn: str, query, params, duration_ms: float):
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        read_only = re.match(r"\s*(SELECT|WITH)\b", query, re.I) and not re.search(
+            r"\b(INSERT|UPDATE|DELETE)\b|\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE)\b", query, re.I
+        )
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if read_only else "FORMAT JSON"
+        conn = self._explain_conns.get(dsn)
+        try:
+            if conn is None or conn.closed:
+                conn = self._explain_conns[dsn] = psycopg2.connect(dsn, connect_timeout=CONNECT_TIMEOUT)
+            with conn.cursor() as cur:
+                # a reexecução não pode demorar muito mais que a original
+                cur.execute("SET statement_timeout = %s;", (int(min(max(duration_ms * 10, 1000), 60000)),))
+                cur.execute(f"EXPLAIN ({options}) {query}", params)
+                plan = cur.fetchone()[0]
+            conn.rollback()
+            return plan
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            return {"error": str(e)}
+
+    def _write(self, entry: dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > QUERY_LOG_MAX_MB * 1024 * 1024:
+            os.replace(self.path, self.path + ".1")  # guarda só o arquivo anterior
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
+_query_log = _QueryLog(QUERY_LOG_PATH)
+
+
+class _DeadlineCursor(psycopg2.extensions.cursor):
+    """
+    Cursor que aplica o prazo restante do turno como statement_timeout do próprio statement
+    (SET LOCAL no mesmo envio, sem ida extra ao banco), registra a conexão para cancel_session
+    e manda cada statement para o log de workload.
+    """
+
+    def execute(self, query, vars=None):
+        original = query
+        session = _session_id.get()
+        if session is not None and session in _cancelled_sessions:
+            raise DeadlineExceeded("Turno cancelado.")
+        remaining = _remaining_ms()
+        if remaining is not None:
+            # execute_values monta a query em bytes
+            prefix = f"SET LOCAL statement_timeout = {remaining}; "
+            query = (prefix.encode() if isinstance(query, bytes) else prefix) + query
+        with _active_queries_lock:
+            _active_queries.setdefault(session, set()).add(self.connection)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if QUERY_LOG:
+                _query_log.record(original, vars, (time.perf_counter() - started) * 1000, self.rowcount)
+            with _active_queries_lock:
+                conns = _active_queries.get(session)
+                if conns is not None:
+                    conns.discard(self.connection)
+                    if not conns:
+                        _active_queries.pop(session, None)
+
+
+def cancel_session(session_id: Optional[str]) -> int:
+    """
+    Abandona o turno da sessão: cancela no servidor os statements em execução e faz os próximos
+    statements dela falharem na hora (DeadlineExceeded) até o próximo set_session.
+    Chame de outra thread que não a do turno (ela fica bloqueada dentro do psycopg2), ex.: a que
+    espera o turno e recebeu Ctrl+C. Devolve quantos statements foram cancelados.
+    """
+    with _active_queries_lock:
+        if session_id is not None:
+            _cancelled_sessions.add(session_id)
+        conns = list(_active_queries.get(session_id, ()))
+    for conn in conns:
+        try:
+            conn.cancel()
+        except Exception:
+            logger.exception("Falha ao cancelar consulta da sessão %s", session_id)
+    return len(conns)
+
+
+class _CircuitBreaker:
+    """
+    Disjuntor de um banco: após CIRCUIT_FAILURES falhas seguidas de conexão, abre e as tools
+    falham na hora (sem pagar connect_timeout a cada turno). Uma thread testa o banco a cada
+    CIRCUIT_PROBE_SECONDS; quando ele responde, fecha o disjuntor e reaplica o spool de escritas.
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self) -> None:
+        if self.opened_at is not None:
+            raise DatabaseUnavailable("Banco de dados indisponível (disjuntor aberto).")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures < CIRCUIT_FAILURES or self.opened_at is not None:
+                return
+            self.opened_at = time.monotonic()
+        logger.warning("Disjuntor aberto após %d falhas de conexão", self.failures)
+        threading.Thread(target=self._probe, name="pg-circuit-probe", daemon=True).start()
+
+    def _probe(self) -> None:
+        while True:
+            time.sleep(CIRCUIT_PROBE_SECONDS)
+            try:
+                conn = psycopg2.connect(self.dsn, connect_timeout=CONNECT_TIMEOUT)
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1;")
+                finally:
+                    conn.close()
+            except Exception:
+                continue
+            with self._lock:
+                self.failures = 0
+                self.opened_at = None
+            logger.info("Banco respondeu; disjuntor fechado")
+            replay_spool()
+            return
+
+
+_breakers = {}  # DSN -> _CircuitBreaker
+_breakers_lock = threading.Lock()
+
+
+def _breaker_for(dsn: str) -> _CircuitBreaker:
+    with _breakers_lock:
+        if dsn not in _breakers:
+            _breakers[dsn] = _CircuitBreaker(dsn)
+        return _breakers[dsn]
+
+
+def _connect(dsn: str):
+    breaker = _breaker_for(dsn)
+    breaker.check()
+    try:
+        conn = psycopg2.connect(dsn, cursor_factory=_DeadlineCursor, connect_timeout=CONNECT_TIMEOUT)
+    except psycopg2.OperationalError:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return conn
+
+
+def _is_unavailable(e: Exception) -> bool:
+    # erros de conexão do lado do cliente não têm SQLSTATE; erros do servidor (deadlock etc.) têm
+    if isinstance(e, DatabaseUnavailable):
+        return True
+    if isinstance(e, psycopg2.extensions.QueryCanceledError):
+        return False
+    return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) and getattr(e, "pgcode", None) is None
+
+
+def _error_result(e: Exception) -> dict:
+    """Resposta de erro das tools; prazo estourado vira status 'timeout' para o agente poder reagir."""
+    if isinstance(e, AnalyticsBusy):
+        return {"status": "busy", "message": str(e)}
+    if isinstance(e, AnalyticsTimeout):
+        return {
+            "status": "timeout",
+            "message": "A análise passou do tempo e foi interrompida. "
+                       "Reduza o horizonte (dias/meses) ou avise o usuário e tente de novo.",
+        }
+    if isinstance(e, FutureTimeoutError):
+        return {
+            "status": "timeout",
+            "message": "A gravação não foi confirmada a tempo e pode ainda acontecer; repetir a chamada é seguro.",
+        }
+    if isinstance(e, (DeadlineExceeded, psycopg2.extensions.QueryCanceledError)):
+        return {
+            "status": "timeout",
+            "message": "A consulta passou do tempo do turno e foi cancelada no banco. "
+                       "Restrinja os filtros (período, valor, categoria) ou avise o usuário e tente de novo.",
+        }
+    if _is_unavailable(e):
+        return {"status": "unavailable", "message": "Banco de dados indisponível no momento; tente de novo em instantes."}
+    return {"status": "error", "message": str(e)}
+
+
+def _shard_index(user_id: str) -> int:
+    """Shard do usuário: override em shard_directory (após resharding) ou hash estável."""
+    cached = _shard_directory.get(user_id)
+    if cached is None or time.monotonic() - cached[2] > SHARD_DIRECTORY_TTL:
+        shard, moving = None, False
+        # o diretório fica no banco principal (DATABASE_URL)
+        conn = _connect(DATABASE_URL)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT shard, moving FROM shard_directory WHERE user_id = %s;", (user_id,))
+                row = cur.fetchone()
+                if row:
+                    shard, moving = row
+        finally:
+            conn.close()
+        if shard is None:
+            shard = int(hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:8], 16) % len(SHARD_DATABASE_URLS)
+        cached = (shard, moving, time.monotonic())
+        _shard_directory[user_id] = cached
+    return cached[0]
+
+
+def _current_shard() -> Optional[int]:
+    user = _user_id.get()
+    if not SHARD_DATABASE_URLS or user is None:
+        return None
+    return _shard_index(user)
+
+
+def _shard_dsn(write: bool = True) -> str:
+    shard = _current_shard()
+    if shard is None:
+        return DATABASE_URL
+    if write and _shard_directory[_user_id.get()][1]:
+        raise ShardMoving("Dados do usuário em migração entre shards; tente novamente em instantes.")
+    return SHARD_DATABASE_URLS[shard]
+
+
+def _read_dsn() -> Optional[str]:
+    shard = _current_shard()
+    if shard is None:
+        return DATABASE_READ_URL
+    return SHARD_READ_URLS[shard] if shard < len(SHARD_READ_URLS) else None
+
 
 def get_conn():
-    return psycopg2.connect(DATABASE_URL)
+    return _connect(_shard_dsn())
+
+
+def _get_read_pool(dsn: str) -> ThreadedConnectionPool:
+    pool = _read_pools.get(dsn)
+    if pool is None:
+        with _read_pool_lock:
+            pool = _read_pools.get(dsn)
+            if pool is None:
+                pool = ThreadedConnectionPool(1, READ_POOL_MAX, dsn, cursor_factory=_DeadlineCursor)
+                _read_pools[dsn] = pool
+    return pool
+
+
+def _current_lsn(conn) -> Optional[str]:
+    if not (DATABASE_READ_URL or SHARD_READ_URLS):
+        return None
+    try:
+        with conn.cursor() as c:
+            c.execute("SELECT pg_current_wal_lsn()::text;")
+            return c.fetchone()[0]
+    except Exception:
+        return None
+
+
+def _record_write(lsn: Optional[str]) -> None:
+    _result_cache.bump_generation()
+    if _read_dsn():
+        now = time.monotonic()
+        # sessões que não voltaram a ler dentro da janela não precisam mais da entrada
+        for key, (written_at, _) in list(_last_write.items()):
+            if now - written_at >= READ_YOUR_WRITES_WINDOW:
+                _last_write.pop(key, None)
+        _last_write[_session_id.get()] = (now, lsn)
+
+
+def _mark_write(conn) -> None:
+    """Registra que a sessão corrente escreveu no primário (chamar após o commit)."""
+    _record_write(_current_lsn(conn))
+
+
+def _replica_caught_up(conn, lsn: str) -> bool:
+    # pg_last_wal_replay_lsn() é NULL fora de recovery (ou seja, a URL aponta para um primário)
+    with conn.cursor() as c:
+        c.execute("SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, TRUE);", (lsn,))
+        row = c.fetchone()
+    return bool(row and row[0])
+
+
+def get_read_conn():
+    """
+    Conexão para tools somente-leitura.
+    Usa o pool da réplica (do shard do usuário), exceto quando a sessão escreveu há menos de
+    READ_YOUR_WRITES_WINDOW segundos e a réplica ainda não alcançou o LSN da escrita.
+    """
+    read_dsn = _read_dsn()
+    if not read_dsn or _breaker_for(read_dsn).is_open:
+        return _connect(_shard_dsn(write=False))
+
+    try:
+        pool = _get_read_pool(read_dsn)
+        conn = pool.getconn()
+    except psycopg2.OperationalError:
+        _breaker_for(read_dsn).record_failure()
+        return _connect(_shard_dsn(write=False))
+    conn.autocommit = True
+    _pooled_conns[id(conn)] = pool
+
+    key = _session_id.get()
+    last = _last_write.get(key)
+    if last:
+        written_at, lsn = last
+        try:
+            caught_up = time.monotonic() - written_at >= READ_YOUR_WRITES_WINDOW or (
+                lsn is not None and _replica_caught_up(conn, lsn)
+            )
+        except psycopg2.Error as e:
+            # réplica não respondeu à checagem: a conexão volta ao pool e a leitura vai ao primário
+            if _is_unavailable(e):
+                _breaker_for(read_dsn).record_failure()
+            caught_up = False
+        if caught_up:
+            _last_write.pop(key, None)
+        else:
+            release_conn(conn)
+            return _connect(_shard_dsn(write=False))
+    return conn
+
+
+def release_conn(conn) -> None:
+    """Devolve a conexão ao pool de leitura; conexões do primário são fechadas."""
+    pool = _pooled_conns.pop(id(conn), None)
+    if pool is not None:
+        pool.putconn(conn, close=bool(conn.closed))
+    else:
+        conn.close()
+
+
+class _ResultCache:
+    """
+    LRU com TTL para resultados de tools de leitura.
+    Cada escrita incrementa a geração; entradas de gerações anteriores viram miss.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bump_generation(self) -> None:
+        with self._lock:
+            self.generation += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                generation, stored_at, value = entry
+                if generation == self.generation and time.monotonic() - stored_at < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation: int) -> None:
+        with self._lock:
+            # resultado lido antes de uma escrita concorrente: não guardar
+            if generation != self.generation or self.maxsize <= 0:
+                return
+            self._data[key] = (generation, time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "size": len(self._data),
+                "generation": self.generation,
+            }
+
+
+_result_cache = _ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+
+class _SnapshotStore:
+    """Último resultado ok de cada leitura (LRU, sem TTL), servido como 'stale' com o banco fora."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def put(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_snapshots = _SnapshotStore(SNAPSHOT_SIZE)
+
+
+def cache_stats() -> dict:
+    """Estatísticas do cache de leituras (hits, misses, hit_ratio, size, generation)."""
+    return _result_cache.stats()
+
+
+def _normalize_arg(value):
+    if isinstance(value, str):
+        return value.strip().lower()
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize_arg(v) for v in value)
+    return value
+
+
+def _cached_read(name: str):
+    """
+    Cacheia respostas com status ok da tool, pela chave (nome, usuário, argumentos normalizados).
+    Com o banco indisponível (ou o pool de análises lotado), devolve o último resultado ok da mesma
+    chave marcado com stale/as_of. Cada chamada recebe sua própria cópia do resultado guardado.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (name, _user_id.get(), tuple(sorted(
+                (k, _normalize_arg(v)) for k, v in bound.arguments.items() if v is not None
+            )))
+            if RESULT_CACHE_SIZE > 0:
+                cached = _result_cache.get(key)
+                if cached is not None:
+                    return copy.deepcopy(cached)
+            generation = _result_cache.generation
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not _is_unavailable(e):
+                    raise
+                result = _error_result(e)
+            if isinstance(result, dict) and result.get("status") == "ok":
+                stored = copy.deepcopy(result)
+                _result_cache.put(key, stored, generation)
+                _snapshots.put(key, stored)
+            elif isinstance(result, dict) and result.get("status") in ("unavailable", "busy"):
+                snapshot = _snapshots.get(key)
+                if snapshot is not None:
+                    as_of, value = snapshot
+                    return {**copy.deepcopy(value), "stale": True, "as_of": as_of}
+            return result
+        return wrapper
+    return decorator
+
+
+class _WriteSpool:
+    """
+    Fila durável (JSONL com fsync) das escritas feitas com o banco indisponível.
+    replay() reaplica na ordem e para na primeira que ainda encontrar o banco fora; escritas
+    barradas como possível duplicata (status confirm) não são gravadas e voltam em needs_confirmation.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, name: str, call: dict) -> int:
+        entry = {
+            "tool": name,
+            "args": call,
+            "session_id": _session_id.get(),
+            "user_id": _user_id.get(),
+            "spooled_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        }
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            return self._count()
+
+    def _count(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, encoding="utf-8") as f:
+            return sum(1 for line in f if line.strip())
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._count()
+
+    def replay(self) -> dict:
+        with self._lock:
+            if not os.path.exists(self.path):
+                return {"replayed": 0, "failed": 0, "needs_confirmation": [], "pending": 0}
+            with open(self.path, encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            processed = failed = 0
+            needs_confirmation = []
+            for line in lines:
+                entry = json.loads(line)
+                # contexto limpo: usuário/sessão da chamada original, sem prazo de turno
+                result = contextvars.Context().run(self._apply, entry)
+                if result.get("status") in ("unavailable", "timeout"):
+                    break
+                if result.get("status") == "confirm":
+                    logger.warning(
+                        "Escrita do spool não gravada, possível duplicata (%s, %s): %s",
+                        entry["tool"], entry["spooled_at"], result.get("possible_duplicates"),
+                    )
+                    needs_confirmation.append({**entry, "possible_duplicates": result.get("possible_duplicates")})
+                elif result.get("status") != "ok":
+                    failed += 1
+                    logger.error("Escrita do spool descartada (%s): %s", entry["tool"], result.get("message"))
+                processed += 1
+            remaining = lines[processed:]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(remaining)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            return {
+                "replayed": processed - failed - len(needs_confirmation),
+                "failed": failed,
+                "needs_confirmation": needs_confirmation,
+                "pending": len(remaining),
+            }
+
+    @staticmethod
+    def _apply(entry: dict) -> dict:
+        set_session(entry["session_id"], user_id=entry["user_id"], deadline_seconds=0)
+        _tool_name.set(entry["tool"])
+        try:
+            # função original, sem o wrapper de spool (senão uma falha reenfileiraria a escrita)
+            return inspect.unwrap(_SPOOLED_WRITES[entry["tool"]].func)(**entry["args"])
+        except Exception as e:
+            return _error_result(e)
+
+
+_write_spool = _WriteSpool(SPOOL_PATH)
+
+
+def replay_spool() -> dict:
+    """
+    Reaplica as escritas pendentes do spool local (chamado sozinho quando o disjuntor fecha).
+    needs_confirmation traz os lançamentos não gravados por parecerem duplicados, para confirmar com o usuário.
+    """
+    return _write_spool.replay()
+
+
+def _spooled_write(name: str, prepare=None):
+    """
+    Com o banco indisponível, grava a chamada no spool local e responde status 'queued'.
+    prepare(call) ajusta os argumentos para o replay (ex.: fixar a chave de idempotência).
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not _is_unavailable(e):
+                    raise
+                result = _error_result(e)
+            if not (isinstance(result, dict) and result.get("status") == "unavailable"):
+                return result
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            call = dict(bound.arguments)
+            if prepare is not None:
+                call = prepare(call)
+            pending = _write_spool.append(name, call)
+            return {
+                "status": "queued",
+                "message": "Banco indisponível: a operação foi salva localmente e será aplicada quando ele voltar.",
+                "pending_writes": pending,
+            }
+        return wrapper
+    return decorator
+
+
+def _user_filter(alias: str = "t"):
+    """Condição de isolamento por usuário (vazia quando não há usuário na sessão)."""
+    user = _user_id.get()
+    if user is None:
+        return [], []
+    return [f"{alias}.user_id = %s"], [user]
+
 
 # Essa classe garante que o objeto de Python passe todos esses campos
 class AddTransactionArgs(BaseModel):
@@ -25,13 +890,40 @@ class AddTransactionArgs(BaseModel):
     category_id: Optional[int] = Field(default=None, description="FK de categories (opcional).")
     description: Optional[str] = Field(default=None, description="Descrição (opcional).")
     payment_method: Optional[str] = Field(default=None, description="Forma de pagamento (opcional).")
+    card_id: Optional[int] = Field(default=None, description="Cartão de crédito da compra (cards.id; é o card_id listado em card_statement), para entrar na fatura.")
+    from_account_id: Optional[int] = Field(default=None, description="Conta de onde o dinheiro sai (despesa/transferência; id do account_balances).")
+    to_account_id: Optional[int] = Field(default=None, description="Conta para onde o dinheiro vai (receita/transferência; id do account_balances).")
+    idempotency_key: Optional[str] = Field(
+        default=None,
+        description="Chave de idempotência (opcional); se ausente, é derivada da sessão/turno, texto, valor e data. Use chaves distintas para lançamentos iguais intencionais no mesmo turno."
+    )
+    confirm_duplicate: bool = Field(
+        default=False,
+        description="Use True para gravar mesmo após aviso de possível duplicado (status 'confirm')."
+    )
 
-class QueryTransactionsArgs(BaseModel):
-    text: str = Field(..., description="Buscar por texto em source_text ou description.")
+# Filtros compartilhados pelas tools que leem/alteram conjuntos de transações
+class TransactionFilterArgs(BaseModel):
+    text: Optional[str] = Field(default=None, description="Buscar por texto em source_text ou description.")
     type_name: Optional[str] = Field(default=None, description="Tipo: INCOME | EXPENSES | TRANSFER.")
     date_local: Optional[str] = Field(default=None, description="Data específica no formato YYYY-MM-DD (America/Sao_Paulo).")
     date_from_local: Optional[str] = Field(default=None, description="Data inicial no formato YYYY-MM-DD (America/Sao_Paulo).")
     date_to_local: Optional[str] = Field(default=None, description="Data final no formato YYYY-MM-DD (America/Sao_Paulo).")
+    min_amount: Optional[float] = Field(default=None, description="Valor mínimo (inclusive).")
+    max_amount: Optional[float] = Field(default=None, description="Valor máximo (inclusive).")
+    category_id: Optional[int] = Field(default=None, description="Categoria (id).")
+    category_name: Optional[str] = Field(default=None, description="Categoria (nome, ex.: transporte).")
+    payment_method: Optional[str] = Field(default=None, description="Forma de pagamento (busca parcial, ex.: crédito).")
+
+class QueryTransactionsArgs(TransactionFilterArgs):
+    fields: Optional[List[str]] = Field(
+        default=None,
+        description="Colunas a retornar: id, amount, type_name, category_id, category, description, payment_method, occurred_at_local, source_text (padrão: todas menos category)."
+    )
+    order_by_amount: Optional[str] = Field(
+        default=None,
+        description="asc | desc: ordena por valor (top-N com limit) em vez de por data."
+    )
     limit: int = Field(default=20, description="Limite de resultados (máximo 100).")
 
 
@@ -55,15 +947,163 @@ class UpdateTransactionArgs(BaseModel):
     category_name: Optional[str] = Field(default=None, description="Nova categoria (nome).")
     description: Optional[str] = Field(default=None, description="Nova descrição.")
     payment_method: Optional[str] = Field(default=None, description="Novo meio de pagamento.")
+    card_id: Optional[int] = Field(default=None, description="Novo cartão de crédito (cards.id, o card_id do card_statement); 0 remove o vínculo com cartão.")
+    from_account_id: Optional[int] = Field(default=None, description="Nova conta de origem (id); 0 remove.")
+    to_account_id: Optional[int] = Field(default=None, description="Nova conta de destino (id); 0 remove.")
     occurred_at: Optional[str] = Field(default=None, description="Novo timestamp ISO 8601.")
 
 
+class AggregateTransactionsArgs(TransactionFilterArgs):
+    group_by: List[str] = Field(
+        default_factory=list,
+        description="Dimensões: day | week | month | quarter | year | weekday | business_day | category | payment_method | type (vazio = total geral)."
+    )
+    metrics: List[str] = Field(
+        default_factory=lambda: ["sum", "count"],
+        description="Métricas sobre amount: sum | count | avg | min | max | p50 | p90 | pNN (percentil)."
+    )
+    limit: int = Field(default=50, description="Máximo de grupos retornados (máximo 100).")
+
+
+class ForecastBalanceArgs(BaseModel):
+    days: Optional[int] = Field(default=None, description="Horizonte em dias (padrão 30).")
+    months: Optional[int] = Field(default=None, description="Horizonte em meses (alternativa a days).")
+
+
+class ResolvePeriodArgs(BaseModel):
+    period: str = Field(
+        ...,
+        description="today | yesterday | tomorrow | this_week | last_week | next_week | this_month | last_month | "
+                    "next_month | this_quarter | last_quarter | this_year | last_year | last_7_days | last_30_days | "
+                    "next_7_days | next_30_days",
+    )
+    reference_date_local: Optional[str] = Field(default=None, description="Data de referência (YYYY-MM-DD); padrão: hoje.")
+
+
+class AddBusinessDaysArgs(BaseModel):
+    days: int = Field(..., description="Quantidade de dias úteis (negativo = para trás; 0 = próximo dia útil).")
+    date_local: Optional[str] = Field(default=None, description="Data inicial (YYYY-MM-DD); padrão: hoje.")
+
+
+class SimulatePurchaseArgs(BaseModel):
+    amount: float = Field(..., description="Valor total da compra em R$.")
+    installments: int = Field(default=1, description="Número de parcelas mensais (1 = à vista).")
+    months: int = Field(default=3, description="Meses simulados à frente (máximo 24).")
+    min_balance: float = Field(default=0.0, description="Saldo mínimo aceitável (reserva); risco = chance de ficar abaixo dele.")
+
+
+class SpendingProfileArgs(BaseModel):
+    date_from_local: Optional[str] = Field(default=None, description="Início (YYYY-MM-DD); o período vira meses inteiros.")
+    date_to_local: Optional[str] = Field(default=None, description="Fim (YYYY-MM-DD); o período vira meses inteiros.")
+    top: int = Field(default=10, description="Quantas descrições mais frequentes retornar (máximo 25).")
+
+
+class ListAnomaliesArgs(BaseModel):
+    date_from_local: Optional[str] = Field(default=None, description="Início do período (YYYY-MM-DD, America/Sao_Paulo).")
+    date_to_local: Optional[str] = Field(default=None, description="Fim do período (YYYY-MM-DD, America/Sao_Paulo).")
+    category_name: Optional[str] = Field(default=None, description="Filtra pela categoria (nome, busca parcial).")
+    period: Optional[str] = Field(default=None, description="day | week (vazio = ambos).")
+
+
+class RegisterCardArgs(BaseModel):
+    name: str = Field(..., description="Nome do cartão (ex.: Nubank, Itaú Platinum).")
+    closing_day: int = Field(..., description="Dia do fechamento da fatura (1-31).")
+    due_day: int = Field(..., description="Dia do vencimento da fatura (1-31).")
+    credit_limit: Optional[float] = Field(default=None, description="Limite de crédito (opcional).")
+
+
+class CardStatementArgs(BaseModel):
+    card_name: Optional[str] = Field(default=None, description="Nome do cartão (busca parcial); vazio = todos.")
+    closing_month: Optional[str] = Field(default=None, description="Mês de fechamento YYYY-MM (fatura específica); vazio = aberta + última fechada.")
+
+
+class RegisterAccountArgs(BaseModel):
+    name: str = Field(..., description="Nome da conta/carteira (ex.: Itaú, Carteira, Poupança).")
+    kind: str = Field(default="checking", description="checking | savings | wallet | investment.")
+    opening_balance: Optional[float] = Field(default=None, description="Saldo inicial da conta (padrão 0; em atualização, mantém o atual).")
+
+
+class SchedulePaymentArgs(BaseModel):
+    title: str = Field(..., description="O que pagar (ex.: IPVA, aluguel, boleto da internet).")
+    amount: float = Field(..., description="Valor previsto.")
+    due_date_local: str = Field(..., description="Vencimento YYYY-MM-DD (America/Sao_Paulo).")
+    recurrence: Optional[str] = Field(default=None, description="weekly | monthly | yearly; vazio = pagamento único.")
+    category_id: Optional[int] = Field(default=None, description="Categoria da despesa quando for paga (id).")
+    from_account_id: Optional[int] = Field(default=None, description="Conta de onde sai o pagamento (id do account_balances).")
+
+
+class ListDuePaymentsArgs(BaseModel):
+    date_from_local: Optional[str] = Field(default=None, description="Vencimento inicial YYYY-MM-DD; vazio = inclui todas as atrasadas.")
+    date_to_local: Optional[str] = Field(default=None, description="Vencimento final YYYY-MM-DD; vazio = hoje + 6 dias.")
+    include_paid: bool = Field(default=False, description="Incluir as já pagas.")
+
+
+class PayScheduledPaymentArgs(BaseModel):
+    id: int = Field(..., description="ID da conta a pagar (do list_due_payments).")
+    amount: Optional[float] = Field(default=None, description="Valor efetivamente pago, se diferente do previsto.")
+    paid_at: Optional[str] = Field(default=None, description="Quando foi pago (ISO 8601); padrão: agora.")
+    from_account_id: Optional[int] = Field(default=None, description="Conta usada no pagamento, se diferente da cadastrada.")
+    payment_method: Optional[str] = Field(default=None, description="Forma de pagamento (ex.: pix, boleto).")
+
+
+class ProjectOutflowsArgs(BaseModel):
+    days: int = Field(default=30, description="Horizonte em dias (padrão 30).")
+
+
+class BulkUpdateTransactionsArgs(TransactionFilterArgs):
+    set_type_name: Optional[str] = Field(default=None, description="Novo tipo: INCOME | EXPENSES | TRANSFER.")
+    set_category_id: Optional[int] = Field(default=None, description="Nova categoria (id).")
+    set_category_name: Optional[str] = Field(default=None, description="Nova categoria (nome).")
+    set_description: Optional[str] = Field(default=None, description="Nova descrição.")
+    set_payment_method: Optional[str] = Field(default=None, description="Novo meio de pagamento.")
+    dry_run: bool = Field(default=False, description="Se True, só conta e lista os ids que seriam alterados.")
+    max_rows: int = Field(default=BULK_MAX_ROWS, description="Não altera nada se os filtros casarem mais linhas que isso.")
+
+
+class DeleteTransactionsArgs(TransactionFilterArgs):
+    dry_run: bool = Field(default=False, description="Se True, só conta e lista os ids que seriam excluídos.")
+    max_rows: int = Field(default=BULK_MAX_ROWS, description="Não exclui nada se os filtros casarem mais linhas que isso.")
+
+
+def _normalize_type_name(type_name: Optional[str]) -> Optional[str]:
+    if not type_name:
+        return None
+    t = type_name.strip().upper()
+    if t == "EXPENSE":
+        t = "EXPENSES"
+    return t
+
+
+ACCOUNT_DIRECTION_ERROR = (
+    "Contas incompatíveis com o tipo: despesa só tem from_account_id, receita só to_account_id "
+    "e transferência com conta precisa das duas."
+)
+
+
+# Despesa (2) só sai de uma conta, receita (1) só entra; transferência (3) sem conta nenhuma
+# é aceita (usuário sem contas cadastradas), mas com conta precisa de origem e destino
+def _account_direction_ok(type_id: Optional[int], from_account_id: Optional[int], to_account_id: Optional[int]) -> bool:
+    if type_id == 2:
+        return to_account_id is None
+    if type_id == 1:
+        return from_account_id is None
+    if type_id == 3:
+        return (from_account_id is None) == (to_account_id is None)
+    return True
+
+
+# A mesma regra em SQL, para quando o tipo/contas só são conhecidos no statement
+def _account_direction_sql(type_sql: str, from_sql: str, to_sql: str) -> str:
+    return (
+        f"CASE {type_sql} WHEN 2 THEN {to_sql} IS NULL WHEN 1 THEN {from_sql} IS NULL "
+        f"WHEN 3 THEN num_nonnulls({from_sql}, {to_sql}) <> 1 ELSE TRUE END"
+    )
+
+
 #Garante que o campo type da tabela transactions receba um id válido (1=INCOME, 2=EXPENSES, 3=TRANSFER
 def _resolve_type_id(cur, type_id: Optional[int], type_name: Optional[str]) -> Optional[int]:
     if type_name:
-        t = type_name.strip().upper()
-        if t == "EXPENSE":
-            t = "EXPENSES"
+        t = _normalize_type_name(type_name)
         cur.execute("SELECT id FROM transaction_types WHERE UPPER(type)=%s LIMIT 1;", (t,))
         row = cur.fetchone()
         return row[0] if row else None
@@ -72,56 +1112,348 @@ def _resolve_type_id(cur, type_id: Optional[int], type_name: Optional[str]) -> O
     return 2
 
 
-# Tool: add_transaction
-@tool("add_transaction", args_schema=AddTransactionArgs)
-def add_transaction(
-    amount: float,
-    source_text: str,
-    occurred_at: Optional[str] = None,
-    type_id: Optional[int] = None,
-    type_name: Optional[str] = None,
-    category_id: Optional[int] = None,
-    description: Optional[str] = None,
-    payment_method: Optional[str] = None,
-) -> dict:
-    """Insere uma transação financeira no banco de dados Postgres.""" # docstring obrigatório da @tools do langchain (estranho, mas legal né?)
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        resolved_type_id = _resolve_type_id(cur, type_id, type_name)
-        if not resolved_type_id:
-            return {"status": "error", "message": "Tipo inválido (use type_id ou type_name: INCOME/EXPENSES/TRANSFER)."}
+# Chave determinística para que retries do mesmo lançamento não gerem linhas duplicadas
+def _scoped_key(key: str) -> str:
+    """Chave como gravada: prefixada pelo usuário da sessão, para chaves iguais de usuários diferentes não colidirem."""
+    user = _user_id.get()
+    return key if user is None else f"{user}:{key}"
 
-        if occurred_at:
-            cur.execute(
-                """
-                INSERT INTO transactions
-                    (amount, type, category_id, description, payment_method, occurred_at, source_text)
-                VALUES
-                    (%s, %s, %s, %s, %s, %s::timestamptz, %s)
-                RETURNING id, occurred_at;
-                """,
-                (amount, resolved_type_id, category_id, description, payment_method, occurred_at, source_text),
-            )
-        else:
-            cur.execute(
-                """
-                INSERT INTO transactions
-                    (amount, type, category_id, description, payment_method, occurred_at, source_text)
-                VALUES
-                    (%s, %s, %s, %s, %s, NOW(), %s)
-                RETURNING id, occurred_at;
-                """,
-                (amount, resolved_type_id, category_id, description, payment_method, source_text),
-            )
 
-        new_id, occurred = cur.fetchone()
-        conn.commit()
-        return {"status": "ok", "id": new_id, "occurred_at": str(occurred)}
+def _idempotency_key(amount: float, source_text: str, occurred_at: Optional[str]) -> str:
+    text = re.sub(r"\s+", " ", source_text or "").strip().lower()
+    # sem occurred_at, o "tempo" do lançamento é o turno (ou o minuto, fora de um turno)
+    when = occurred_at or _turn_id.get() or time.strftime("%Y-%m-%dT%H:%M")
+    raw = "|".join([str(_session_id.get() or ""), text, f"{float(amount):.2f}", when])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-    except Exception as e:
-        conn.rollback()
-        return {"status": "error", "message": str(e)}
+
+_type_ids = {}
+_type_ids_lock = threading.Lock()
+
+
+# Versão em cache do _resolve_type_id (o write-behind não abre conexão por chamada)
+def _cached_type_id(type_id: Optional[int], type_name: Optional[str]) -> Optional[int]:
+    if type_name:
+        if not _type_ids:
+            with _type_ids_lock:
+                if not _type_ids:
+                    conn = _connect(_shard_dsn(write=False))
+                    try:
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT id, UPPER(type) FROM transaction_types;")
+                            _type_ids.update({name: tid for tid, name in cur.fetchall()})
+                    finally:
+                        conn.close()
+        return _type_ids.get(_normalize_type_name(type_name))
+    if type_id:
+        return int(type_id)
+    return 2
+
+
+class _WriteBehindWriter:
+    """
+    Agrupa inserts de add_transaction vindos de várias sessões (um writer por banco/shard).
+    A cada WRITE_BEHIND_FLUSH_MS (ou WRITE_BEHIND_BATCH linhas) grava tudo com um
+    único INSERT multi-linha e um único commit; cada chamador espera seu Future.
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, row: tuple) -> Future:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="pg-write-behind", daemon=True)
+                    self._thread.start()
+        fut = Future()
+        self._queue.put((row, fut))
+        return fut
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + WRITE_BEHIND_FLUSH_MS / 1000
+        while len(batch) < WRITE_BEHIND_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        _tool_name.set("add_transaction")  # para o log de consultas
+        conn = None
+        while True:
+            batch = self._next_batch()
+            try:
+                if conn is None or conn.closed:
+                    conn = _connect(self.dsn)  # breaker + connect_timeout, como get_conn
+                try:
+                    self._flush(conn, batch)
+                except psycopg2.DatabaseError:
+                    # Uma linha ruim (ex.: FK inválida) não derruba o lote: isola linha a linha
+                    conn.rollback()
+                    for item in batch:
+                        try:
+                            self._flush(conn, [item])
+                        except psycopg2.DatabaseError as e:
+                            conn.rollback()
+                            item[1].set_exception(e)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+
+    def _flush(self, conn, batch: list) -> None:
+        rows = [row for row, _ in batch]
+        with conn.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """
+                INSERT INTO transactions
+                    (amount, type, category_id, description, payment_method, occurred_at, source_text,
+                     idempotency_key, user_id, card_id, from_account_id, to_account_id)
+                SELECT v.amount, v.type, v.category_id, v.description, v.payment_method, v.occurred_at, v.source_text,
+                       v.idempotency_key, v.user_id, v.card_id, v.from_account_id, v.to_account_id
+                FROM (VALUES %s) AS v(amount, type, category_id, description, payment_method, occurred_at, source_text,
+                                      idempotency_key, user_id, card_id, from_account_id, to_account_id)
+                -- cartão e contas precisam ser do mesmo usuário (como no caminho síncrono)
+                WHERE (v.card_id IS NULL OR EXISTS (
+                          SELECT 1 FROM cards WHERE id = v.card_id AND user_id = COALESCE(v.user_id, '')))
+                  AND (SELECT COUNT(*) FROM accounts
+                       WHERE id IN (v.from_account_id, v.to_account_id) AND user_id = COALESCE(v.user_id, ''))
+                      = num_nonnulls(v.from_account_id, v.to_account_id)
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING idempotency_key, id, occurred_at;
+                """,
+                rows,
+                template=(
+                    "(%s::numeric, %s::int, %s::int, %s::text, %s::text, COALESCE(%s::timestamptz, NOW()),"
+                    " %s::text, %s::text, %s::text, %s::bigint, %s::bigint, %s::bigint)"
+                ),
+                fetch=True,
+            )
+            new = {key: (new_id, occurred) for key, new_id, occurred in inserted}
+            missing = [row[7] for row in rows if row[7] not in new]
+            existing = {}
+            if missing:
+                cur.execute(
+                    "SELECT idempotency_key, id, occurred_at FROM transactions WHERE idempotency_key = ANY(%s);",
+                    (missing,),
+                )
+                existing = {key: (old_id, occurred) for key, old_id, occurred in cur.fetchall()}
+        conn.commit()
+        lsn = _current_lsn(conn)
+
+        seen = set()
+        for row, fut in batch:
+            key = row[7]
+            if key in new and key not in seen:
+                new_id, occurred = new[key]
+                fut.set_result(({"status": "ok", "id": new_id, "occurred_at": str(occurred)}, lsn))
+            elif key not in new and key not in existing:
+                # não inserida nem já existente: cartão ou conta de outro usuário (ou inexistente)
+                fut.set_result(({"status": "error", "message": "Cartão ou conta não encontrado (veja card_statement e account_balances)."}, lsn))
+            else:
+                old_id, occurred = new.get(key) or existing[key]
+                fut.set_result(({"status": "ok", "id": old_id, "occurred_at": str(occurred), "duplicate": True}, lsn))
+            seen.add(key)
+
+
+_write_behind = {}  # DSN -> _WriteBehindWriter
+_write_behind_lock = threading.Lock()
+
+
+def _write_behind_for(dsn: str) -> _WriteBehindWriter:
+    with _write_behind_lock:
+        if dsn not in _write_behind:
+            _write_behind[dsn] = _WriteBehindWriter(dsn)
+        return _write_behind[dsn]
+
+
+# Tool: add_transaction
+def _prepare_spooled_add(call: dict) -> dict:
+    # a chave é fixada agora (o replay roda em outro turno); confirm_duplicate fica como o agente
+    # mandou: no replay, um quase-duplicado não é gravado e volta em needs_confirmation
+    call["idempotency_key"] = call.get("idempotency_key") or _idempotency_key(
+        call["amount"], call["source_text"], call.get("occurred_at")
+    )
+    return call
+
+
+@tool("add_transaction", args_schema=AddTransactionArgs)
+@_spooled_write("add_transaction", prepare=_prepare_spooled_add)
+def add_transaction(
+    amount: float,
+    source_text: str,
+    occurred_at: Optional[str] = None,
+    type_id: Optional[int] = None,
+    type_name: Optional[str] = None,
+    category_id: Optional[int] = None,
+    description: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    card_id: Optional[int] = None,
+    from_account_id: Optional[int] = None,
+    to_account_id: Optional[int] = None,
+    idempotency_key: Optional[str] = None,
+    confirm_duplicate: bool = False,
+) -> dict:
+    """
+    Insere uma transação financeira no banco de dados Postgres.
+    Se já existir lançamento parecido (mesmo valor, horário próximo, texto similar), não grava e
+    retorna status 'confirm' com possible_duplicates: pergunte ao usuário e repita com confirm_duplicate=True.
+    """ # docstring obrigatório da @tools do langchain (estranho, mas legal né?)
+    key = _scoped_key(idempotency_key or _idempotency_key(amount, source_text, occurred_at))
+    if from_account_id is not None and from_account_id == to_account_id:
+        return {"status": "error", "message": "from_account_id e to_account_id devem ser contas diferentes."}
+
+    # No write-behind não há checagem de quase-duplicados (exigiria uma leitura por chamada); o dono do cartão/contas é checado no INSERT do lote
+    if WRITE_BEHIND:
+        try:
+            resolved_type_id = _cached_type_id(type_id, type_name)
+            if not resolved_type_id:
+                return {"status": "error", "message": "Tipo inválido (use type_id ou type_name: INCOME/EXPENSES/TRANSFER)."}
+            if not _account_direction_ok(resolved_type_id, from_account_id, to_account_id):
+                return {"status": "error", "message": ACCOUNT_DIRECTION_ERROR}
+            remaining = _remaining_ms()
+            timeout = WRITE_BEHIND_TIMEOUT if remaining is None else min(WRITE_BEHIND_TIMEOUT, remaining / 1000)
+            fut = _write_behind_for(_shard_dsn()).submit(
+                (amount, resolved_type_id, category_id, description, payment_method, occurred_at, source_text,
+                 key, _user_id.get(), card_id, from_account_id, to_account_id)
+            )
+            result, lsn = fut.result(timeout=timeout)
+            _record_write(lsn)
+            if resolved_type_id == 2 and result.get("status") == "ok" and not result.get("duplicate"):
+                _on_expense_written(result["id"])
+            return result
+        except Exception as e:
+            return _error_result(e)
+
+    conn = get_conn()
+    # Um único statement (tipo + quase-duplicados + insert + original em caso de retry): com autocommit, o commit vai junto
+    conn.autocommit = True
+    cur = conn.cursor()
+    direction_sql = _account_direction_sql("tp.id", "%(from_account_id)s::bigint", "%(to_account_id)s::bigint")
+    try:
+        cur.execute(
+            f"""
+            WITH tp AS (
+                SELECT
+                    CASE
+                        WHEN %(type_name)s::text IS NULL THEN %(type_id)s::int
+                        ELSE (SELECT id FROM transaction_types WHERE UPPER(type) = %(type_name)s LIMIT 1)
+                    END AS id,
+                    COALESCE(%(occurred_at)s::timestamptz, NOW()) AS ts,
+                    %(card_id)s::bigint IS NULL OR EXISTS (
+                        SELECT 1 FROM cards WHERE id = %(card_id)s AND user_id = COALESCE(%(user_id)s, '')
+                    ) AS card_ok,
+                    (SELECT COUNT(*) FROM accounts
+                     WHERE id IN (%(from_account_id)s, %(to_account_id)s) AND user_id = COALESCE(%(user_id)s, ''))
+                        = num_nonnulls(%(from_account_id)s, %(to_account_id)s) AS accounts_ok
+            ),
+            -- usa idx_transactions_amount (amount, occurred_at): mesmo valor em uma janela curta, depois similaridade de texto
+            dup AS (
+                SELECT d.id, d.amount, d.occurred_at, COALESCE(d.description, d.source_text) AS text
+                FROM transactions d, tp
+                WHERE d.amount = %(amount)s::numeric
+                  AND d.occurred_at BETWEEN tp.ts - %(window)s * INTERVAL '1 minute'
+                                        AND tp.ts + %(window)s * INTERVAL '1 minute'
+                  AND d.idempotency_key IS DISTINCT FROM %(key)s
+                  AND d.user_id IS NOT DISTINCT FROM %(user_id)s
+                  AND GREATEST(
+                        similarity(LOWER(COALESCE(d.description, '')), LOWER(%(text)s)),
+                        similarity(LOWER(d.source_text), LOWER(%(text)s))
+                      ) >= %(similarity)s
+                ORDER BY d.occurred_at DESC
+                LIMIT 3
+            ),
+            ins AS (
+                INSERT INTO transactions
+                    (amount, type, category_id, description, payment_method, occurred_at, source_text,
+                     idempotency_key, user_id, card_id, from_account_id, to_account_id)
+                SELECT
+                    %(amount)s, tp.id, %(category_id)s, %(description)s, %(payment_method)s,
+                    tp.ts, %(source_text)s, %(key)s, %(user_id)s, %(card_id)s, %(from_account_id)s, %(to_account_id)s
+                FROM tp
+                WHERE tp.id IS NOT NULL AND tp.card_ok AND tp.accounts_ok AND {direction_sql}
+                  AND (%(confirm)s OR NOT EXISTS (SELECT 1 FROM dup))
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING id, occurred_at
+            )
+            SELECT tp.id, tp.card_ok, tp.accounts_ok, {direction_sql}, ins.id, ins.occurred_at, old.id, old.occurred_at,
+                   (SELECT json_agg(json_build_object(
+                        'id', dup.id, 'amount', dup.amount, 'occurred_at', dup.occurred_at, 'text', dup.text
+                    )) FROM dup)
+            FROM tp
+            LEFT JOIN ins ON TRUE
+            LEFT JOIN transactions old ON ins.id IS NULL AND old.idempotency_key = %(key)s;
+            """,
+            {
+                "type_name": _normalize_type_name(type_name),
+                "type_id": int(type_id) if type_id else 2,
+                "amount": amount,
+                "category_id": category_id,
+                "description": description,
+                "payment_method": payment_method,
+                "card_id": card_id,
+                "from_account_id": from_account_id,
+                "to_account_id": to_account_id,
+                "occurred_at": occurred_at,
+                "source_text": source_text,
+                "key": key,
+                "user_id": _user_id.get(),
+                "text": description or source_text,
+                "window": NEAR_DUP_WINDOW_MINUTES,
+                "similarity": NEAR_DUP_SIMILARITY,
+                "confirm": bool(confirm_duplicate),
+            },
+        )
+        (resolved_type_id, card_ok, accounts_ok, direction_ok, new_id, occurred,
+         original_id, original_occurred, possible_duplicates) = cur.fetchone()
+        if not resolved_type_id:
+            return {"status": "error", "message": "Tipo inválido (use type_id ou type_name: INCOME/EXPENSES/TRANSFER)."}
+        if not card_ok:
+            return {"status": "error", "message": f"Cartão {card_id} não encontrado (veja os cartões com card_statement)."}
+        if not accounts_ok:
+            return {"status": "error", "message": "Conta não encontrada (veja as contas com account_balances)."}
+        if not direction_ok:
+            return {"status": "error", "message": ACCOUNT_DIRECTION_ERROR}
+
+        if new_id is None and original_id is not None:
+            # Chamada repetida: devolve o lançamento original sem escrever de novo
+            return {"status": "ok", "id": original_id, "occurred_at": str(original_occurred), "duplicate": True}
+
+        if new_id is None and possible_duplicates and not confirm_duplicate:
+            return {
+                "status": "confirm",
+                "message": "Possível lançamento duplicado; confirme com o usuário antes de gravar.",
+                "possible_duplicates": possible_duplicates,
+            }
+
+        if new_id is None:
+            # o original foi commitado por outra sessão depois do snapshot deste statement
+            cur.execute("SELECT id, occurred_at FROM transactions WHERE idempotency_key = %s;", (key,))
+            original_id, original_occurred = cur.fetchone()
+            return {"status": "ok", "id": original_id, "occurred_at": str(original_occurred), "duplicate": True}
+
+        _mark_write(conn)
+        if resolved_type_id == 2:
+            _on_expense_written(new_id)
+        return {"status": "ok", "id": new_id, "occurred_at": str(occurred)}
+
+    except Exception as e:
+        return _error_result(e)
     finally:
         try:
             cur.close()
@@ -129,81 +1461,378 @@ def add_transaction(
         except Exception:
             pass
 
+LOCAL_DATE_SQL = "DATE(t.occurred_at AT TIME ZONE 'America/Sao_Paulo')"
+WEEKDAY_NAMES = ("segunda", "terça", "quarta", "quinta", "sexta", "sábado", "domingo")
+
+# Colunas que o query_transactions pode projetar (nome de saída -> expressão)
+TRANSACTION_FIELDS = {
+    "id": "t.id",
+    "amount": "t.amount",
+    "type_name": "tt.type AS type_name",
+    "category_id": "t.category_id",
+    "category": "c.name AS category",
+    "description": "t.description",
+    "payment_method": "t.payment_method",
+    "occurred_at_local": "t.occurred_at AT TIME ZONE 'America/Sao_Paulo' AS occurred_at_local",
+    "source_text": "t.source_text",
+}
+DEFAULT_TRANSACTION_FIELDS = [f for f in TRANSACTION_FIELDS if f != "category"]
+
+
+# Filtros comuns das tools de leitura sobre transactions (alias t)
+def _transaction_filters(
+    text: Optional[str] = None,
+    type_name: Optional[str] = None,
+    date_local: Optional[str] = None,
+    date_from_local: Optional[str] = None,
+    date_to_local: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    category_id: Optional[int] = None,
+    category_name: Optional[str] = None,
+    payment_method: Optional[str] = None,
+):
+    where_conditions, params = _user_filter("t")
+
+    if text:
+        where_conditions.append("(t.source_text ILIKE %s OR t.description ILIKE %s)")
+        params.extend([f"%{text}%", f"%{text}%"])
+
+    if type_name:
+        where_conditions.append("t.type IN (SELECT id FROM transaction_types WHERE UPPER(type) = %s)")
+        params.append(_normalize_type_name(type_name))
+
+    if date_local:
+        where_conditions.append(f"{LOCAL_DATE_SQL} = %s")
+        params.append(date_local)
+    elif date_from_local and date_to_local:
+        where_conditions.append(f"{LOCAL_DATE_SQL} BETWEEN %s AND %s")
+        params.extend([date_from_local, date_to_local])
+    elif date_from_local:
+        where_conditions.append(f"{LOCAL_DATE_SQL} >= %s")
+        params.append(date_from_local)
+    elif date_to_local:
+        where_conditions.append(f"{LOCAL_DATE_SQL} <= %s")
+        params.append(date_to_local)
+
+    if min_amount is not None:
+        where_conditions.append("t.amount >= %s")
+        params.append(min_amount)
+    if max_amount is not None:
+        where_conditions.append("t.amount <= %s")
+        params.append(max_amount)
+
+    if category_id is not None:
+        where_conditions.append("t.category_id = %s")
+        params.append(category_id)
+    elif category_name:
+        # resolvido no próprio banco, sem ida-e-volta extra
+        where_conditions.append("t.category_id IN (SELECT id FROM categories WHERE LOWER(name) = LOWER(%s))")
+        params.append(category_name.strip())
+
+    if payment_method:
+        where_conditions.append("t.payment_method ILIKE %s")
+        params.append(f"%{payment_method.strip()}%")
+
+    return where_conditions, params
+
+
+# ----- Arquivo frio (Parquet) -----
+# Linhas arquivadas saem de transactions; ficam só os totais diários em transactions_archive_daily
+# e o limite em archive_state. As tools de leitura só abrem os Parquet quando o período pedido
+# começa antes desse limite (duckdb/pyarrow são importados só nesse caminho).
+
+_archive_before_cache = {}  # DSN -> (data-limite, carregado_em)
+
+
+def _archive_before(cur) -> Optional[dt.date]:
+    """Data local antes da qual pode haver dados arquivados neste banco (None se nada foi arquivado)."""
+    dsn = cur.connection.dsn
+    cached = _archive_before_cache.get(dsn)
+    if cached is None or time.monotonic() - cached[1] > 60:
+        cur.execute("SELECT to_regclass('archive_state') IS NOT NULL;")
+        value = None
+        if cur.fetchone()[0]:
+            cur.execute("SELECT MAX(archived_before) FROM archive_state;")
+            value = cur.fetchone()[0]
+        cached = (value, time.monotonic())
+        _archive_before_cache[dsn] = cached
+    return cached[0]
+
+
+_archive_daily_dsns = set()  # DSNs em que transactions_archive_daily já existe
+
+
+def _archive_daily_union(cur, columns: str, owner_sql: str) -> str:
+    """
+    UNION ALL com os totais diários arquivados, para somar às linhas de transactions.
+    Vazio enquanto transactions_archive_daily não existe neste banco (DDL do arquivo não aplicado).
+    """
+    dsn = cur.connection.dsn
+    if dsn not in _archive_daily_dsns:
+        cur.execute("SELECT to_regclass('transactions_archive_daily') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return ""
+        _archive_daily_dsns.add(dsn)
+    # totais diários das transações já arquivadas em Parquet
+    return f"UNION ALL SELECT {columns} FROM transactions_archive_daily x {owner_sql}"
+
+
+def _archive_dir(shard: Optional[int] = None) -> str:
+    # com sharding, cada shard arquiva no próprio subdiretório
+    if shard is None:
+        shard = _current_shard()
+    return ARCHIVE_DIR if shard is None else os.path.join(ARCHIVE_DIR, f"shard{shard}")
+
+
+def _range_bounds(date_local, date_from_local, date_to_local):
+    lower = date_local or date_from_local
+    upper = date_local or date_to_local
+    return (
+        dt.date.fromisoformat(lower) if lower else None,
+        dt.date.fromisoformat(upper) if upper else None,
+    )
+
+
+def _archive_files(lower: Optional[dt.date], upper: Optional[dt.date]) -> list:
+    # um arquivo por mês (YYYY-MM.parquet): poda pelos meses do período
+    files = []
+    for path in sorted(glob.glob(os.path.join(_archive_dir(), "*.parquet"))):
+        try:
+            month = dt.datetime.strptime(os.path.basename(path)[:7], "%Y-%m").date()
+        except ValueError:
+            continue
+        if lower and month < lower.replace(day=1):
+            continue
+        if upper and month > upper:
+            continue
+        files.append(path)
+    return files
+
+
+# Mesmos filtros do _transaction_filters, na sintaxe do DuckDB sobre as colunas do Parquet
+def _archive_filters(
+    text=None, type_name=None, date_local=None, date_from_local=None, date_to_local=None,
+    min_amount=None, max_amount=None, category_id=None, category_name=None, payment_method=None,
+):
+    where_conditions = []
+    params = []
+    if _user_id.get() is not None:
+        where_conditions.append("user_id = ?")
+        params.append(_user_id.get())
+    if text:
+        where_conditions.append("(source_text ILIKE ? OR description ILIKE ?)")
+        params.extend([f"%{text}%", f"%{text}%"])
+    if type_name:
+        where_conditions.append("UPPER(type_name) = ?")
+        params.append(_normalize_type_name(type_name))
+    if date_local:
+        where_conditions.append("local_date = CAST(? AS DATE)")
+        params.append(date_local)
+    else:
+        if date_from_local:
+            where_conditions.append("local_date >= CAST(? AS DATE)")
+            params.append(date_from_local)
+        if date_to_local:
+            where_conditions.append("local_date <= CAST(? AS DATE)")
+            params.append(date_to_local)
+    if min_amount is not None:
+        where_conditions.append("amount >= ?")
+        params.append(min_amount)
+    if max_amount is not None:
+        where_conditions.append("amount <= ?")
+        params.append(max_amount)
+    if category_id is not None:
+        where_conditions.append("category_id = ?")
+        params.append(category_id)
+    elif category_name:
+        where_conditions.append("LOWER(category) = LOWER(?)")
+        params.append(category_name.strip())
+    if payment_method:
+        where_conditions.append("payment_method ILIKE ?")
+        params.append(f"%{payment_method.strip()}%")
+    return where_conditions, params
+
+
+def _archive_query(files: list, select_sql: str, filters: dict, tail_sql: str = "", tail_params=()) -> list:
+    """Roda um SELECT no DuckDB sobre os Parquet indicados; devolve lista de dicts."""
+    import duckdb
+
+    _remaining_ms()  # não começa a varrer o arquivo com o prazo do turno já esgotado
+    where_conditions, params = _archive_filters(**filters)
+    sources = ", ".join("'" + f.replace("'", "''") + "'" for f in files)
+    query = f"SELECT {select_sql} FROM read_parquet([{sources}], union_by_name = true)"
+    if where_conditions:
+        query += " WHERE " + " AND ".join(where_conditions)
+    query += " " + tail_sql
+    with duckdb.connect() as db:
+        cursor = db.execute(query, params + list(tail_params))
+        columns = [desc[0] for desc in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _compact_value(value):
+    if isinstance(value, (Decimal, float)):
+        return round(float(value), 2)
+    if isinstance(value, dt.datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, dt.date):
+        return value.isoformat()
+    if isinstance(value, str) and len(value) > TEXT_MAX_CHARS:
+        return value[:TEXT_MAX_CHARS] + "…"
+    return value
+
+
+def _summarize_rows(columns: list, rows: list) -> dict:
+    # Resumo agregado das linhas (inclusive as cortadas): somas numéricas e faixa de datas
+    summary = {}
+    for i, col in enumerate(columns):
+        values = [r[i] for r in rows if r[i] is not None]
+        if not values or col == "id" or col.endswith("_id"):
+            continue
+        if all(isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in values):
+            summary[f"{col}_sum"] = round(float(sum(values)), 2)
+        elif col == "date" or "occurred_at" in col:
+            summary[f"{col}_min"] = _compact_value(min(values))
+            summary[f"{col}_max"] = _compact_value(max(values))
+    return summary
+
+
+def _compact_result(results: list) -> dict:
+    """
+    Converte uma lista de dicts no formato colunar {columns, rows}.
+    Arredonda valores, encurta textos longos, remove colunas sempre nulas e,
+    se o total passar de RESULT_TOKEN_BUDGET (~4 chars/token), corta as linhas
+    (mantendo ao menos uma) e informa more_rows + summary.
+    """
+    if not results:
+        return {"status": "ok", "columns": [], "rows": [], "count": 0}
+
+    columns = [c for c in results[0] if any(r.get(c) is not None for r in results)]
+    raw_rows = [[r.get(c) for c in columns] for r in results]
+    rows = [[_compact_value(v) for v in raw] for raw in raw_rows]
+
+    budget_chars = RESULT_TOKEN_BUDGET * 4
+    used = len(json.dumps(columns, ensure_ascii=False))
+    kept = 0
+    for row in rows:
+        used += len(json.dumps(row, ensure_ascii=False, default=str)) + 1
+        if used > budget_chars and kept:  # a primeira linha sempre vai, mesmo passando do orçamento
+            break
+        kept += 1
+
+    out = {"status": "ok", "columns": columns, "rows": rows[:kept], "count": len(rows)}
+    if kept < len(rows):
+        out["more_rows"] = len(rows) - kept
+        out["summary"] = _summarize_rows(columns, raw_rows)
+    return out
+
+
 @tool("query_transactions", args_schema=QueryTransactionsArgs)
+@_cached_read("query_transactions")
 def query_transactions(
     text: Optional[str] = None,
     type_name: Optional[str] = None,
     date_local: Optional[str] = None,
     date_from_local: Optional[str] = None,
     date_to_local: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    category_id: Optional[int] = None,
+    category_name: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+    order_by_amount: Optional[str] = None,
     limit: int = 20
 ) -> dict:
     """
-    Consulta transações com filtros por texto (source_text/description), tipo e datas locais (America/Sao_Paulo).
+    Consulta transações com filtros por texto (source_text/description), tipo, datas locais (America/Sao_Paulo),
+    faixa de valor, categoria e forma de pagamento. Use 'fields' para trazer só as colunas necessárias.
     Os dados devem vir na seguinte ordem:
+        - order_by_amount (asc/desc): por valor (top-N)
         - Intervalo (date_from_local/date_to_local): ASC (cronológico)
         - Caso contrário: DESC (mais recentes primeiro)
+    Retorno: data (ou columns + rows, no modo compacto); se houver more_rows, use summary para os totais.
     """
-    conn = get_conn()
+    selected = [f.strip().lower() for f in (fields or DEFAULT_TRANSACTION_FIELDS)]
+    bad_fields = [f for f in selected if f not in TRANSACTION_FIELDS]
+    if bad_fields:
+        return {"status": "error", "message": f"Campo inválido: {bad_fields}. Use: {list(TRANSACTION_FIELDS)}."}
+    if order_by_amount and order_by_amount.strip().lower() not in ("asc", "desc"):
+        return {"status": "error", "message": "order_by_amount deve ser 'asc' ou 'desc'."}
+
+    filters = dict(
+        text=text, type_name=type_name, date_local=date_local,
+        date_from_local=date_from_local, date_to_local=date_to_local,
+        min_amount=min_amount, max_amount=max_amount, category_id=category_id,
+        category_name=category_name, payment_method=payment_method,
+    )
+    conn = get_read_conn()
     cur = conn.cursor()
     
     try:
-        where_conditions = []
-        params = []
-        
-        if text:
-            where_conditions.append("(source_text ILIKE %s OR description ILIKE %s)")
-            params.extend([f"%{text}%", f"%{text}%"])
-        
-        if type_name:
-            type_id = _resolve_type_id(cur, None, type_name)
-            if type_id:
-                where_conditions.append("t.type = %s")
-                params.append(type_id)
-
-        if date_local:
-            where_conditions.append("DATE(occurred_at AT TIME ZONE 'America/Sao_Paulo') = %s")
-            params.append(date_local)
-        elif date_from_local and date_to_local:
-            where_conditions.append("DATE(occurred_at AT TIME ZONE 'America/Sao_Paulo') BETWEEN %s AND %s")
-            params.extend([date_from_local, date_to_local])
-        elif date_from_local:
-            where_conditions.append("DATE(occurred_at AT TIME ZONE 'America/Sao_Paulo') >= %s")
-            params.append(date_from_local)
-        elif date_to_local:
-            where_conditions.append("DATE(occurred_at AT TIME ZONE 'America/Sao_Paulo') <= %s")
-            params.append(date_to_local)
+        where_conditions, params = _transaction_filters(**filters)
         
-        order_by = "DESC"
-        if date_from_local and date_to_local:
-            order_by = "ASC"
+        # direções separadas: o merge com o arquivo reordena pelas mesmas chaves
+        amount_desc = bool(order_by_amount) and order_by_amount.strip().lower() == "desc"
+        occurred_desc = bool(order_by_amount) or not (date_from_local and date_to_local)
+        order_by = f"t.occurred_at {'DESC' if occurred_desc else 'ASC'}"
+        if order_by_amount:
+            order_by = f"t.amount {'DESC' if amount_desc else 'ASC'}, {order_by}"
+
+        # com dados arquivados, traz as chaves de ordenação para intercalar com o Parquet
+        archive_before = _archive_before(cur)
+        sort_cols = ""
+        if archive_before:
+            sort_cols = ", t.occurred_at AT TIME ZONE 'America/Sao_Paulo' AS _occ, t.amount AS _amt"
         
-        query = """
-        SELECT 
-            t.id,
-            t.amount,
-            tt.type as type_name,
-            t.category_id,
-            t.description,
-            t.payment_method,
-            t.occurred_at AT TIME ZONE 'America/Sao_Paulo' as occurred_at_local,
-            t.source_text
+        query = f"""
+        SELECT {", ".join(TRANSACTION_FIELDS[f] for f in selected)}{sort_cols}
         FROM transactions t
         JOIN transaction_types tt ON t.type = tt.id
         """
+        if "category" in selected:
+            query += " LEFT JOIN categories c ON c.id = t.category_id"
         
         if where_conditions:
             query += " WHERE " + " AND ".join(where_conditions)
         
-        query += f" ORDER BY t.occurred_at {order_by} LIMIT %s"
-        params.append(min(limit, 100))
+        query += f" ORDER BY {order_by} LIMIT %s"
+        max_rows = min(limit, 100)
+        params.append(max_rows)
         
         cur.execute(query, params)
         rows = cur.fetchall()
         
         columns = [desc[0] for desc in cur.description]
         results = [dict(zip(columns, row)) for row in rows]
+
+        # Período começa antes do arquivo (ou sem data e faltaram linhas, ou ordenado por valor:
+        # os maiores/menores podem estar arquivados): completa com o Parquet
+        lower, upper = _range_bounds(date_local, date_from_local, date_to_local)
+        if archive_before and (lower < archive_before if lower else order_by_amount or len(results) < max_rows):
+            files = _archive_files(lower, upper)
+            if files:
+                archive_order = order_by.replace("t.occurred_at", "_occ").replace("t.amount", "_amt")
+                results += _archive_query(
+                    files,
+                    ", ".join(selected) + ", occurred_at_local AS _occ, amount AS _amt",
+                    filters,
+                    f"ORDER BY {archive_order} LIMIT ?",
+                    [max_rows],
+                )
+                # sort estável: data como desempate, valor como chave principal
+                results.sort(key=lambda r: r["_occ"], reverse=occurred_desc)
+                if order_by_amount:
+                    results.sort(key=lambda r: r["_amt"], reverse=amount_desc)
+                results = results[:max_rows]
+        for result in results:
+            result.pop("_occ", None)
+            result.pop("_amt", None)
         
+        if COMPACT_RESULTS:
+            return _compact_result(results)
+
         for result in results:
             if 'occurred_at_local' in result and result['occurred_at_local']:
                 result['occurred_at_local'] = str(result['occurred_at_local'])
@@ -211,34 +1840,41 @@ def query_transactions(
         return {"status": "ok", "data": results, "count": len(results)}
         
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        return _error_result(e)
         
     finally:
         try:
             cur.close()
-            conn.close()
+            release_conn(conn)
         except Exception:
             pass
 
 
 @tool("total_balance")
+@_cached_read("total_balance")
 def total_balance() -> dict:
     """
     Calcula o saldo total (entradas menos saídas) das transações.
+    Saldo por conta/carteira e patrimônio líquido: use account_balances.
     """
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor()
     
     try:
-        query = """
+        owner_conditions, owner_params = _user_filter("x")
+        owner_sql = f"WHERE {owner_conditions[0]}" if owner_conditions else ""
+        archive_sql = _archive_daily_union(cur, "type, total AS amount", owner_sql)
+        query = f"""
         SELECT
             COALESCE(SUM(CASE WHEN t.type = 1 THEN t.amount ELSE 0 END), 0) AS total_income,
             COALESCE(SUM(CASE WHEN t.type = 2 THEN t.amount ELSE 0 END), 0) AS total_expenses,
             COALESCE(SUM(CASE WHEN t.type = 1 THEN t.amount ELSE 0 END), 0) - COALESCE(SUM(CASE WHEN t.type = 2 THEN t.amount ELSE 0 END), 0) AS total_balance
-        FROM
-            transactions t;
+        FROM (
+            SELECT type, amount FROM transactions x {owner_sql}
+            {archive_sql}
+        ) t;
         """
-        cur.execute(query)
+        cur.execute(query, owner_params * (2 if archive_sql else 1))
         row = cur.fetchone()
         
         if row:
@@ -252,40 +1888,47 @@ def total_balance() -> dict:
             return {"status": "error", "message": "No data"}
             
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        return _error_result(e)
     finally:
         try:
             cur.close()
-            conn.close()
+            release_conn(conn)
         except Exception:
             pass
 
 @tool("daily_balance")
+@_cached_read("daily_balance")
 def daily_balance() -> dict:
     """
     Retorna o saldo diário agrupado por data (America/Sao_Paulo).
     Ignora TRANSFER (type=3).
+    Retorno: data (ou columns + rows, no modo compacto); se houver more_rows, use summary para os totais.
     """
-    conn = get_conn()
+    conn = get_read_conn()
     cur = conn.cursor()
     
     try:
-        query = """
+        owner_conditions, owner_params = _user_filter("x")
+        owner_sql = f"WHERE {owner_conditions[0]}" if owner_conditions else ""
+        archive_sql = _archive_daily_union(cur, "day, type, total AS amount", owner_sql)
+        query = f"""
         SELECT
-            DATE(t.occurred_at AT TIME ZONE 'America/Sao_Paulo') AS date,
+            t.day AS date,
             COALESCE(SUM(CASE WHEN t.type = 1 THEN t.amount ELSE 0 END), 0) AS total_income,
             COALESCE(SUM(CASE WHEN t.type = 2 THEN t.amount ELSE 0 END), 0) AS total_expenses,
             COALESCE(SUM(CASE WHEN t.type = 1 THEN t.amount ELSE 0 END), 0) - COALESCE(SUM(CASE WHEN t.type = 2 THEN t.amount ELSE 0 END), 0) AS daily_balance
-        FROM
-            transactions t
+        FROM (
+            SELECT DATE(occurred_at AT TIME ZONE 'America/Sao_Paulo') AS day, type, amount FROM transactions x {owner_sql}
+            {archive_sql}
+        ) t
         WHERE
             t.type IN (1, 2)  -- Ignora TRANSFER (type=3)
         GROUP BY
-            DATE(t.occurred_at AT TIME ZONE 'America/Sao_Paulo')
+            t.day
         ORDER BY
-            DATE(t.occurred_at AT TIME ZONE 'America/Sao_Paulo') DESC;
+            t.day DESC;
         """
-        cur.execute(query)
+        cur.execute(query, owner_params * (2 if archive_sql else 1))
         rows = cur.fetchall()
         
         results = []
@@ -296,152 +1939,3242 @@ def daily_balance() -> dict:
                 "total_expenses": float(row[2]),
                 "daily_balance": float(row[3])
             })
-        
+
+        if COMPACT_RESULTS:
+            return _compact_result(results)
+
         return {"status": "ok", "data": results, "count": len(results)}
         
     except Exception as e:
-        return {"status": "error", "message": str(e)}
+        return _error_result(e)
     finally:
         try:
             cur.close()
-            conn.close()
+            release_conn(conn)
         except Exception:
             pass
 
-@tool("update_transaction", args_schema=UpdateTransactionArgs)
-def update_transaction(
-    id: Optional[int] = None,
-    match_text: Optional[str] = None,
-    date_local: Optional[str] = None,
-    amount: Optional[float] = None,
-    type_id: Optional[int] = None,
+# Dimensões e métricas aceitas pelo aggregate_transactions (nunca interpolar texto do LLM)
+AGGREGATE_DIMENSIONS = {
+    "day": LOCAL_DATE_SQL,
+    # dimensões de período vêm da tabela calendar (join pela chave do dia local)
+    "week": "cal.week_start",
+    "month": "cal.month_start",
+    "quarter": "cal.quarter_start",
+    "year": "cal.year",
+    "weekday": "cal.iso_dow",
+    "business_day": "cal.is_business_day",
+    "category": "c.name",
+    "payment_method": "t.payment_method",
+    "type": "tt.type",
+}
+
+CALENDAR_DIMENSIONS = {"week", "month", "quarter", "year", "weekday", "business_day"}
+
+AGGREGATE_METRICS = {
+    "sum": "COALESCE(SUM(t.amount), 0)",
+    "count": "COUNT(*)",
+    "avg": "AVG(t.amount)",
+    "min": "MIN(t.amount)",
+    "max": "MAX(t.amount)",
+}
+
+
+# Equivalentes no DuckDB, sobre as colunas do Parquet arquivado
+ARCHIVE_DIMENSIONS = {
+    "day": "local_date",
+    "week": "CAST(DATE_TRUNC('week', occurred_at_local) AS DATE)",
+    "month": "CAST(DATE_TRUNC('month', occurred_at_local) AS DATE)",
+    "quarter": "CAST(DATE_TRUNC('quarter', occurred_at_local) AS DATE)",
+    "year": "YEAR(local_date)",
+    "weekday": "ISODOW(local_date)",
+    "category": "category",
+    "payment_method": "payment_method",
+    "type": "type_name",
+}
+
+ARCHIVE_METRICS = {
+    "sum": "COALESCE(SUM(amount), 0)",
+    "count": "COUNT(*)",
+    "avg": "AVG(amount)",
+    "min": "MIN(amount)",
+    "max": "MAX(amount)",
+}
+
+
+def _merge_aggregates(group_by: list, metrics: list, rows: list) -> list:
+    # Junta grupos vindos do Postgres e do Parquet; avg é refeito a partir de _sum/_n
+    groups = {}
+    for row in rows:
+        key = tuple(row[g] for g in group_by)
+        acc = groups.get(key)
+        if acc is None:
+            groups[key] = dict(row)
+            continue
+        for m in metrics:
+            a, b = acc[m], row[m]
+            if m in ("sum", "count"):
+                acc[m] = a + b
+            elif m in ("min", "max") and (a is None or b is None):
+                acc[m] = b if a is None else a
+            elif m == "min":
+                acc[m] = min(a, b)
+            elif m == "max":
+                acc[m] = max(a, b)
+        acc["_sum"] += row["_sum"]
+        acc["_n"] += row["_n"]
+    merged = []
+    for acc in groups.values():
+        if "avg" in metrics:
+            acc["avg"] = acc["_sum"] / acc["_n"] if acc["_n"] else None
+        acc.pop("_sum")
+        acc.pop("_n")
+        merged.append(acc)
+    return sorted(merged, key=lambda r: tuple((r[g] is None, r[g]) for g in group_by))
+
+
+def _metric_sql(metric: str) -> Optional[str]:
+    m = metric.strip().lower()
+    if m in AGGREGATE_METRICS:
+        return AGGREGATE_METRICS[m]
+    match = re.fullmatch(r"p(\d{1,2})", m)
+    if match:
+        return f"PERCENTILE_CONT({int(match.group(1)) / 100}) WITHIN GROUP (ORDER BY t.amount)"
+    return None
+
+
+@tool("aggregate_transactions", args_schema=AggregateTransactionsArgs)
+@_cached_read("aggregate_transactions")
+def aggregate_transactions(
+    group_by: Optional[List[str]] = None,
+    metrics: Optional[List[str]] = None,
+    text: Optional[str] = None,
     type_name: Optional[str] = None,
+    date_local: Optional[str] = None,
+    date_from_local: Optional[str] = None,
+    date_to_local: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
     category_id: Optional[int] = None,
     category_name: Optional[str] = None,
-    description: Optional[str] = None,
     payment_method: Optional[str] = None,
-    occurred_at: Optional[str] = None,
+    limit: int = 50,
 ) -> dict:
     """
-    Atualiza uma transação existente.
-    Estratégias:
-      - Se 'id' for informado: atualiza diretamente por ID.
-      - Caso contrário: localiza a transação mais recente que combine (match_text em source_text/description)
-        E (date_local em America/Sao_Paulo), então atualiza.
-    Retorna: status, rows_affected, id, e o registro atualizado.
+    Agrega transações no banco (quanto / quantas / em média) em uma única consulta.
+    Agrupa por dia/semana/mês/trimestre/ano local, dia da semana (1 = segunda), dia útil ou não,
+    categoria, forma de pagamento ou tipo, com os mesmos filtros do query_transactions.
+    Para gastos, filtre type_name=EXPENSES ou agrupe por type.
     """
-    if not any([amount, type_id, type_name, category_id, category_name, description, payment_method, occurred_at]):
-        return {"status": "error", "message": "Nada para atualizar: forneça pelo menos um campo (amount, type, category, description, payment_method, occurred_at)."}
+    group_by = [g.strip().lower() for g in (group_by or [])]
+    metrics = metrics or ["sum", "count"]
 
-    conn = get_conn()
+    bad_dims = [g for g in group_by if g not in AGGREGATE_DIMENSIONS]
+    if bad_dims:
+        return {"status": "error", "message": f"Dimensão inválida: {bad_dims}. Use: {list(AGGREGATE_DIMENSIONS)}."}
+    metric_sql = [(m.strip().lower(), _metric_sql(m)) for m in metrics]
+    bad_metrics = [m for m, sql in metric_sql if sql is None]
+    if bad_metrics:
+        return {"status": "error", "message": f"Métrica inválida: {bad_metrics}. Use sum, count, avg, min, max ou pNN."}
+
+    filters = dict(
+        text=text, type_name=type_name, date_local=date_local,
+        date_from_local=date_from_local, date_to_local=date_to_local,
+        min_amount=min_amount, max_amount=max_amount, category_id=category_id,
+        category_name=category_name, payment_method=payment_method,
+    )
+    conn = get_read_conn()
     cur = conn.cursor()
     try:
-        # Resolve target_id
-        target_id = id
-        if target_id is None:
-            if not match_text or not date_local:
-                return {"status": "error", "message": "Sem 'id': informe match_text E date_local para localizar o registro."}
+        where_conditions, params = _transaction_filters(**filters)
 
-            # Buscar o mais recente no dia local informado que combine o texto
-            cur.execute(
-                f"""
-                SELECT t.id
-                FROM transactions t
-                WHERE (t.source_text ILIKE %s OR t.description ILIKE %s)
-                  AND {_local_date_filter_sql("t.occurred_at")}
-                ORDER BY t.occurred_at DESC
-                LIMIT 1;
-                """,
-                (f"%{match_text}%", f"%{match_text}%", date_local)
-            )
-            row = cur.fetchone()
-            if not row:
-                return {"status": "error", "message": "Nenhuma transação encontrada para os filtros fornecidos."}
-            target_id = row[0]
-
-        # Resolver type_id / category_id a partir de nomes, se fornecidos
-        resolved_type_id = _resolve_type_id(cur, type_id, type_name) if (type_id or type_name) else None
-        resolved_category_id = category_id
-        if category_name and not category_id:
-            resolved_category_id = _get_category_id(cur, category_name)
-
-        # Montar SET dinâmico
-        sets = []
-        params: List[object] = []
-        if amount is not None:
-            sets.append("amount = %s")
-            params.append(amount)
-        if resolved_type_id is not None:
-            sets.append("type = %s")
-            params.append(resolved_type_id)
-        if resolved_category_id is not None:
-            sets.append("category_id = %s")
-            params.append(resolved_category_id)
-        if description is not None:
-            sets.append("description = %s")
-            params.append(description)
-        if payment_method is not None:
-            sets.append("payment_method = %s")
-            params.append(payment_method)
-        if occurred_at is not None:
-            sets.append("occurred_at = %s::timestamptz")
-            params.append(occurred_at)
-
-        if not sets:
-            return {"status": "error", "message": "Nenhum campo válido para atualizar."}
-
-        params.append(target_id)
+        # Período que alcança o arquivo: agrega também os Parquet e junta os grupos
+        archive_before = _archive_before(cur)
+        lower, upper = _range_bounds(date_local, date_from_local, date_to_local)
+        files = []
+        if archive_before and (lower is None or lower < archive_before):
+            files = _archive_files(lower, upper)
+        if files and any(m.startswith("p") for m, _ in metric_sql):
+            return {
+                "status": "error",
+                "message": f"Percentis não são suportados em períodos com dados arquivados (antes de {archive_before}); use um período a partir dessa data.",
+            }
+        if files and "business_day" in group_by:
+            return {
+                "status": "error",
+                "message": f"Agrupar por business_day não é suportado em períodos com dados arquivados (antes de {archive_before}).",
+            }
 
+        select_cols = [f"{AGGREGATE_DIMENSIONS[g]} AS {g}" for g in group_by]
+        select_cols += [f"{sql} AS {m}" for m, sql in metric_sql]
+        if files:
+            select_cols += ["COALESCE(SUM(t.amount), 0) AS _sum", "COUNT(*) AS _n"]
+        query = f"""
+        SELECT {", ".join(select_cols)}
+        FROM transactions t
+        JOIN transaction_types tt ON t.type = tt.id
+        LEFT JOIN categories c ON c.id = t.category_id
+        """
+        if CALENDAR_DIMENSIONS.intersection(group_by):
+            query += f" JOIN calendar cal ON cal.day = {LOCAL_DATE_SQL}"
+        if where_conditions:
+            query += " WHERE " + " AND ".join(where_conditions)
+        if group_by:
+            positions = ", ".join(str(i + 1) for i in range(len(group_by)))
+            query += f" GROUP BY {positions} ORDER BY {positions}"
+        if not files:
+            query += " LIMIT %s"
+            params.append(min(limit, 100))
+
+        cur.execute(query, params)
+        columns = [desc[0] for desc in cur.description]
+        results = [dict(zip(columns, row)) for row in cur.fetchall()]
+
+        if files:
+            archive_cols = [f"{ARCHIVE_DIMENSIONS[g]} AS {g}" for g in group_by]
+            archive_cols += [f"{ARCHIVE_METRICS[m]} AS {m}" for m, _ in metric_sql]
+            archive_cols += ["COALESCE(SUM(amount), 0) AS _sum", "COUNT(*) AS _n"]
+            tail = ""
+            if group_by:
+                tail = "GROUP BY " + ", ".join(str(i + 1) for i in range(len(group_by)))
+            results += _archive_query(files, ", ".join(archive_cols), filters, tail)
+            results = _merge_aggregates(group_by, [m for m, _ in metric_sql], results)[:min(limit, 100)]
+
+        if COMPACT_RESULTS:
+            return _compact_result(results)
+        for result in results:
+            for k, v in result.items():
+                if isinstance(v, Decimal):
+                    result[k] = float(v)
+                elif isinstance(v, dt.date):
+                    result[k] = str(v)
+        return {"status": "ok", "data": results, "count": len(results)}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+# ----- Calendário (tabela calendar) -----
+# Limites de período e dias úteis vêm da tabela (feriados nacionais/bancários), não do LLM.
+
+PERIODS = (
+    "today", "yesterday", "tomorrow",
+    "this_week", "last_week", "next_week",
+    "this_month", "last_month", "next_month",
+    "this_quarter", "last_quarter", "this_year", "last_year",
+    "last_7_days", "last_30_days", "next_7_days", "next_30_days",
+)
+
+
+def _period_range(period: str, today: dt.date):
+    """(início, fim) do período relativo a `today`; semanas começam na segunda-feira."""
+    day = dt.timedelta(days=1)
+    week_start = today - today.weekday() * day
+    month_start = today.replace(day=1)
+    quarter_start = month_start.replace(month=(today.month - 1) // 3 * 3 + 1)
+    ranges = {
+        "today": (today, today),
+        "yesterday": (today - day, today - day),
+        "tomorrow": (today + day, today + day),
+        "this_week": (week_start, week_start + 6 * day),
+        "last_week": (week_start - 7 * day, week_start - day),
+        "next_week": (week_start + 7 * day, week_start + 13 * day),
+        "this_month": (month_start, _add_months(month_start, 1) - day),
+        "last_month": (_add_months(month_start, -1), month_start - day),
+        "next_month": (_add_months(month_start, 1), _add_months(month_start, 2) - day),
+        "this_quarter": (quarter_start, _add_months(quarter_start, 3) - day),
+        "last_quarter": (_add_months(quarter_start, -3), quarter_start - day),
+        "this_year": (today.replace(month=1, day=1), today.replace(month=12, day=31)),
+        "last_year": (today.replace(year=today.year - 1, month=1, day=1), today.replace(year=today.year - 1, month=12, day=31)),
+        "last_7_days": (today - 6 * day, today),
+        "last_30_days": (today - 29 * day, today),
+        "next_7_days": (today, today + 6 * day),
+        "next_30_days": (today, today + 29 * day),
+    }
+    return ranges.get(period)
+
+
+@tool("resolve_period", args_schema=ResolvePeriodArgs)
+@_cached_read("resolve_period")
+def resolve_period(period: str, reference_date_local: Optional[str] = None) -> dict:
+    """
+    Converte um período relativo ("mês passado", "esta semana", "próximos 30 dias"...) em datas
+    locais exatas (date_from_local/date_to_local), com dias úteis e feriados nacionais no intervalo.
+    Use antes de filtrar por período em outras tools, em vez de calcular as datas de cabeça.
+    """
+    period = (period or "").strip().lower()
+    if period not in PERIODS:
+        return {"status": "error", "message": f"Período inválido: {period!r}. Use: {list(PERIODS)}."}
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
         cur.execute(
-            f"UPDATE transactions SET {', '.join(sets)} WHERE id = %s;",
-            params
+            "SELECT COALESCE(%s::date, (NOW() AT TIME ZONE 'America/Sao_Paulo')::date);",
+            (reference_date_local,),
         )
-        rows_affected = cur.rowcount
-        conn.commit()
-
-        # Retornar o registro atualizado
+        today = cur.fetchone()[0]
+        start, end = _period_range(period, today)
         cur.execute(
             """
             SELECT
-              t.id, t.occurred_at, t.amount, tt.type AS type_name,
-              c.name AS category_name, t.description, t.payment_method, t.source_text
-            FROM transactions t
-            JOIN transaction_types tt ON tt.id = t.type
-            LEFT JOIN categories c ON c.id = t.category_id
-            WHERE t.id = %s;
+                COUNT(*) FILTER (WHERE is_business_day),
+                COUNT(*) FILTER (WHERE is_business_day AND day >= %s),
+                json_agg(json_build_object('date', day, 'name', holiday_name) ORDER BY day)
+                    FILTER (WHERE holiday_name IS NOT NULL)
+            FROM calendar
+            WHERE day BETWEEN %s AND %s;
             """,
-            (target_id,)
+            (today, start, end),
         )
-        r = cur.fetchone()
-        updated = None
-        if r:
-            updated = {
-                "id": r[0],
-                "occurred_at": str(r[1]),
-                "amount": float(r[2]),
-                "type": r[3],
-                "category": r[4],
-                "description": r[5],
-                "payment_method": r[6],
-                "source_text": r[7],
-            }
-
+        business_days, business_days_remaining, holidays = cur.fetchone()
         return {
             "status": "ok",
-            "rows_affected": rows_affected,
-            "id": target_id,
-            "updated": updated
+            "period": period,
+            "reference_date_local": today.isoformat(),
+            "date_from_local": start.isoformat(),
+            "date_to_local": end.isoformat(),
+            "days": (end - start).days + 1,
+            "business_days": business_days,
+            "business_days_remaining": business_days_remaining,
+            "holidays": holidays or [],
         }
 
     except Exception as e:
-        conn.rollback()
-        return {"status": "error", "message": str(e)}
+        return _error_result(e)
     finally:
         try:
             cur.close()
-            conn.close()
+            release_conn(conn)
         except Exception:
             pass
 
-# Exporta a lista de tools
-TOOLS = [add_transaction, query_transactions, total_balance, daily_balance, update_transaction]
+
+@tool("add_business_days", args_schema=AddBusinessDaysArgs)
+@_cached_read("add_business_days")
+def add_business_days(days: int, date_local: Optional[str] = None) -> dict:
+    """
+    Data que fica N dias úteis depois (ou antes, se N < 0) de date_local (padrão: hoje),
+    pulando fins de semana e feriados nacionais. Com N = 0, devolve o próprio dia se for útil
+    ou o próximo dia útil (ex.: vencimento que cai no fim de semana).
+    """
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        days = int(days)
+        if days >= 0:
+            query = """
+                SELECT day, holiday_name FROM calendar
+                WHERE is_business_day AND day >= COALESCE(%s::date, (NOW() AT TIME ZONE 'America/Sao_Paulo')::date) + %s
+                ORDER BY day OFFSET %s LIMIT 1;
+            """
+            params = (date_local, 1 if days > 0 else 0, max(days - 1, 0))
+        else:
+            query = """
+                SELECT day, holiday_name FROM calendar
+                WHERE is_business_day AND day < COALESCE(%s::date, (NOW() AT TIME ZONE 'America/Sao_Paulo')::date)
+                ORDER BY day DESC OFFSET %s LIMIT 1;
+            """
+            params = (date_local, -days - 1)
+        cur.execute(query, params)
+        row = cur.fetchone()
+        if row is None:
+            return {"status": "error", "message": "Data fora da tabela calendar."}
+        return {"status": "ok", "date_local": row[0].isoformat(), "weekday": WEEKDAY_NAMES[row[0].weekday()]}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+@tool("update_transaction", args_schema=UpdateTransactionArgs)
+@_spooled_write("update_transaction")
+def update_transaction(
+    id: Optional[int] = None,
+    match_text: Optional[str] = None,
+    date_local: Optional[str] = None,
+    amount: Optional[float] = None,
+    type_id: Optional[int] = None,
+    type_name: Optional[str] = None,
+    category_id: Optional[int] = None,
+    category_name: Optional[str] = None,
+    description: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    card_id: Optional[int] = None,
+    from_account_id: Optional[int] = None,
+    to_account_id: Optional[int] = None,
+    occurred_at: Optional[str] = None,
+) -> dict:
+    """
+    Atualiza uma transação existente.
+    Estratégias:
+      - Se 'id' for informado: atualiza diretamente por ID.
+      - Caso contrário: localiza a transação mais recente que combine (match_text em source_text/description)
+        E (date_local em America/Sao_Paulo), então atualiza.
+    Retorna: status, rows_affected, id, e o registro atualizado.
+    Transações já arquivadas (mais antigas que o arquivo frio) não são alteradas, embora apareçam nas leituras.
+    """
+    if not any([amount, type_id, type_name, category_id, category_name, description, payment_method, occurred_at]) and all(
+        v is None for v in (card_id, from_account_id, to_account_id)
+    ):
+        return {"status": "error", "message": "Nada para atualizar: forneça pelo menos um campo (amount, type, category, description, payment_method, card_id, from/to_account_id, occurred_at)."}
+
+    if id is None and (not match_text or not date_local):
+        return {"status": "error", "message": "Sem 'id': informe match_text E date_local para localizar o registro."}
+    if from_account_id and from_account_id == to_account_id:
+        return {"status": "error", "message": "from_account_id e to_account_id devem ser contas diferentes."}
+
+    # Montar SET dinâmico; tipo/categoria por nome, cartão e contas são resolvidos no próprio
+    # statement (CTE ref) e, se algum não for encontrado, nada é alterado
+    sets = []
+    params: List[object] = []
+    refs = []  # (coluna em ref, subconsulta, params, mensagem se não resolver)
+    if amount is not None:
+        sets.append("amount = %s")
+        params.append(amount)
+    if type_name:
+        refs.append(("type", "(SELECT id FROM transaction_types WHERE UPPER(type) = %s LIMIT 1)",
+                     [_normalize_type_name(type_name)], "Tipo inválido (use type_id ou type_name: INCOME/EXPENSES/TRANSFER)."))
+    elif type_id:
+        refs.append(("type", "%s::int", [int(type_id)], None))
+    if category_id is not None:
+        sets.append("category_id = %s")
+        params.append(category_id)
+    elif category_name:
+        refs.append(("category_id", "(SELECT id FROM categories WHERE LOWER(name) = LOWER(%s) LIMIT 1)",
+                     [category_name.strip()], f"Categoria '{category_name}' não encontrada."))
+    if description is not None:
+        sets.append("description = %s")
+        params.append(description)
+    if payment_method is not None:
+        sets.append("payment_method = %s")
+        params.append(payment_method)
+    # só cartões/contas do próprio usuário; 0 remove o vínculo
+    if card_id == 0:
+        sets.append("card_id = NULL")
+    elif card_id is not None:
+        refs.append(("card_id", "(SELECT id FROM cards WHERE id = %s AND user_id = %s)",
+                     [card_id, _user_id.get() or ""], f"Cartão {card_id} não encontrado (veja os cartões com card_statement)."))
+    for column, account_id in (("from_account_id", from_account_id), ("to_account_id", to_account_id)):
+        if account_id == 0:
+            sets.append(f"{column} = NULL")
+        elif account_id is not None:
+            refs.append((column, "(SELECT id FROM accounts WHERE id = %s AND user_id = %s)",
+                         [account_id, _user_id.get() or ""], f"Conta {account_id} não encontrada (veja as contas com account_balances)."))
+    sets.extend(f"{column} = ref.{column}" for column, _, _, _ in refs)
+    # se tipo ou contas mudam, a combinação final (com o que não muda) precisa respeitar a direção
+    new_values = {"type": "t.type", "from_account_id": "t.from_account_id", "to_account_id": "t.to_account_id"}
+    new_values.update({column: f"ref.{column}" for column, _, _, _ in refs if column in new_values})
+    new_values.update({column: "NULL" for column, value in (("from_account_id", from_account_id), ("to_account_id", to_account_id)) if value == 0})
+    changes_direction = any(value != f"t.{column}" for column, value in new_values.items())
+    direction_sql = _account_direction_sql(new_values["type"], new_values["from_account_id"], new_values["to_account_id"])
+    if occurred_at is not None:
+        sets.append("occurred_at = %s::timestamptz")
+        params.append(occurred_at)
+
+    if not sets:
+        return {"status": "error", "message": "Nenhum campo válido para atualizar."}
+
+    # só altera transações do usuário corrente (quando houver)
+    owner_conditions, owner_params = _user_filter("t")
+    owner_sql = "".join(f" AND {c}" for c in owner_conditions)
+
+    # Localizar por id ou pelo mais recente no dia local informado que combine o texto
+    # (entre as do usuário: o LIMIT 1 não pode escolher a linha de outro)
+    if id is not None:
+        target_sql = "SELECT %s::bigint AS id"
+        target_params = [id]
+    else:
+        target_sql = f"""
+            SELECT t.id
+            FROM transactions t
+            WHERE (t.source_text ILIKE %s OR t.description ILIKE %s)
+              AND {LOCAL_DATE_SQL} = %s{owner_sql}
+            ORDER BY t.occurred_at DESC
+            LIMIT 1
+        """
+        target_params = [f"%{match_text}%", f"%{match_text}%", date_local] + owner_params
+
+    ref_sql = ", ".join(f"{sql} AS {column}" for column, sql, _, _ in refs) or "TRUE AS ok"
+    ref_params = [p for _, _, ps, _ in refs for p in ps]
+    ref_ok_sql = "".join(f" AND ref.{column} IS NOT NULL" for column, _, _, _ in refs)
+    ref_columns = "".join(f", ref.{column}" for column, _, _, _ in refs)
+    if changes_direction:
+        ref_ok_sql += f" AND {direction_sql}"
+        # só para distinguir "direção inválida" de "não encontrada" quando nada é atualizado
+        direction_check = f"""(SELECT bool_and({direction_sql}) FROM transactions t, target, ref
+                               WHERE t.id = target.id{owner_sql})"""
+        direction_params = owner_params
+    else:
+        direction_check, direction_params = "TRUE", []
+
+    conn = get_conn()
+    # localizar + atualizar + reler em um único statement (uma ida ao banco, commit incluso)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            WITH ref AS (SELECT {ref_sql}),
+            target AS ({target_sql}),
+            upd AS (
+                UPDATE transactions t
+                SET {', '.join(sets)}
+                FROM target, ref
+                WHERE t.id = target.id{ref_ok_sql}{owner_sql}
+                RETURNING t.id, t.occurred_at, t.amount, t.type, t.category_id,
+                          t.description, t.payment_method, t.source_text, t.card_id,
+                          t.from_account_id, t.to_account_id
+            )
+            SELECT
+              upd.id, upd.occurred_at, upd.amount, tt.type AS type_name,
+              c.name AS category_name, upd.description, upd.payment_method, upd.source_text, upd.card_id,
+              upd.from_account_id, upd.to_account_id, {direction_check}{ref_columns}
+            FROM ref
+            LEFT JOIN upd ON TRUE
+            LEFT JOIN transaction_types tt ON tt.id = upd.type
+            LEFT JOIN categories c ON c.id = upd.category_id;
+            """,
+            ref_params + target_params + params + owner_params + direction_params
+        )
+        r = cur.fetchone()
+        for (column, _, _, message), value in zip(refs, r[12:]):
+            if value is None:
+                return {"status": "error", "message": message}
+        if r[0] is None and r[11] is False:
+            return {"status": "error", "message": ACCOUNT_DIRECTION_ERROR}
+        if r[0] is None:
+            if id is None:
+                return {"status": "error", "message": "Nenhuma transação encontrada para os filtros fornecidos."}
+            return {"status": "ok", "rows_affected": 0, "id": id, "updated": None}
+
+        _mark_write(conn)
+        # valor/categoria/data podem ter mudado; o dia/semana anteriores ficam para o detect_anomalies
+        # e os sketches para o rebuild_sketches
+        _on_expense_written(r[0], inserted=False)
+        updated = {
+            "id": r[0],
+            "occurred_at": str(r[1]),
+            "amount": float(r[2]),
+            "type": r[3],
+            "category": r[4],
+            "description": r[5],
+            "payment_method": r[6],
+            "source_text": r[7],
+            "card_id": r[8],
+            "from_account_id": r[9],
+            "to_account_id": r[10],
+        }
+
+        return {
+            "status": "ok",
+            "rows_affected": 1,
+            "id": r[0],
+            "updated": updated
+        }
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+def _bulk_apply(action_sql: str, action_params: list, filters: dict, dry_run: bool, max_rows: int) -> dict:
+    """
+    Executa UPDATE/DELETE em lote em um único statement.
+    action_sql recebe as linhas-alvo na CTE 'target' e deve retornar t.id.
+    Se os filtros casarem mais de max_rows linhas, nada é alterado.
+    """
+    # texto em branco não é filtro
+    filters = {k: None if isinstance(v, str) and not v.strip() else v for k, v in filters.items()}
+    where_conditions, params = _transaction_filters(**filters)
+    # só a condição do dono (ou nenhuma) alcançaria todas as transações do usuário
+    if len(where_conditions) <= len(_user_filter("t")[0]):
+        return {"status": "error", "message": "Informe ao menos um filtro; operações em lote sem filtro não são permitidas."}
+    max_rows = max(1, min(int(max_rows), BULK_MAX_ROWS_LIMIT))
+
+    # operações em lote por filtro não vão para o spool: só valem contra os dados atuais
+    try:
+        conn = get_conn()
+    except Exception as e:
+        return _error_result(e)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            WITH target AS (
+                SELECT t.id
+                FROM transactions t
+                WHERE {" AND ".join(where_conditions)}
+                ORDER BY t.id
+                LIMIT %s
+            ),
+            allowed AS (
+                SELECT target.id FROM target
+                WHERE NOT %s AND (SELECT COUNT(*) FROM target) <= %s
+            ),
+            affected AS ({action_sql})
+            SELECT
+                (SELECT COUNT(*) FROM target),
+                (SELECT ARRAY_AGG(id ORDER BY id) FROM target),
+                (SELECT ARRAY_AGG(id ORDER BY id) FROM affected);
+            """,
+            params + [max_rows + 1, bool(dry_run), max_rows] + action_params,
+        )
+        matched, matched_ids, affected_ids = cur.fetchone()
+        matched_ids = matched_ids or []
+        affected_ids = affected_ids or []
+
+        if matched > max_rows:
+            return {
+                "status": "error",
+                "message": f"Os filtros casam mais de {max_rows} transações; refine os filtros ou aumente max_rows.",
+                "matched": f">{max_rows}",
+            }
+        if dry_run:
+            return {"status": "ok", "dry_run": True, "matched": matched, "ids": matched_ids}
+
+        if affected_ids:
+            _mark_write(conn)
+        return {"status": "ok", "matched": matched, "rows_affected": len(affected_ids), "ids": affected_ids}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("bulk_update_transactions", args_schema=BulkUpdateTransactionsArgs)
+def bulk_update_transactions(
+    text: Optional[str] = None,
+    type_name: Optional[str] = None,
+    date_local: Optional[str] = None,
+    date_from_local: Optional[str] = None,
+    date_to_local: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    category_id: Optional[int] = None,
+    category_name: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    set_type_name: Optional[str] = None,
+    set_category_id: Optional[int] = None,
+    set_category_name: Optional[str] = None,
+    set_description: Optional[str] = None,
+    set_payment_method: Optional[str] = None,
+    dry_run: bool = False,
+    max_rows: int = BULK_MAX_ROWS,
+) -> dict:
+    """
+    Atualiza em um único comando todas as transações que casam os filtros (mesmos do query_transactions).
+    Ex.: recategorizar todo 'Uber' como transporte. Use dry_run=True para ver quantas/quais seriam alteradas.
+    Retorna: status, rows_affected e ids alterados.
+    Transações já arquivadas (mais antigas que o arquivo frio) não são alteradas, embora apareçam nas leituras.
+    """
+    sets = []
+    set_params: List[object] = []
+    if set_type_name:
+        sets.append("type = (SELECT id FROM transaction_types WHERE UPPER(type) = %s LIMIT 1)")
+        set_params.append(_normalize_type_name(set_type_name))
+    if set_category_id is not None:
+        sets.append("category_id = %s")
+        set_params.append(set_category_id)
+    elif set_category_name:
+        sets.append("category_id = (SELECT id FROM categories WHERE LOWER(name) = LOWER(%s) LIMIT 1)")
+        set_params.append(set_category_name.strip())
+    if set_description is not None:
+        sets.append("description = %s")
+        set_params.append(set_description)
+    if set_payment_method is not None:
+        sets.append("payment_method = %s")
+        set_params.append(set_payment_method)
+    if not sets:
+        return {"status": "error", "message": "Nada para atualizar: informe ao menos um campo set_*."}
+
+    # tipo/categoria inexistentes não podem virar NULL em massa
+    guards = []
+    if set_type_name:
+        guards.append("EXISTS (SELECT 1 FROM transaction_types WHERE UPPER(type) = %s)")
+        set_params.append(_normalize_type_name(set_type_name))
+        # nem troca o tipo de transações cujas contas não combinam com ele (despesa com to_account_id etc.)
+        direction_sql = _account_direction_sql(
+            "(SELECT id FROM transaction_types WHERE UPPER(type) = %s LIMIT 1)", "x.from_account_id", "x.to_account_id"
+        )
+        guards.append(f"NOT EXISTS (SELECT 1 FROM allowed a JOIN transactions x ON x.id = a.id WHERE NOT {direction_sql})")
+        set_params.append(_normalize_type_name(set_type_name))
+    if set_category_id is None and set_category_name:
+        guards.append("EXISTS (SELECT 1 FROM categories WHERE LOWER(name) = LOWER(%s))")
+        set_params.append(set_category_name.strip())
+
+    action_sql = f"""
+        UPDATE transactions t
+        SET {", ".join(sets)}
+        FROM allowed
+        WHERE t.id = allowed.id {"".join(" AND " + g for g in guards)}
+        RETURNING t.id
+    """
+    result = _bulk_apply(
+        action_sql,
+        set_params,
+        dict(
+            text=text, type_name=type_name, date_local=date_local,
+            date_from_local=date_from_local, date_to_local=date_to_local,
+            min_amount=min_amount, max_amount=max_amount, category_id=category_id,
+            category_name=category_name, payment_method=payment_method,
+        ),
+        dry_run,
+        max_rows,
+    )
+    matched = result.get("matched")
+    if (
+        guards and not dry_run and result.get("status") == "ok"
+        and isinstance(matched, int) and matched > 0 and not result.get("rows_affected")
+    ):
+        return {
+            "status": "error",
+            "message": "Tipo ou categoria informados em set_* não existem, ou o novo tipo não combina com as contas "
+                       "das transações (despesa só com from_account_id, receita só com to_account_id); nada foi alterado.",
+        }
+    return result
+
+
+@tool("delete_transactions", args_schema=DeleteTransactionsArgs)
+def delete_transactions(
+    text: Optional[str] = None,
+    type_name: Optional[str] = None,
+    date_local: Optional[str] = None,
+    date_from_local: Optional[str] = None,
+    date_to_local: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    category_id: Optional[int] = None,
+    category_name: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    dry_run: bool = False,
+    max_rows: int = BULK_MAX_ROWS,
+) -> dict:
+    """
+    Exclui em um único comando as transações que casam os filtros (mesmos do query_transactions).
+    Use dry_run=True para ver quantas/quais seriam excluídas antes de confirmar com o usuário.
+    Retorna: status, rows_affected e ids excluídos.
+    Transações já arquivadas (mais antigas que o arquivo frio) não são excluídas, embora apareçam nas leituras.
+    """
+    action_sql = """
+        DELETE FROM transactions t
+        USING allowed
+        WHERE t.id = allowed.id
+        RETURNING t.id
+    """
+    return _bulk_apply(
+        action_sql,
+        [],
+        dict(
+            text=text, type_name=type_name, date_local=date_local,
+            date_from_local=date_from_local, date_to_local=date_to_local,
+            min_amount=min_amount, max_amount=max_amount, category_id=category_id,
+            category_name=category_name, payment_method=payment_method,
+        ),
+        dry_run,
+        max_rows,
+    )
+
+
+# ----- Pool de processos para análises pesadas -----
+# Ajuste do modelo de fluxo, Monte Carlo e varredura de anomalias seguram o GIL por centenas de ms;
+# rodando em processos (spawn) à parte, as tools dos outros usuários não esperam por eles.
+# Os arrays NumPy passam por memória compartilhada: só o descritor (nome, forma, dtype) é serializado.
+# As funções enviadas ao pool precisam ser de nível de módulo (o worker as importa pelo nome) e o
+# script de entrada precisa de `if __name__ == "__main__":` (o spawn reimporta o módulo principal).
+
+
+def _share_array(array):
+    """Copia o array para um bloco de memória compartilhada; devolve o bloco e o descritor para o worker."""
+    from multiprocessing import shared_memory
+    import numpy as np
+
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _task_expired(signum, frame):
+    raise AnalyticsTimeout("Tempo da análise esgotado.")
+
+
+def _run_offloaded(func, args: tuple, kwargs: dict, specs: dict, deadline: float):
+    """
+    Roda no worker: anexa os arrays compartilhados (somente leitura) e interrompe a tarefa em
+    `deadline` (time.time()) — inclusive o tempo que ela esperou na fila.
+    """
+    import signal
+    from multiprocessing import shared_memory
+    import numpy as np
+
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise AnalyticsTimeout("Tempo da análise esgotado na fila.")
+    timer = hasattr(signal, "setitimer")  # no Windows vale só o prazo de espera do chamador
+    if timer:
+        signal.signal(signal.SIGALRM, _task_expired)
+        signal.setitimer(signal.ITIMER_REAL, remaining)
+    handles, arrays = [], {}
+    try:
+        for name, (shm_name, shape, dtype) in specs.items():
+            # o processo pai é o dono do bloco (e do registro no resource_tracker, compartilhado no spawn)
+            shm = shared_memory.SharedMemory(name=shm_name)
+            handles.append(shm)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arrays[name].flags.writeable = False
+        return func(*args, **kwargs, **arrays)
+    finally:
+        if timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        arrays = None
+        for shm in handles:
+            try:
+                shm.close()
+            except BufferError:  # traceback ainda referencia uma view; o GC fecha depois
+                pass
+
+
+class _AnalyticsPool:
+    """
+    Executa funções CPU-bound num ProcessPoolExecutor (criado na primeira tarefa).
+    A fila é limitada: com ANALYTICS_QUEUE tarefas em andamento, run() recusa com AnalyticsBusy
+    em vez de empilhar espera para todo mundo. O espaço só volta quando a tarefa termina de fato
+    (ou é cancelada ainda na fila), então uma tarefa abandonada por timeout continua contando.
+    """
+
+    def __init__(self, processes: int, max_pending: int, timeout: float):
+        self.processes = processes
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # spawn: o worker não herda conexões, pools nem threads do processo das tools
+                self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _broken(self, executor, e: Exception) -> AnalyticsBusy:
+        """Um worker morreu (ex.: falta de memória): descarta o pool; a próxima tarefa cria outro."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.warning("pool de análises recriado: %s", e)
+        return AnalyticsBusy("O processo de análise foi interrompido; tente de novo em instantes.")
+
+    def warm(self) -> None:
+        """Sobe os workers já (spawn reimporta numpy etc.), sem esperar: a primeira análise de um turno não paga isso."""
+        if self.processes <= 0:
+            return
+        executor = self._pool()
+        for _ in range(self.processes):
+            executor.submit(os.getpid)
+
+    def run(self, func, *args, arrays: Optional[dict] = None, task_timeout: Optional[float] = None, **kwargs):
+        """
+        func(*args, **kwargs, **arrays) num worker; `arrays` (nome -> ndarray) vão por memória compartilhada.
+        task_timeout substitui o prazo padrão do pool (ex.: jobs); o prazo do turno continua valendo.
+        """
+        arrays = arrays or {}
+        if self.processes <= 0:
+            return func(*args, **kwargs, **arrays)
+        remaining = _remaining_ms()
+        timeout = task_timeout or self.timeout
+        timeout = timeout if remaining is None else min(timeout, remaining / 1000)
+        if not self._slots.acquire(blocking=False):
+            raise AnalyticsBusy("Muitas análises em andamento; tente de novo em instantes.")
+        shared = []
+
+        def release(_future=None):
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+            self._slots.release()
+
+        executor = None
+        try:
+            specs = {}
+            for name, array in arrays.items():
+                shm, specs[name] = _share_array(array)
+                shared.append(shm)
+            executor = self._pool()
+            future = executor.submit(_run_offloaded, func, args, kwargs, specs, time.time() + timeout)
+        except BrokenProcessPool as e:
+            release()
+            raise self._broken(executor, e) from e
+        except BaseException:
+            release()
+            raise
+        future.add_done_callback(release)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()  # ainda na fila: sai dela; já rodando: o worker interrompe no prazo
+            raise AnalyticsTimeout("Tempo da análise esgotado.") from None
+        except BrokenProcessPool as e:
+            raise self._broken(executor, e) from e
+
+
+_analytics_pool = _AnalyticsPool(ANALYTICS_PROCESSES, ANALYTICS_QUEUE, ANALYTICS_TASK_TIMEOUT)
+
+
+# ----- Fluxo de caixa: histórico, recorrências e previsão -----
+# O modelo (séries diárias em NumPy + lançamentos recorrentes) é ajustado uma vez por usuário e
+# reaproveitado até a próxima escrita (geração do cache de leituras); numpy é importado só aqui.
+
+_flow_models = {}  # user_id -> (geração, modelo)
+_flow_models_lock = threading.Lock()
+
+
+def _add_months(day: dt.date, months: int) -> dt.date:
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    last_day = calendar.monthrange(year, month)[1]
+    return day.replace(year=year, month=month, day=min(day.day, last_day))
+
+
+def _load_flow_history(cur):
+    """Hoje (local), saldo atual e lançamentos INCOME/EXPENSES da janela FORECAST_HISTORY_DAYS."""
+    owner_conditions, owner_params = _user_filter("x")
+    owner_sql = f"WHERE {owner_conditions[0]}" if owner_conditions else ""
+    archive_sql = _archive_daily_union(cur, "x.type, x.total", owner_sql)
+    cur.execute(
+        f"""
+        SELECT
+            (NOW() AT TIME ZONE 'America/Sao_Paulo')::date,
+            COALESCE(SUM(CASE x.type WHEN 1 THEN x.amount WHEN 2 THEN -x.amount ELSE 0 END), 0)
+        FROM (
+            SELECT x.type, x.amount FROM transactions x {owner_sql}
+            {archive_sql}
+        ) x;
+        """,
+        owner_params * (2 if archive_sql else 1),
+    )
+    today, balance = cur.fetchone()
+    where_conditions, params = _user_filter("t")
+    where_conditions += ["t.type IN (1, 2)", f"{LOCAL_DATE_SQL} > %s"]
+    params.append(today - dt.timedelta(days=FORECAST_HISTORY_DAYS))
+    cur.execute(
+        f"""
+        SELECT {LOCAL_DATE_SQL}, t.type, t.amount,
+               LOWER(COALESCE(NULLIF(t.description, ''), t.source_text))
+        FROM transactions t
+        WHERE {" AND ".join(where_conditions)};
+        """,
+        params,
+    )
+    return today, float(balance), cur.fetchall()
+
+
+def _detect_recurring(rows: list, today: dt.date) -> list:
+    """
+    Lançamentos mensais: mesmo tipo, mesmo texto e valor parecido (arredondado) em pelo menos
+    RECURRING_MIN_MONTHS meses distintos, cerca de uma vez por mês e visto nos últimos 45 dias.
+    Textos frequentes (ex.: "uber" várias vezes por mês) não viram recorrência por coincidência de valor.
+    """
+    groups = {}
+    label_days = {}
+    for i, (day, type_id, amount, label) in enumerate(rows):
+        groups.setdefault((type_id, label, round(float(amount))), []).append(i)
+        label_days.setdefault((type_id, label), []).append(day)
+    recurring = []
+    for (type_id, label, _), indexes in groups.items():
+        days = [rows[i][0] for i in indexes]
+        months = {(d.year, d.month) for d in days}
+        if len(months) < RECURRING_MIN_MONTHS or len(indexes) > 1.5 * len(months):
+            continue
+        all_days = label_days[(type_id, label)]
+        if len(all_days) > 1.5 * len({(d.year, d.month) for d in all_days}):
+            continue
+        if (today - max(days)).days > 45:
+            continue
+        amount = sorted(float(rows[i][2]) for i in indexes)[len(indexes) // 2]
+        recurring.append({
+            "label": label,
+            "amount": amount if type_id == 1 else -amount,
+            "day": sorted(d.day for d in days)[len(days) // 2],
+            "months": len(months),
+            "indexes": indexes,
+        })
+    return recurring
+
+
+def _fit_flow_model(today: dt.date, balance: float, labels: list, day_index, types, amounts) -> dict:
+    """
+    Roda no pool de análises: lançamentos como arrays (dia desde o início da janela, tipo, valor)
+    + os textos na mesma ordem.
+    """
+    import numpy as np
+
+    start = today - dt.timedelta(days=FORECAST_HISTORY_DAYS)
+    signed = np.where(types == 1, amounts, -amounts)
+    rows = [
+        (start + dt.timedelta(days=int(d)), int(t), float(a), label)
+        for d, t, a, label in zip(day_index, types, amounts, labels)
+    ]
+    recurring = _detect_recurring(rows, today)
+    is_recurring = np.zeros(len(rows), dtype=bool)
+    for item in recurring:
+        is_recurring[item.pop("indexes")] = True
+
+    # fluxo diário sem as recorrências (elas entram na projeção nas datas certas), do 1º lançamento até hoje
+    size = FORECAST_HISTORY_DAYS + 1
+    residual = np.bincount(day_index[~is_recurring], weights=signed[~is_recurring], minlength=size)
+    residual = residual[day_index.min():]
+    # sazonalidade semanal: média do fluxo residual por dia da semana
+    weekdays = (np.arange(size - len(residual), size) + start.weekday()) % 7
+    weekday_mean = np.bincount(weekdays, weights=residual, minlength=7) / np.maximum(np.bincount(weekdays, minlength=7), 1)
+    return {
+        "today": today,
+        "balance": balance,
+        "residual": residual,
+        "weekday_mean": weekday_mean,
+        "sigma": float(residual.std()),
+        "recurring": sorted(recurring, key=lambda r: -abs(r["amount"])),
+    }
+
+
+def _flow_model(cur) -> Optional[dict]:
+    """Modelo de fluxo do usuário corrente (None sem histórico), em cache até a próxima escrita."""
+    user = _user_id.get()
+    generation = _result_cache.generation
+    cached = _flow_models.get(user)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    today, balance, rows = _load_flow_history(cur)
+    model = None
+    if rows:
+        import numpy as np
+
+        start = today - dt.timedelta(days=FORECAST_HISTORY_DAYS)
+        arrays = {
+            "day_index": np.array([(r[0] - start).days for r in rows], dtype=np.int64),
+            "types": np.array([r[1] for r in rows], dtype=np.int8),
+            "amounts": np.array([float(r[2]) for r in rows]),
+        }
+        model = _analytics_pool.run(_fit_flow_model, today, balance, [r[3] for r in rows], arrays=arrays)
+    with _flow_models_lock:
+        _flow_models[user] = (generation, model)
+    return model
+
+
+def _future_calendar(today: dt.date, days: int):
+    """Arrays (offset, dia da semana, dia do mês, tamanho do mês) dos próximos `days` dias."""
+    import numpy as np
+
+    offsets = np.arange(1, days + 1)
+    dates = np.datetime64(today, "D") + offsets
+    month_start = dates.astype("datetime64[M]")
+    day_of_month = (dates - month_start.astype("datetime64[D]")).astype(np.int64) + 1
+    month_len = ((month_start + 1).astype("datetime64[D]") - month_start.astype("datetime64[D]")).astype(np.int64)
+    return offsets, (today.weekday() + offsets) % 7, day_of_month, month_len
+
+
+def _recurring_flow(model: dict, days: int):
+    """Recorrências do modelo distribuídas nas datas dos próximos `days` dias."""
+    import numpy as np
+
+    _, _, day_of_month, month_len = _future_calendar(model["today"], days)
+    flow = np.zeros(days)
+    for item in model["recurring"]:
+        # vencimento no dia 31 cai no último dia dos meses mais curtos
+        flow += np.where(day_of_month == np.minimum(item["day"], month_len), item["amount"], 0.0)
+    return flow
+
+
+def _expected_flow(model: dict, days: int):
+    """Fluxo diário esperado (sazonalidade semanal + recorrências nas datas) para os próximos dias."""
+    offsets, weekdays, _, _ = _future_calendar(model["today"], days)
+    return offsets, model["weekday_mean"][weekdays] + _recurring_flow(model, days)
+
+
+@tool("forecast_balance", args_schema=ForecastBalanceArgs)
+@_cached_read("forecast_balance")
+def forecast_balance(days: Optional[int] = None, months: Optional[int] = None) -> dict:
+    """
+    Projeta o saldo para os próximos dias/meses a partir do histórico: entradas e saídas
+    recorrentes (salário, aluguel, assinaturas) nas datas prováveis + padrão semanal do resto.
+    Retorna saldo projetado, faixa p10–p90, menor saldo no período e a série semanal.
+    Use para perguntas como "como vou estar no fim do mês?" ou "vai sobrar dinheiro?".
+    """
+    import numpy as np
+
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        model = _flow_model(cur)
+        if model is None:
+            return {"status": "error", "message": "Sem histórico de transações para projetar o saldo."}
+        today = model["today"]
+        if months:
+            horizon = (_add_months(today, months) - today).days
+        else:
+            horizon = days or 30
+        horizon = max(1, min(horizon, FORECAST_MAX_DAYS))
+
+        offsets, flow = _expected_flow(model, horizon)
+        balance = model["balance"] + np.cumsum(flow)
+        # incerteza do fluxo residual acumulada como passeio aleatório (faixa ~p10–p90)
+        band = 1.2816 * model["sigma"] * np.sqrt(offsets)
+        lowest = int(np.argmin(balance))
+        negative = np.flatnonzero(balance < 0)
+        checkpoints = sorted(set(range(6, horizon, 7)) | {horizon - 1})
+
+        return {
+            "status": "ok",
+            "as_of": today.isoformat(),
+            "horizon_days": horizon,
+            "current_balance": round(model["balance"], 2),
+            "projected_balance": round(float(balance[-1]), 2),
+            "range_p10": round(float(balance[-1] - band[-1]), 2),
+            "range_p90": round(float(balance[-1] + band[-1]), 2),
+            "lowest_balance": round(float(balance[lowest]), 2),
+            "lowest_balance_date": (today + dt.timedelta(days=lowest + 1)).isoformat(),
+            "first_negative_date": (today + dt.timedelta(days=int(negative[0]) + 1)).isoformat() if len(negative) else None,
+            "recurring": [
+                {"label": _compact_value(r["label"]), "amount": round(r["amount"], 2), "day": r["day"]}
+                for r in model["recurring"][:10]
+            ],
+            "series": {
+                "columns": ["date", "balance", "p10", "p90"],
+                "rows": [
+                    [
+                        (today + dt.timedelta(days=i + 1)).isoformat(),
+                        round(float(balance[i]), 2),
+                        round(float(balance[i] - band[i]), 2),
+                        round(float(balance[i] + band[i]), 2),
+                    ]
+                    for i in checkpoints
+                ],
+            },
+        }
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+def _simulate_paths(balance: float, min_balance: float, residual, recurring, purchase) -> dict:
+    """
+    Roda no pool de análises: SIMULATION_PATHS cenários sorteando semanas do fluxo residual
+    + recorrências (recurring), com e sem a compra (purchase), ambos diários no horizonte.
+    """
+    import numpy as np
+
+    horizon = len(recurring)
+    # semanas inteiras do histórico (sem o dia de hoje, incompleto), começando no mesmo dia da
+    # semana de amanhã: o último índice é hoje, então índices ≡ len (mod 7) caem nesse dia
+    starts = np.flatnonzero((np.arange(len(residual) - 7) - len(residual)) % 7 == 0)
+    rng = np.random.default_rng(SIMULATION_SEED)
+    weeks = -(-horizon // 7)
+    blocks = rng.choice(starts, size=(SIMULATION_PATHS, weeks))
+    flows = residual[blocks[:, :, None] + np.arange(7)].reshape(SIMULATION_PATHS, -1)[:, :horizon]
+    flows += recurring
+    balances = balance + np.cumsum(flows, axis=1)
+    # mesmos cenários com a compra
+    with_purchase = balances - np.cumsum(purchase)
+
+    lowest_with = with_purchase.min(axis=1)
+    p10, p50, p90 = np.percentile(lowest_with, [10, 50, 90])
+    return {
+        "risk_without": float(np.mean(balances.min(axis=1) < min_balance)),
+        "risk_with": float(np.mean(lowest_with < min_balance)),
+        "lowest_with": {"p10": float(p10), "p50": float(p50), "p90": float(p90)},
+        "end_p50_without": float(np.median(balances[:, -1])),
+        "end_p50_with": float(np.median(with_purchase[:, -1])),
+    }
+
+
+@tool("simulate_purchase", args_schema=SimulatePurchaseArgs)
+@_cached_read("simulate_purchase")
+def simulate_purchase(amount: float, installments: int = 1, months: int = 3, min_balance: float = 0.0) -> dict:
+    """
+    Simula milhares de cenários do fluxo de caixa dos próximos meses (sorteando semanas do
+    histórico + recorrências) com e sem a compra, à vista ou parcelada, e devolve o risco de
+    o saldo ficar abaixo de min_balance. Use para "Posso comprar um celular de R$1.200?".
+    """
+    import numpy as np
+
+    if amount is None or amount <= 0:
+        return {"status": "error", "message": "Informe o valor da compra (amount > 0)."}
+    installments = max(1, min(int(installments or 1), 48))
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        model = _flow_model(cur)
+        if model is None or len(model["residual"]) < 28:
+            return {"status": "error", "message": "Histórico insuficiente para simular (mínimo de 4 semanas de transações)."}
+        today = model["today"]
+        first_day = today + dt.timedelta(days=1)
+        horizon = max(
+            (_add_months(today, max(1, min(int(months or 3), 24))) - today).days,
+            (_add_months(first_day, installments - 1) - today).days,
+        )
+
+        # parcelas mensais da compra a partir de amanhã
+        purchase = np.zeros(horizon)
+        for i in range(installments):
+            purchase[(_add_months(first_day, i) - first_day).days] += amount / installments
+        paths = _analytics_pool.run(
+            _simulate_paths, model["balance"], min_balance,
+            arrays={"residual": model["residual"], "recurring": _recurring_flow(model, horizon), "purchase": purchase},
+        )
+        return {
+            "status": "ok",
+            "as_of": today.isoformat(),
+            "horizon_days": horizon,
+            "simulations": SIMULATION_PATHS,
+            "current_balance": round(model["balance"], 2),
+            "purchase": {"amount": round(float(amount), 2), "installments": installments,
+                         "installment_amount": round(float(amount) / installments, 2)},
+            "risk_below_min_without": round(paths["risk_without"], 3),
+            "risk_below_min_with": round(paths["risk_with"], 3),
+            "lowest_balance_with": {k: round(v, 2) for k, v in paths["lowest_with"].items()},
+            "end_balance_p50_without": round(paths["end_p50_without"], 2),
+            "end_balance_p50_with": round(paths["end_p50_with"], 2),
+        }
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+# ----- Anomalias de gasto (z-score robusto por categoria) -----
+# Gasto diário e semanal de cada categoria comparado à janela anterior (mediana e MAD).
+# detect_anomalies() varre o histórico inteiro numa passada NumPy; cada lançamento novo
+# rescora, em background, só a categoria e os períodos que ele tocou.
+
+# trabalho derivado das escritas (anomalias, sketches), fora do caminho da tool
+_analytics_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pg-analytics")
+
+
+def _category_spend(cur, start: dt.date, end: dt.date, category_id: Optional[int] = None):
+    """Categorias (0 = sem categoria) e matriz [categoria x dia] do gasto (EXPENSES) de start até end."""
+    import numpy as np
+
+    where_conditions, params = _user_filter("t")
+    where_conditions += ["t.type = 2", f"{LOCAL_DATE_SQL} BETWEEN %s AND %s"]
+    params += [start, end]
+    if category_id is not None:
+        where_conditions.append("COALESCE(t.category_id, 0) = %s")
+        params.append(category_id)
+    cur.execute(
+        f"""
+        SELECT COALESCE(t.category_id, 0), {LOCAL_DATE_SQL}, SUM(t.amount)
+        FROM transactions t
+        WHERE {" AND ".join(where_conditions)}
+        GROUP BY 1, 2;
+        """,
+        params,
+    )
+    rows = cur.fetchall()
+    categories = sorted({r[0] for r in rows})
+    position = {c: i for i, c in enumerate(categories)}
+    daily = np.zeros((len(categories), (end - start).days + 1))
+    if rows:
+        np.add.at(
+            daily,
+            (np.array([position[r[0]] for r in rows]), np.array([(r[1] - start).days for r in rows])),
+            np.array([float(r[2]) for r in rows]),
+        )
+    return categories, daily
+
+
+def _robust_scores(series, window: int):
+    """
+    Compara cada período com os `window` anteriores (vetorizado em todas as categorias).
+    Devolve (mediana, score) a partir do período `window`; sem desvio (MAD = 0) usa o desvio médio absoluto.
+    """
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    history = sliding_window_view(series, window, axis=1)[:, :-1]
+    current = series[:, window:]
+    median = np.median(history, axis=2)
+    deviation = np.abs(history - median[..., None])
+    scale = np.where(
+        np.median(deviation, axis=2) > 0,
+        np.median(deviation, axis=2) / 0.6745,
+        np.mean(deviation, axis=2) * 1.2533,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = np.where(scale > 0, (current - median) / scale, np.where(current > median, np.inf, 0.0))
+    return median, score
+
+
+def _score_anomalies(categories: list, daily, start: dt.date, since: dt.date) -> list:
+    """Anomalias (dia e semana ISO) a partir de `since`; start deve cair numa segunda-feira."""
+    import numpy as np
+
+    found = []
+    if not categories:  # ex.: a transação foi apagada antes do rescore
+        return found
+    weekly = daily[:, : daily.shape[1] // 7 * 7].reshape(len(categories), -1, 7).sum(axis=2)
+    for period, series, window, step in (
+        ("day", daily, ANOMALY_DAILY_WINDOW, 1),
+        ("week", weekly, ANOMALY_WEEKLY_WINDOW, 7),
+    ):
+        if series.shape[1] <= window:
+            continue
+        median, score = _robust_scores(series, window)
+        current = series[:, window:]
+        flagged = (score >= ANOMALY_Z) & (current - median >= ANOMALY_MIN_DELTA)
+        for c, j in zip(*np.nonzero(flagged)):
+            period_start = start + dt.timedelta(days=int(j + window) * step)
+            if period_start >= since:
+                found.append((
+                    categories[c], period, period_start, round(float(current[c, j]), 2),
+                    round(float(median[c, j]), 2), float(min(score[c, j], 99.0)),
+                ))
+    return found
+
+
+def _store_anomalies(cur, found: list, where_sql: str, params: list) -> None:
+    """Apaga as anomalias do usuário que casam where_sql (os períodos rescorados) e grava as encontradas."""
+    user = _user_id.get() or ""
+    cur.execute(f"DELETE FROM spending_anomalies WHERE user_id = %s AND {where_sql};", [user] + params)
+    if found:
+        execute_values(
+            cur,
+            """
+            INSERT INTO spending_anomalies (user_id, category_id, period, period_start, amount, baseline, score)
+            VALUES %s
+            ON CONFLICT (user_id, category_id, period, period_start) DO UPDATE
+            SET amount = EXCLUDED.amount, baseline = EXCLUDED.baseline,
+                score = EXCLUDED.score, detected_at = NOW()
+            """,
+            [(user,) + f for f in found],
+        )
+
+
+def _monday(day: dt.date) -> dt.date:
+    return day - dt.timedelta(days=day.weekday())
+
+
+def detect_anomalies(history_days: Optional[int] = None) -> dict:
+    """
+    Job (não é tool): recalcula as anomalias do usuário corrente em todo o histórico
+    (ANOMALY_HISTORY_DAYS) numa única passada; rode periodicamente ou após importações em lote.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT (NOW() AT TIME ZONE 'America/Sao_Paulo')::date;")
+        today = cur.fetchone()[0]
+        start = _monday(today - dt.timedelta(days=history_days or ANOMALY_HISTORY_DAYS))
+        categories, daily = _category_spend(cur, start, today)
+        # varredura do histórico inteiro: no pool (a matriz diária vai por memória compartilhada)
+        found = _analytics_pool.run(
+            _score_anomalies, categories, start=start, since=start,
+            arrays={"daily": daily}, task_timeout=ANALYTICS_JOB_TIMEOUT,
+        )
+        _store_anomalies(cur, found, "period_start >= %s", [start])
+        conn.commit()
+        _result_cache.bump_generation()
+        return {"status": "ok", "since": start.isoformat(), "anomalies": len(found)}
+    except Exception as e:
+        conn.rollback()
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+def _refresh_anomalies(transaction_id: int) -> None:
+    """Rescora o dia e a semana da transação, só na categoria dela."""
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"SELECT COALESCE(t.category_id, 0), {LOCAL_DATE_SQL} FROM transactions t WHERE t.id = %s AND t.type = 2;",
+            (transaction_id,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return
+        category_id, day = row
+        week = _monday(day)
+        # janela anterior suficiente para o dia e para a semana da transação
+        start = _monday(min(day - dt.timedelta(days=ANOMALY_DAILY_WINDOW), week - dt.timedelta(weeks=ANOMALY_WEEKLY_WINDOW)))
+        end = week + dt.timedelta(days=6)
+        categories, daily = _category_spend(cur, start, end, category_id)
+        found = [
+            f for f in _score_anomalies(categories, daily, start, week)
+            if (f[1] == "day" and f[2] == day) or (f[1] == "week" and f[2] == week)
+        ]
+        _store_anomalies(
+            cur,
+            found,
+            "category_id = %s AND ((period = 'day' AND period_start = %s) OR (period = 'week' AND period_start = %s))",
+            [category_id, day, week],
+        )
+        conn.commit()
+        _result_cache.bump_generation()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _run_anomaly_refresh(transaction_id: int) -> None:
+    _deadline.set(None)  # roda fora do turno que a disparou
+    try:
+        _refresh_anomalies(transaction_id)
+    except Exception:
+        logger.exception("Falha ao rescorar anomalias da transação %s", transaction_id)
+
+
+def _on_expense_written(transaction_id: int, inserted: bool = True) -> None:
+    """Agenda o rescore de anomalias e, para inserts, a atualização dos sketches do mês."""
+    # cópia do contexto: mesmo usuário/shard da escrita
+    _analytics_executor.submit(contextvars.copy_context().run, _run_anomaly_refresh, transaction_id)
+    if inserted:
+        _analytics_executor.submit(contextvars.copy_context().run, _run_sketch_update, transaction_id)
+
+
+@tool("list_anomalies", args_schema=ListAnomaliesArgs)
+@_cached_read("list_anomalies")
+def list_anomalies(
+    date_from_local: Optional[str] = None,
+    date_to_local: Optional[str] = None,
+    category_name: Optional[str] = None,
+    period: Optional[str] = None,
+) -> dict:
+    """
+    Lista gastos fora do normal já detectados: dias/semanas em que uma categoria gastou muito
+    acima da sua mediana recente (z-score robusto). Sem datas, traz os últimos 30 dias.
+    Use para "algum gasto fora do normal este mês?".
+    """
+    where_conditions = ["a.user_id = %s"]
+    params: List[object] = [_user_id.get() or ""]
+    if date_from_local:
+        where_conditions.append("a.period_start >= %s::date")
+        params.append(date_from_local)
+    if date_to_local:
+        where_conditions.append("a.period_start <= %s::date")
+        params.append(date_to_local)
+    if not (date_from_local or date_to_local):
+        where_conditions.append("a.period_start >= (NOW() AT TIME ZONE 'America/Sao_Paulo')::date - 30")
+    if category_name:
+        where_conditions.append("COALESCE(c.name, 'sem categoria') ILIKE %s")
+        params.append(f"%{category_name.strip()}%")
+    if period in ("day", "week"):
+        where_conditions.append("a.period = %s")
+        params.append(period)
+
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            SELECT a.period, a.period_start, COALESCE(c.name, 'sem categoria') AS category,
+                   a.amount, a.baseline, ROUND(a.score::numeric, 1) AS score
+            FROM spending_anomalies a
+            LEFT JOIN categories c ON c.id = a.category_id
+            WHERE {" AND ".join(where_conditions)}
+            ORDER BY a.period_start DESC, a.score DESC
+            LIMIT 100;
+            """,
+            params,
+        )
+        columns = [desc[0] for desc in cur.description]
+        results = [dict(zip(columns, row)) for row in cur.fetchall()]
+
+        if COMPACT_RESULTS:
+            return _compact_result(results)
+
+        for result in results:
+            result["period_start"] = str(result["period_start"])
+            for k in ("amount", "baseline", "score"):
+                result[k] = float(result[k])
+        return {"status": "ok", "data": results, "count": len(results)}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+# ----- Sketches aproximados por mês (t-digest, HyperLogLog, top-K) -----
+# Um registro por usuário e mês em transaction_sketches, atualizado a cada despesa nova (em background).
+# Os três são mescláveis: um período qualquer é a fusão dos meses, custo O(meses) e não O(linhas).
+# Não suportam remoção: updates/deletes só entram no próximo rebuild_sketches().
+
+class _TDigest:
+    """t-digest com fusão (escala k1): percentis com erro relativo pequeno nas caudas."""
+
+    def __init__(self, compression: float = 100.0, centroids=None, minimum=None, maximum=None):
+        self.compression = compression
+        self.centroids = centroids or []  # [média, peso], ordenados pela média
+        self.min = minimum
+        self.max = maximum
+        self._buffer = []
+
+    def add(self, value: float, weight: float = 1.0) -> None:
+        self._buffer.append([value, weight])
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) > 5 * self.compression:
+            self._compress()
+
+    def merge(self, other: "_TDigest") -> None:
+        other._compress()
+        self._buffer.extend([list(c) for c in other.centroids])
+        for bound in (other.min, other.max):
+            if bound is not None:
+                self.min = bound if self.min is None else min(self.min, bound)
+                self.max = bound if self.max is None else max(self.max, bound)
+        self._compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _compress(self) -> None:
+        if not self._buffer:
+            return
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        total = sum(w for _, w in points)
+        merged = [list(points[0])]
+        weight_before = 0.0
+        for mean, weight in points[1:]:
+            current = merged[-1]
+            if self._k((weight_before + current[1] + weight) / total) - self._k(weight_before / total) <= 1:
+                current[1] += weight
+                current[0] += (mean - current[0]) * weight / current[1]
+            else:
+                weight_before += current[1]
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    def count(self) -> float:
+        self._compress()
+        return sum(w for _, w in self.centroids)
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not self.centroids:
+            return None
+        target = q * self.count()
+        # interpola entre os centros (peso acumulado até o meio de cada centróide); min/max nas pontas
+        previous_center, previous_mean = 0.0, self.min
+        cumulative = 0.0
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2
+            if target <= center:
+                span = center - previous_center
+                return previous_mean + (mean - previous_mean) * ((target - previous_center) / span if span else 0.0)
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        span = cumulative - previous_center
+        return previous_mean + (self.max - previous_mean) * ((target - previous_center) / span if span else 0.0)
+
+    def to_json(self) -> dict:
+        self._compress()
+        return {"d": self.compression, "c": self.centroids, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_json(cls, data: Optional[dict]) -> "_TDigest":
+        if not data:
+            return cls()
+        return cls(data["d"], [list(c) for c in data["c"]], data["min"], data["max"])
+
+
+class _HyperLogLog:
+    """HyperLogLog com 2^p registradores (p=12: ~1,6% de erro padrão); fusão = máximo por registrador."""
+
+    def __init__(self, p: int = 12, registers: Optional[bytearray] = None):
+        self.p = p
+        self.registers = registers if registers is not None else bytearray(1 << p)
+
+    def add(self, item: str) -> None:
+        h = int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "_HyperLogLog") -> None:
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            return round(m * math.log(m / zeros))  # correção para cardinalidades pequenas
+        return round(raw)
+
+    def to_json(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode("ascii")
+
+    @classmethod
+    def from_json(cls, data: Optional[str]) -> "_HyperLogLog":
+        if not data:
+            return cls()
+        registers = bytearray(base64.b64decode(data))
+        return cls(len(registers).bit_length() - 1, registers)
+
+
+class _SpaceSaving:
+    """Top-K aproximado (space-saving): contagem superestimada no máximo por `error`; guarda também o valor somado."""
+
+    def __init__(self, capacity: int = 50, counters: Optional[dict] = None):
+        self.capacity = capacity
+        self.counters = counters or {}  # chave -> [contagem, erro, valor]
+
+    def add(self, key: str, amount: float) -> None:
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += 1
+            counter[2] += amount
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [1, 0, amount]
+        else:
+            evicted = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(evicted)[0]
+            self.counters[key] = [floor + 1, floor, amount]
+
+    def _floor(self) -> int:
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(c[0] for c in self.counters.values())
+
+    def merge(self, other: "_SpaceSaving") -> None:
+        # chave ausente de um resumo cheio pode ter até o menor contador dele
+        floor_a, floor_b = self._floor(), other._floor()
+        merged = {}
+        for key in set(self.counters) | set(other.counters):
+            a = self.counters.get(key, [floor_a, floor_a, 0.0])
+            b = other.counters.get(key, [floor_b, floor_b, 0.0])
+            merged[key] = [a[0] + b[0], a[1] + b[1], a[2] + b[2]]
+        top = sorted(merged.items(), key=lambda kv: -kv[1][0])[: self.capacity]
+        self.counters = dict(top)
+
+    def top(self, k: int) -> list:
+        return sorted(self.counters.items(), key=lambda kv: -kv[1][0])[:k]
+
+    def to_json(self) -> dict:
+        return {"k": self.capacity, "c": self.counters}
+
+    @classmethod
+    def from_json(cls, data: Optional[dict]) -> "_SpaceSaving":
+        if not data:
+            return cls()
+        return cls(data["k"], {key: list(v) for key, v in data["c"].items()})
+
+
+def _sketch_label(description: Optional[str], source_text: str) -> str:
+    return re.sub(r"\s+", " ", (description or source_text or "")).strip().lower()
+
+
+def _save_sketch(cur, month: dt.date, n: int, total: float, digest, hll, topk) -> None:
+    cur.execute(
+        """
+        INSERT INTO transaction_sketches (user_id, month, n, total, tdigest, hll, topk, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+        ON CONFLICT (user_id, month) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, tdigest = EXCLUDED.tdigest,
+            hll = EXCLUDED.hll, topk = EXCLUDED.topk, updated_at = NOW();
+        """,
+        (
+            _user_id.get() or "", month, n, total,
+            json.dumps(digest.to_json()), hll.to_json(), json.dumps(topk.to_json(), ensure_ascii=False),
+        ),
+    )
+
+
+def _update_sketches(transaction_id: int) -> None:
+    """Soma uma despesa recém-inserida aos sketches do mês dela (read-modify-write sob FOR UPDATE)."""
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"""
+            SELECT DATE_TRUNC('month', {LOCAL_DATE_SQL})::date, t.amount, t.description, t.source_text
+            FROM transactions t WHERE t.id = %s AND t.type = 2;
+            """,
+            (transaction_id,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return
+        month, amount, description, source_text = row
+        user = _user_id.get() or ""
+        cur.execute(
+            "INSERT INTO transaction_sketches (user_id, month) VALUES (%s, %s) ON CONFLICT DO NOTHING;",
+            (user, month),
+        )
+        cur.execute(
+            "SELECT n, total, tdigest, hll, topk FROM transaction_sketches WHERE user_id = %s AND month = %s FOR UPDATE;",
+            (user, month),
+        )
+        n, total, digest, hll, topk = cur.fetchone()
+        digest, hll, topk = _TDigest.from_json(digest), _HyperLogLog.from_json(hll), _SpaceSaving.from_json(topk)
+        label = _sketch_label(description, source_text)
+        digest.add(float(amount))
+        hll.add(label)
+        topk.add(label, float(amount))
+        _save_sketch(cur, month, n + 1, float(total) + float(amount), digest, hll, topk)
+        conn.commit()
+        _result_cache.bump_generation()
+    finally:
+        cur.close()
+        conn.close()
+
+
+def _run_sketch_update(transaction_id: int) -> None:
+    _deadline.set(None)  # roda fora do turno que a disparou
+    try:
+        _update_sketches(transaction_id)
+    except Exception:
+        logger.exception("Falha ao atualizar sketches da transação %s", transaction_id)
+
+
+def rebuild_sketches(months: Optional[int] = None) -> dict:
+    """
+    Job (não é tool): recalcula do zero os sketches do usuário corrente nos últimos `months`
+    meses (padrão: todo o histórico quente). Meses já arquivados em Parquet não são tocados.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        where_conditions, params = _user_filter("t")
+        where_conditions.append("t.type = 2")
+        if months:
+            where_conditions.append(
+                f"{LOCAL_DATE_SQL} >= DATE_TRUNC('month', NOW() AT TIME ZONE 'America/Sao_Paulo')::date - %s * INTERVAL '1 month'"
+            )
+            params.append(months - 1)
+        archived_before = _archive_before(cur)
+        if archived_before:
+            where_conditions.append(f"{LOCAL_DATE_SQL} >= %s")
+            params.append(archived_before)
+        cur.execute(
+            f"""
+            SELECT DATE_TRUNC('month', {LOCAL_DATE_SQL})::date, t.amount, t.description, t.source_text
+            FROM transactions t
+            WHERE {" AND ".join(where_conditions)}
+            ORDER BY 1;
+            """,
+            params,
+        )
+        rebuilt = {}
+        for month, group in itertools.groupby(cur.fetchall(), key=lambda r: r[0]):
+            digest, hll, topk = _TDigest(), _HyperLogLog(), _SpaceSaving()
+            n, total = 0, 0.0
+            for _, amount, description, source_text in group:
+                label = _sketch_label(description, source_text)
+                digest.add(float(amount))
+                hll.add(label)
+                topk.add(label, float(amount))
+                n += 1
+                total += float(amount)
+            _save_sketch(cur, month, n, total, digest, hll, topk)
+            rebuilt[f"{month:%Y-%m}"] = n
+        conn.commit()
+        _result_cache.bump_generation()
+        return {"status": "ok", "rebuilt": rebuilt}
+    except Exception as e:
+        conn.rollback()
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("spending_profile", args_schema=SpendingProfileArgs)
+@_cached_read("spending_profile")
+def spending_profile(date_from_local: Optional[str] = None, date_to_local: Optional[str] = None, top: int = 10) -> dict:
+    """
+    Perfil aproximado dos gastos (EXPENSES) por meses inteiros, em tempo constante mesmo com
+    históricos enormes: gasto típico (mediana) e percentis, quantidade de estabelecimentos/descrições
+    distintos e onde mais gasta (descrições mais frequentes). Sem datas: últimos 12 meses.
+    Use para "qual meu gasto típico?" ou "onde mais gasto?"; valores exatos: aggregate_transactions.
+    """
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT month, n, total, tdigest, hll, topk
+            FROM transaction_sketches
+            WHERE user_id = %s
+              AND month >= DATE_TRUNC('month', COALESCE(%s::date,
+                    (NOW() AT TIME ZONE 'America/Sao_Paulo')::date - INTERVAL '11 months'))::date
+              AND month <= COALESCE(%s::date, (NOW() AT TIME ZONE 'America/Sao_Paulo')::date)
+              AND n > 0
+            ORDER BY month;
+            """,
+            (_user_id.get() or "", date_from_local, date_to_local),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return {"status": "ok", "count": 0, "message": "Sem despesas no período."}
+
+        digest, hll, topk = _TDigest(), _HyperLogLog(), _SpaceSaving()
+        for _, _, _, month_digest, month_hll, month_topk in rows:
+            digest.merge(_TDigest.from_json(month_digest))
+            hll.merge(_HyperLogLog.from_json(month_hll))
+            topk.merge(_SpaceSaving.from_json(month_topk))
+
+        top = max(1, min(int(top or 10), 25))
+        return {
+            "status": "ok",
+            "approximate": True,
+            "months": [f"{rows[0][0]:%Y-%m}", f"{rows[-1][0]:%Y-%m}"],
+            "count": sum(r[1] for r in rows),
+            "total": round(float(sum(r[2] for r in rows)), 2),
+            "typical_expense": round(digest.quantile(0.5), 2),
+            "percentiles": {f"p{int(q * 100)}": round(digest.quantile(q), 2) for q in (0.25, 0.75, 0.9, 0.99)},
+            "distinct_descriptions": hll.estimate(),
+            "top_descriptions": {
+                "columns": ["description", "count", "amount", "max_overcount"],
+                "rows": [
+                    [_compact_value(key), c[0], round(c[2], 2), c[1]]
+                    for key, c in topk.top(top)
+                ],
+            },
+        }
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+# ----- Cartões de crédito e faturas -----
+# Os totais de card_statements são mantidos pelo trigger trg_transactions_card_statements (ver sql.txt);
+# aqui só há leitura, cadastro de cartão e a reconciliação.
+
+# Faturas cujo ciclo inteiro está no banco quente (ciclos têm no máximo 31 dias): só elas são recalculadas
+_CARD_STATEMENTS_HOT_SQL = "closing_date > COALESCE((SELECT archived_before FROM archive_state WHERE id = 1), '-infinity'::date) + 32"
+
+
+def _rebuild_card_statements(cur, card_ids: Optional[list] = None) -> int:
+    """
+    Recalcula as faturas dos cartões (todos, se card_ids for None) a partir das transações e
+    corrige as que divergirem. Devolve quantas faturas foram corrigidas, criadas ou apagadas.
+    """
+    # bloqueia os triggers de escrita até o commit: nenhum incremento se perde entre a leitura e o upsert
+    cur.execute("LOCK TABLE card_statements IN SHARE ROW EXCLUSIVE MODE;")
+    cur.execute(
+        f"""
+        WITH fresh AS (
+            SELECT t.card_id, cyc.closing_date, cyc.due_date,
+                   SUM(CASE WHEN t.type = 2 THEN t.amount ELSE -t.amount END) AS amount, COUNT(*) AS n
+            FROM transactions t
+            JOIN cards c ON c.id = t.card_id
+            CROSS JOIN LATERAL card_cycle(c.closing_day, c.due_day, {LOCAL_DATE_SQL}) cyc
+            WHERE t.type IN (1, 2) AND (%(ids)s::bigint[] IS NULL OR t.card_id = ANY(%(ids)s))
+            GROUP BY 1, 2, 3
+        ),
+        upserted AS (
+            INSERT INTO card_statements (card_id, closing_date, due_date, amount, n)
+            SELECT * FROM fresh WHERE {_CARD_STATEMENTS_HOT_SQL}
+            ON CONFLICT (card_id, closing_date) DO UPDATE
+            SET due_date = EXCLUDED.due_date, amount = EXCLUDED.amount, n = EXCLUDED.n
+            WHERE (card_statements.due_date, card_statements.amount, card_statements.n)
+                  IS DISTINCT FROM (EXCLUDED.due_date, EXCLUDED.amount, EXCLUDED.n)
+            RETURNING 1
+        ),
+        deleted AS (
+            DELETE FROM card_statements s
+            WHERE (%(ids)s::bigint[] IS NULL OR s.card_id = ANY(%(ids)s))
+              AND {_CARD_STATEMENTS_HOT_SQL}
+              AND NOT EXISTS (
+                  SELECT 1 FROM fresh f WHERE f.card_id = s.card_id AND f.closing_date = s.closing_date
+              )
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM upserted) + (SELECT COUNT(*) FROM deleted);
+        """,
+        {"ids": card_ids},
+    )
+    return cur.fetchone()[0]
+
+
+def rebuild_card_statements() -> dict:
+    """
+    Job (não é tool): reconcilia os totais incrementais de todas as faturas do banco (do shard)
+    com um recálculo completo. Faturas de ciclos já arquivados em Parquet não são tocadas.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        drift = _rebuild_card_statements(cur)
+        conn.commit()
+        if drift:
+            logger.warning("rebuild_card_statements corrigiu %s faturas", drift)
+            _mark_write(conn)
+        return {"status": "ok", "corrected": drift}
+    except Exception as e:
+        conn.rollback()
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("register_card", args_schema=RegisterCardArgs)
+def register_card(name: str, closing_day: int, due_day: int, credit_limit: Optional[float] = None) -> dict:
+    """
+    Cadastra um cartão de crédito (ou atualiza o de mesmo nome) com dia de fechamento e de vencimento
+    da fatura. Lance as compras no cartão com add_transaction(card_id=...).
+    """
+    if not (1 <= int(closing_day) <= 31 and 1 <= int(due_day) <= 31):
+        return {"status": "error", "message": "closing_day e due_day devem estar entre 1 e 31."}
+    try:
+        conn = get_conn()
+    except Exception as e:
+        return _error_result(e)
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            INSERT INTO cards (user_id, name, closing_day, due_day, credit_limit)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, name) DO UPDATE
+            SET closing_day = EXCLUDED.closing_day, due_day = EXCLUDED.due_day,
+                credit_limit = COALESCE(EXCLUDED.credit_limit, cards.credit_limit)
+            RETURNING id, (xmax <> 0);
+            """,
+            (_user_id.get() or "", name.strip(), int(closing_day), int(due_day), credit_limit),
+        )
+        card_id, existed = cur.fetchone()
+        # mudou o ciclo: as compras já lançadas trocam de fatura
+        moved = _rebuild_card_statements(cur, [card_id]) if existed else 0
+        conn.commit()
+        _mark_write(conn)
+        return {"status": "ok", "id": card_id, "updated": existed, "statements_changed": moved}
+
+    except Exception as e:
+        conn.rollback()
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+def _statement_dict(closing_date, due_date, pay_until, amount, n, today: dt.date) -> Optional[dict]:
+    if closing_date is None:
+        return None
+    pay_until = pay_until or due_date  # vencimento em dia não útil: paga no próximo dia útil
+    return {
+        "closing_date": closing_date.isoformat(),
+        "due_date": due_date.isoformat(),
+        "pay_until": pay_until.isoformat(),
+        "amount": float(amount),
+        "count": n,
+        "status": "open" if closing_date > today else ("closed" if pay_until >= today else "past_due"),
+    }
+
+
+@tool("card_statement", args_schema=CardStatementArgs)
+@_cached_read("card_statement")
+def card_statement(card_name: Optional[str] = None, closing_month: Optional[str] = None) -> dict:
+    """
+    Fatura dos cartões de crédito: por cartão, a fatura aberta (compras até o próximo fechamento) e a
+    última fechada, com vencimento e limite disponível. Com closing_month (YYYY-MM), a fatura que
+    fecha nesse mês. Use para "quanto está minha fatura?" em vez de somar transações por data.
+    """
+    month_start = None
+    if closing_month:
+        try:
+            month_start = dt.datetime.strptime(closing_month.strip()[:7], "%Y-%m").date()
+        except ValueError:
+            return {"status": "error", "message": "closing_month deve estar no formato YYYY-MM."}
+
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        # um ciclo por cartão: fatura pela PK (card_id, closing_date), sem varrer transações
+        statement_sql = """
+            SELECT s.closing_date, s.due_date,
+                   (SELECT MIN(cal.day) FROM calendar cal WHERE cal.is_business_day AND cal.day >= s.due_date),
+                   s.amount, s.n
+            FROM card_statements s
+        """
+        cur.execute(
+            f"""
+            WITH today AS (SELECT (NOW() AT TIME ZONE 'America/Sao_Paulo')::date AS day)
+            SELECT c.id, c.name, c.closing_day, c.due_day, c.credit_limit, today.day,
+                   cyc.closing_date, cyc.due_date, o.*, l.*,
+                   (SELECT COALESCE(SUM(s.amount), 0) FROM card_statements s
+                    WHERE s.card_id = c.id AND s.due_date >= today.day)
+            FROM cards c
+            CROSS JOIN today
+            CROSS JOIN LATERAL card_cycle(c.closing_day, c.due_day,
+                COALESCE(%(month)s::date - 1, today.day)) cyc
+            LEFT JOIN LATERAL ({statement_sql}
+                WHERE s.card_id = c.id AND s.closing_date = cyc.closing_date) o ON TRUE
+            LEFT JOIN LATERAL ({statement_sql}
+                WHERE s.card_id = c.id AND s.closing_date < cyc.closing_date AND %(month)s::date IS NULL
+                ORDER BY s.closing_date DESC LIMIT 1) l ON TRUE
+            WHERE c.user_id = %(user)s
+              AND (%(name)s::text IS NULL OR c.name ILIKE %(name)s)
+            ORDER BY c.name;
+            """,
+            {
+                "user": _user_id.get() or "",
+                "name": f"%{card_name.strip()}%" if card_name else None,
+                "month": month_start,
+            },
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return {"status": "ok", "count": 0, "message": "Nenhum cartão cadastrado (use register_card)."}
+
+        cards = []
+        for card_id, name, closing_day, due_day, limit, today, closing, due, *statements, outstanding in rows:
+            opened, last_closed = statements[:5], statements[5:]
+            current = _statement_dict(*opened, today) or _statement_dict(closing, due, None, 0, 0, today)
+            card = {
+                "card_id": card_id,
+                "name": name,
+                "closing_day": closing_day,
+                "due_day": due_day,
+                "credit_limit": float(limit) if limit is not None else None,
+                # faturas ainda não vencidas contam como limite usado
+                "available_limit": round(float(limit) - float(outstanding), 2) if limit is not None else None,
+            }
+            if month_start:
+                card["statement"] = current
+            else:
+                card["open_statement"] = current
+                card["last_closed_statement"] = _statement_dict(*last_closed, today)
+            cards.append(card)
+        return {"status": "ok", "count": len(cards), "cards": cards}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+# ----- Contas e saldos por conta -----
+# accounts.balance é mantido pelo trigger trg_transactions_account_balances (ver sql.txt).
+
+ACCOUNT_KINDS = ("checking", "savings", "wallet", "investment")
+
+
+def _reconcile_account_balances(cur, user_id: Optional[str] = None) -> list:
+    """
+    Recalcula o saldo das contas (todas, ou só as de user_id) a partir das transações e corrige as
+    que divergirem. Devolve as correções feitas.
+    """
+    # os triggers de escrita esperam o commit: nenhum delta se perde entre o recálculo e o UPDATE
+    cur.execute("LOCK TABLE accounts IN SHARE ROW EXCLUSIVE MODE;")
+    cur.execute(
+        """
+        WITH moves AS (
+            SELECT m.account_id, SUM(m.amount) AS amount
+            FROM (
+                SELECT to_account_id AS account_id, amount FROM transactions WHERE to_account_id IS NOT NULL
+                UNION ALL
+                SELECT from_account_id, -amount FROM transactions WHERE from_account_id IS NOT NULL
+            ) m
+            GROUP BY m.account_id
+        ),
+        expected AS (
+            SELECT a.id, a.balance AS old_balance,
+                   a.opening_balance + a.archived_delta + COALESCE(m.amount, 0) AS balance
+            FROM accounts a
+            LEFT JOIN moves m ON m.account_id = a.id
+            WHERE %(user)s::text IS NULL OR a.user_id = %(user)s
+        )
+        UPDATE accounts a
+        SET balance = e.balance, updated_at = NOW()
+        FROM expected e
+        WHERE a.id = e.id AND a.balance <> e.balance
+        RETURNING a.id, a.name, e.old_balance, e.balance;
+        """,
+        {"user": user_id},
+    )
+    return [
+        {"id": r[0], "name": r[1], "was": float(r[2]), "balance": float(r[3])}
+        for r in cur.fetchall()
+    ]
+
+
+def reconcile_account_balances() -> dict:
+    """
+    Job (não é tool): confere os saldos incrementais de todas as contas do banco (do shard) contra
+    um recálculo completo (saldo inicial + arquivado + transações) e corrige as divergências.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        corrected = _reconcile_account_balances(cur)
+        conn.commit()
+        if corrected:
+            logger.warning("reconcile_account_balances corrigiu %s contas: %s", len(corrected), corrected)
+            _mark_write(conn)
+        return {"status": "ok", "corrected": corrected}
+    except Exception as e:
+        conn.rollback()
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("register_account", args_schema=RegisterAccountArgs)
+def register_account(name: str, kind: str = "checking", opening_balance: Optional[float] = None) -> dict:
+    """
+    Cadastra uma conta/carteira (ou atualiza a de mesmo nome) com o saldo inicial. Lance as
+    movimentações com add_transaction(from_account_id=..., to_account_id=...).
+    """
+    kind = (kind or "checking").strip().lower()
+    if kind not in ACCOUNT_KINDS:
+        return {"status": "error", "message": f"Tipo de conta inválido: {kind!r}. Use: {list(ACCOUNT_KINDS)}."}
+    try:
+        conn = get_conn()
+    except Exception as e:
+        return _error_result(e)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        # mudar o saldo inicial desloca o saldo atual pela diferença
+        cur.execute(
+            """
+            INSERT INTO accounts (user_id, name, kind, opening_balance, balance)
+            VALUES (%(user)s, %(name)s, %(kind)s, COALESCE(%(opening)s, 0), COALESCE(%(opening)s, 0))
+            ON CONFLICT (user_id, name) DO UPDATE
+            SET kind = EXCLUDED.kind,
+                opening_balance = COALESCE(%(opening)s, accounts.opening_balance),
+                balance = accounts.balance + COALESCE(%(opening)s, accounts.opening_balance) - accounts.opening_balance,
+                updated_at = NOW()
+            RETURNING id, (xmax <> 0), balance;
+            """,
+            {"user": _user_id.get() or "", "name": name.strip(), "kind": kind, "opening": opening_balance},
+        )
+        account_id, existed, balance = cur.fetchone()
+        _mark_write(conn)
+        return {"status": "ok", "id": account_id, "updated": existed, "balance": float(balance)}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("account_balances")
+@_cached_read("account_balances")
+def account_balances() -> dict:
+    """
+    Saldo atual de cada conta/carteira do usuário e o patrimônio líquido (soma das contas).
+    Use para "quanto tenho em cada conta?" ou "onde está meu dinheiro?"; os ids servem para
+    from_account_id/to_account_id no add_transaction.
+    """
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            SELECT id, name, kind, balance, updated_at
+            FROM accounts
+            WHERE user_id = %s
+            ORDER BY balance DESC, name;
+            """,
+            (_user_id.get() or "",),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return {"status": "ok", "count": 0, "message": "Nenhuma conta cadastrada (use register_account)."}
+        return {
+            "status": "ok",
+            "count": len(rows),
+            "net_worth": round(float(sum(r[3] for r in rows)), 2),
+            "accounts": {
+                "columns": ["id", "name", "kind", "balance", "updated_at"],
+                "rows": [[r[0], r[1], r[2], float(r[3]), r[4].isoformat(timespec="seconds")] for r in rows],
+            },
+        }
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+# ----- Contas a pagar (scheduled_payments) -----
+
+RECURRENCES = ("weekly", "monthly", "yearly")
+
+
+def _next_due(due: dt.date, recurrence: str, anchor_day: Optional[int]) -> dt.date:
+    """Próximo vencimento; mensal/anual voltam ao dia original (31 -> 28/02 -> 31/03)."""
+    if recurrence == "weekly":
+        return due + dt.timedelta(days=7)
+    month = _add_months(due.replace(day=1), 12 if recurrence == "yearly" else 1)
+    last_day = calendar.monthrange(month.year, month.month)[1]
+    return month.replace(day=min(anchor_day or due.day, last_day))
+
+
+@tool("schedule_payment", args_schema=SchedulePaymentArgs)
+def schedule_payment(
+    title: str,
+    amount: float,
+    due_date_local: str,
+    recurrence: Optional[str] = None,
+    category_id: Optional[int] = None,
+    from_account_id: Optional[int] = None,
+) -> dict:
+    """
+    Agenda uma conta a pagar (boleto, IPVA, aluguel, assinatura...) com vencimento e, opcionalmente,
+    recorrência. Quando for paga, use pay_scheduled_payment (que lança a despesa).
+    """
+    recurrence = recurrence.strip().lower() if recurrence else None
+    if recurrence is not None and recurrence not in RECURRENCES:
+        return {"status": "error", "message": f"Recorrência inválida: {recurrence!r}. Use: {list(RECURRENCES)} ou vazio."}
+    try:
+        due = dt.date.fromisoformat(due_date_local.strip()[:10])
+    except ValueError:
+        return {"status": "error", "message": "due_date_local deve estar no formato YYYY-MM-DD."}
+    try:
+        conn = get_conn()
+    except Exception as e:
+        return _error_result(e)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        user = _user_id.get() or ""
+        cur.execute(
+            """
+            INSERT INTO scheduled_payments
+                (user_id, title, amount, due_date, recurrence, anchor_day, category_id, from_account_id)
+            SELECT %(user)s, %(title)s, %(amount)s, %(due)s, %(recurrence)s, %(anchor)s, %(category_id)s, %(account)s
+            WHERE %(account)s::bigint IS NULL
+               OR EXISTS (SELECT 1 FROM accounts WHERE id = %(account)s AND user_id = %(user)s)
+            RETURNING id;
+            """,
+            {
+                "user": user,
+                "title": title.strip(),
+                "amount": amount,
+                "due": due,
+                "recurrence": recurrence,
+                "anchor": due.day if recurrence in ("monthly", "yearly") else None,
+                "category_id": category_id,
+                "account": from_account_id,
+            },
+        )
+        row = cur.fetchone()
+        if row is None:
+            return {"status": "error", "message": "Conta não encontrada (veja as contas com account_balances)."}
+        _mark_write(conn)
+        return {"status": "ok", "id": row[0], "due_date": due.isoformat(), "recurrence": recurrence}
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("list_due_payments", args_schema=ListDuePaymentsArgs)
+@_cached_read("list_due_payments")
+def list_due_payments(
+    date_from_local: Optional[str] = None,
+    date_to_local: Optional[str] = None,
+    include_paid: bool = False,
+) -> dict:
+    """
+    Contas a pagar por vencimento. Sem datas: as atrasadas mais as que vencem nos próximos 7 dias
+    (com include_paid, também as já pagas até lá).
+    pay_until é o vencimento ajustado para o próximo dia útil.
+    """
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        # sem date_from, o limite inferior é aberto para as pendentes (atrasadas, pelo índice parcial)
+        # e também para as pagas quando include_paid
+        cur.execute(
+            """
+            WITH today AS (SELECT (NOW() AT TIME ZONE 'America/Sao_Paulo')::date AS day)
+            SELECT sp.id, sp.title, sp.amount, sp.due_date,
+                   (SELECT MIN(cal.day) FROM calendar cal WHERE cal.is_business_day AND cal.day >= sp.due_date),
+                   sp.recurrence, c.name, sp.paid_at IS NOT NULL, sp.transaction_id, today.day
+            FROM scheduled_payments sp
+            CROSS JOIN today
+            LEFT JOIN categories c ON c.id = sp.category_id
+            WHERE sp.user_id = %(user)s
+              AND sp.due_date <= COALESCE(%(to)s::date, today.day + 6)
+              AND (sp.due_date >= %(from)s::date OR %(from)s::date IS NULL)
+              AND (%(include_paid)s OR sp.paid_at IS NULL)
+            ORDER BY sp.due_date, sp.id
+            LIMIT 100;
+            """,
+            {
+                "user": _user_id.get() or "",
+                "from": date_from_local,
+                "to": date_to_local,
+                "include_paid": bool(include_paid),
+            },
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return {"status": "ok", "count": 0, "message": "Nenhuma conta a pagar no período."}
+        today = rows[0][-1]
+        pending = [r for r in rows if not r[7]]
+        return {
+            "status": "ok",
+            "count": len(rows),
+            "total_pending": round(float(sum(r[2] for r in pending)), 2),
+            "overdue": sum(1 for r in pending if (r[4] or r[3]) < today),
+            "columns": ["id", "title", "amount", "due_date", "pay_until", "recurrence", "category", "paid", "transaction_id"],
+            "rows": [
+                [r[0], _compact_value(r[1]), float(r[2]), r[3].isoformat(), (r[4] or r[3]).isoformat(),
+                 r[5], r[6], r[7], r[8]]
+                for r in rows
+            ],
+        }
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+def _prepare_spooled_payment(call: dict) -> dict:
+    # o replay roda depois: a despesa fica com o horário em que o usuário pagou
+    call["paid_at"] = call.get("paid_at") or dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+    return call
+
+
+@tool("pay_scheduled_payment", args_schema=PayScheduledPaymentArgs)
+@_spooled_write("pay_scheduled_payment", prepare=_prepare_spooled_payment)
+def pay_scheduled_payment(
+    id: int,
+    amount: Optional[float] = None,
+    paid_at: Optional[str] = None,
+    from_account_id: Optional[int] = None,
+    payment_method: Optional[str] = None,
+) -> dict:
+    """
+    Marca uma conta a pagar como paga: lança a despesa (EXPENSES) e liga à conta a pagar na mesma
+    transação do banco; se for recorrente, agenda a próxima ocorrência. Repetir a chamada não
+    lança de novo. amount: valor efetivamente pago, se diferente (juros, desconto).
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        user = _user_id.get() or ""
+        cur.execute(
+            """
+            SELECT title, amount, due_date, recurrence, anchor_day, category_id, from_account_id,
+                   transaction_id, paid_at
+            FROM scheduled_payments
+            WHERE id = %s AND user_id = %s
+            FOR UPDATE;
+            """,
+            (id, user),
+        )
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            return {"status": "error", "message": f"Conta a pagar {id} não encontrada."}
+        title, due_amount, due, recurrence, anchor_day, category_id, account_id, transaction_id, already_paid = row
+        if already_paid is not None:
+            conn.rollback()
+            return {"status": "ok", "id": id, "transaction_id": transaction_id, "paid_at": str(already_paid), "duplicate": True}
+
+        if from_account_id is not None:
+            cur.execute("SELECT id FROM accounts WHERE id = %s AND user_id = %s;", (from_account_id, user))
+            if cur.fetchone() is None:
+                conn.rollback()
+                return {"status": "error", "message": "Conta não encontrada (veja as contas com account_balances)."}
+            account_id = from_account_id
+
+        # a chave amarra a despesa à conta a pagar: nem retry nem replay do spool lançam duas vezes
+        key = _scoped_key(f"scheduled_payment:{id}")
+        cur.execute(
+            """
+            INSERT INTO transactions
+                (amount, type, category_id, description, payment_method, occurred_at, source_text,
+                 idempotency_key, user_id, from_account_id)
+            VALUES (%s, 2, %s, %s, %s, COALESCE(%s::timestamptz, NOW()), %s, %s, %s, %s)
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING id, occurred_at;
+            """,
+            (
+                amount if amount is not None else due_amount, category_id, title, payment_method, paid_at,
+                f"Pagamento agendado: {title}", key, _user_id.get(), account_id,
+            ),
+        )
+        inserted = cur.fetchone()
+        if inserted is None:
+            cur.execute("SELECT id, occurred_at FROM transactions WHERE idempotency_key = %s;", (key,))
+            inserted = cur.fetchone()
+        transaction_id, occurred = inserted
+        cur.execute(
+            "UPDATE scheduled_payments SET transaction_id = %s, paid_at = %s WHERE id = %s;",
+            (transaction_id, occurred, id),
+        )
+
+        next_due = None
+        if recurrence:
+            next_due = _next_due(due, recurrence, anchor_day)
+            cur.execute(
+                """
+                INSERT INTO scheduled_payments
+                    (user_id, title, amount, due_date, recurrence, anchor_day, category_id, from_account_id)
+                SELECT user_id, title, amount, %s, recurrence, anchor_day, category_id, from_account_id
+                FROM scheduled_payments WHERE id = %s;
+                """,
+                (next_due, id),
+            )
+        conn.commit()
+        _mark_write(conn)
+        _on_expense_written(transaction_id)
+        return {
+            "status": "ok",
+            "id": id,
+            "transaction_id": transaction_id,
+            "paid_at": str(occurred),
+            "next_due_date": next_due.isoformat() if next_due else None,
+        }
+
+    except Exception as e:
+        conn.rollback()
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+@tool("project_outflows", args_schema=ProjectOutflowsArgs)
+@_cached_read("project_outflows")
+def project_outflows(days: int = 30) -> dict:
+    """
+    Projeção das contas a pagar nos próximos `days` dias (padrão 30), expandindo as recorrentes:
+    total, atrasadas, total por semana e, com contas cadastradas, o patrimônio depois dos pagamentos.
+    """
+    days = max(1, min(int(days or 30), FORECAST_MAX_DAYS))
+    conn = get_read_conn()
+    cur = conn.cursor()
+    try:
+        user = _user_id.get() or ""
+        cur.execute(
+            """
+            SELECT (NOW() AT TIME ZONE 'America/Sao_Paulo')::date,
+                   (SELECT SUM(balance) FROM accounts WHERE user_id = %s);
+            """,
+            (user,),
+        )
+        today, net_worth = cur.fetchone()
+        end = today + dt.timedelta(days=days - 1)
+        cur.execute(
+            """
+            SELECT id, title, amount, due_date, recurrence, anchor_day
+            FROM scheduled_payments
+            WHERE user_id = %s AND paid_at IS NULL AND due_date <= %s
+            ORDER BY due_date;
+            """,
+            (user, end),
+        )
+        items, overdue = [], 0.0
+        for payment_id, title, amount, due, recurrence, anchor_day in cur.fetchall():
+            while due <= end:
+                if due < today:
+                    overdue += float(amount)
+                else:
+                    items.append((due, payment_id, title, float(amount)))
+                if not recurrence:
+                    break
+                due = _next_due(due, recurrence, anchor_day)
+        items.sort()
+
+        by_week = {}
+        for due, _, _, amount in items:
+            week = _monday(due).isoformat()
+            by_week[week] = round(by_week.get(week, 0.0) + amount, 2)
+        total = round(sum(i[3] for i in items), 2)
+        result = {
+            "status": "ok",
+            "date_from_local": today.isoformat(),
+            "date_to_local": end.isoformat(),
+            "total": total,
+            "overdue": round(overdue, 2),
+            "by_week": by_week,
+            "columns": ["due_date", "id", "title", "amount"],
+            "rows": [[d.isoformat(), i, _compact_value(t), a] for d, i, t, a in items[:50]],
+        }
+        if len(items) > 50:
+            result["more_rows"] = len(items) - 50
+        if net_worth is not None:
+            result["net_worth"] = float(net_worth)
+            result["net_worth_after"] = round(float(net_worth) - total - overdue, 2)
+        return result
+
+    except Exception as e:
+        return _error_result(e)
+    finally:
+        try:
+            cur.close()
+            release_conn(conn)
+        except Exception:
+            pass
+
+
+def _recover_archive(conn, archive_dir: str) -> None:
+    """
+    Termina uma publicação interrompida: o .tmp marcado em archive_state.pending_file já teve o
+    DELETE commitado e é publicado; qualquer outro .tmp é de um mês que não chegou ao commit.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT pending_file FROM archive_state WHERE id = 1;")
+        row = cur.fetchone()
+        pending = row[0] if row else None
+        if pending and os.path.exists(os.path.join(archive_dir, pending + ".tmp")):
+            os.replace(os.path.join(archive_dir, pending + ".tmp"), os.path.join(archive_dir, pending))
+            logger.warning("Arquivo %s publicado na recuperação do arquivamento", pending)
+        for tmp_path in glob.glob(os.path.join(archive_dir, "*.parquet.tmp")):
+            os.remove(tmp_path)
+        if pending:
+            cur.execute("UPDATE archive_state SET pending_file = NULL WHERE id = 1;")
+    conn.commit()
+
+
+def archive_old_transactions(horizon_months: Optional[int] = None, shard: Optional[int] = None) -> dict:
+    """
+    Job (não é tool): move transações anteriores ao horizonte para ARCHIVE_DIR/YYYY-MM.parquet.
+    Por mês: grava o Parquet (temporário), soma os totais diários em transactions_archive_daily,
+    apaga as linhas quentes, avança archive_state (marcando o arquivo como pendente) e só então
+    publica o arquivo. Se o processo cair entre o commit e a publicação, a próxima execução
+    publica o .tmp pendente antes de arquivar qualquer outro mês.
+    Com sharding, rode uma vez por shard (shard=0..N-1); cada um usa ARCHIVE_DIR/shard<k>.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("amount", pa.decimal128(14, 2)),
+        ("type", pa.int32()),
+        ("type_name", pa.string()),
+        ("category_id", pa.int32()),
+        ("category", pa.string()),
+        ("description", pa.string()),
+        ("payment_method", pa.string()),
+        ("occurred_at", pa.timestamp("us", tz="UTC")),
+        ("occurred_at_local", pa.timestamp("us")),
+        ("local_date", pa.date32()),
+        ("source_text", pa.string()),
+        ("user_id", pa.string()),
+        ("card_id", pa.int64()),
+        ("from_account_id", pa.int64()),
+        ("to_account_id", pa.int64()),
+    ])
+    horizon = horizon_months or ARCHIVE_HORIZON_MONTHS
+    if shard is not None and not 0 <= shard < len(SHARD_DATABASE_URLS):
+        return {"status": "error", "message": f"Shard inválido: {shard}."}
+    archive_dir = _archive_dir(shard) if shard is not None else ARCHIVE_DIR
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = psycopg2.connect(SHARD_DATABASE_URLS[shard] if shard is not None else DATABASE_URL)
+    cur = conn.cursor()
+    archived = {}
+    try:
+        _recover_archive(conn, archive_dir)
+        cur.execute(
+            "SELECT (DATE_TRUNC('month', NOW() AT TIME ZONE 'America/Sao_Paulo') - %s * INTERVAL '1 month')::date;",
+            (horizon,),
+        )
+        cutoff = cur.fetchone()[0]
+        cur.execute(
+            f"""
+            SELECT DISTINCT DATE_TRUNC('month', t.occurred_at AT TIME ZONE 'America/Sao_Paulo')::date
+            FROM transactions t
+            WHERE {LOCAL_DATE_SQL} < %s
+            ORDER BY 1;
+            """,
+            (cutoff,),
+        )
+        months = [row[0] for row in cur.fetchall()]
+        conn.commit()
+
+        for month in months:
+            next_month = (month.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+            cur.execute(
+                f"""
+                SELECT
+                    t.id, t.amount, t.type, tt.type AS type_name, t.category_id, c.name AS category,
+                    t.description, t.payment_method, t.occurred_at,
+                    t.occurred_at AT TIME ZONE 'America/Sao_Paulo' AS occurred_at_local,
+                    {LOCAL_DATE_SQL} AS local_date, t.source_text, t.user_id, t.card_id,
+                    t.from_account_id, t.to_account_id
+                FROM transactions t
+                JOIN transaction_types tt ON tt.id = t.type
+                LEFT JOIN categories c ON c.id = t.category_id
+                WHERE {LOCAL_DATE_SQL} >= %s AND {LOCAL_DATE_SQL} < %s
+                ORDER BY t.occurred_at
+                FOR UPDATE OF t;
+                """,
+                (month, next_month),
+            )
+            columns = [desc[0] for desc in cur.description]
+            rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+            if not rows:
+                conn.rollback()
+                continue
+
+            table = pa.Table.from_pylist(rows, schema=schema)
+            path = os.path.join(archive_dir, f"{month:%Y-%m}.parquet")
+            if os.path.exists(path):
+                # mês já arquivado antes (ex.: lançamento retroativo): junta com o arquivo existente
+                existing = pq.read_table(path, schema=schema)
+                new_ids = set(table.column("id").to_pylist())
+                keep = [i not in new_ids for i in existing.column("id").to_pylist()]
+                table = pa.concat_tables([existing.filter(pa.array(keep)), table])
+            tmp_path = path + ".tmp"
+            pq.write_table(table, tmp_path)
+
+            ids = [r["id"] for r in rows]
+            cur.execute(
+                f"""
+                INSERT INTO transactions_archive_daily (day, type, category_id, payment_method, user_id, total, n)
+                SELECT {LOCAL_DATE_SQL}, t.type, COALESCE(t.category_id, 0), COALESCE(t.payment_method, ''),
+                       COALESCE(t.user_id, ''), SUM(t.amount), COUNT(*)
+                FROM transactions t
+                WHERE t.id = ANY(%s)
+                GROUP BY 1, 2, 3, 4, 5
+                ON CONFLICT (day, type, category_id, payment_method, user_id) DO UPDATE
+                SET total = transactions_archive_daily.total + EXCLUDED.total,
+                    n = transactions_archive_daily.n + EXCLUDED.n;
+                """,
+                (ids,),
+            )
+            # as linhas só mudam de lugar: as faturas não são descontadas e o efeito nos saldos das
+            # contas passa para accounts.archived_delta
+            cur.execute("SET LOCAL assessor.archiving = 'on';")
+            cur.execute("DELETE FROM transactions WHERE id = ANY(%s);", (ids,))
+            cur.execute(
+                """
+                INSERT INTO archive_state (id, archived_before, pending_file) VALUES (1, %s, %s)
+                ON CONFLICT (id) DO UPDATE
+                SET archived_before = GREATEST(archive_state.archived_before, EXCLUDED.archived_before),
+                    pending_file = EXCLUDED.pending_file;
+                """,
+                (next_month, os.path.basename(path)),
+            )
+            conn.commit()
+            os.replace(tmp_path, path)
+            cur.execute("UPDATE archive_state SET pending_file = NULL WHERE id = 1;")
+            conn.commit()
+            archived[f"{month:%Y-%m}"] = len(rows)
+
+        _archive_before_cache.clear()
+        if archived:
+            _mark_write(conn)
+        return {"status": "ok", "cutoff": str(cutoff), "archived": archived}
+
+    except Exception as e:
+        conn.rollback()
+        return {"status": "error", "message": str(e), "archived": archived}
+    finally:
+        try:
+            cur.close()
+            conn.close()
+        except Exception:
+            pass
+
+
+# ----- Log de consultas e sugestão de índices -----
+
+# Seq Scan seletivo (devolve menos de 10% das linhas) em tabela com pelo menos tantas linhas vira candidato a índice
+ADVISOR_MIN_SCANNED_ROWS = 1000
+ADVISOR_MAX_SELECTIVITY = 0.1
+
+
+def _read_query_log(path: str) -> list:
+    entries = []
+    for name in (path + ".1", path):
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # linha truncada (processo morto no meio da escrita)
+    return entries
+
+
+def _plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from _plan_nodes(child)
+
+
+def _filter_columns(condition: str):
+    """Colunas simples comparadas no Filter do plano: (igualdade, faixa). LIKE/ILIKE e expressões ficam de fora."""
+    equality, ranged = [], []
+    for column, op in re.findall(r"\((\w+) (= ANY|=|>=|<=|>|<)(?= )", condition):
+        target = equality if op in ("=", "= ANY") else ranged
+        if column not in equality and column not in ranged:
+            target.append(column)
+    return equality, ranged
+
+
+def _index_columns(indexdef: str) -> list:
+    """Colunas do índice, na ordem; para no parêntese que fecha a lista (o WHERE de um índice parcial fica de fora)."""
+    match = re.search(r"USING \w+ \(", indexdef)
+    if not match:
+        return []
+    columns, current, depth = [], "", 0
+    for char in indexdef[match.end():]:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif char == "," and depth == 0:
+            columns.append(current)
+            current = ""
+            continue
+        current += char
+    columns.append(current)
+    return [c.strip().split(" ")[0].strip('"') for c in columns]
+
+
+def advise_indexes(log_path: Optional[str] = None, dsn: Optional[str] = None, top: int = 10) -> dict:
+    """
+    Job offline (não é tool): minera o log de consultas (QUERY_LOG=1, em QUERY_LOG_PATH) e propõe índices.
+    - queries: formas que mais somam tempo (chamadas, média, máximo, tools de origem);
+    - missing_indexes: Seq Scans seletivos vistos nos planos capturados, com o DDL sugerido
+      (colunas de igualdade antes das de faixa) quando nenhum índice existente já começa por elas;
+    - unused_indexes: índices não únicos sem nenhum scan desde o último reset de estatísticas e
+      que não aparecem em nenhum plano capturado.
+    Com sharding, rode com o dsn de cada shard (os planos do log são de todos).
+    """
+    entries = _read_query_log(log_path or QUERY_LOG_PATH)
+    if not entries:
+        return {"status": "ok", "message": "Log de consultas vazio.", "queries": [], "missing_indexes": [], "unused_indexes": []}
+
+    stats = {}
+    for entry in entries:
+        s = stats.setdefault(entry["fingerprint"], {
+            "fingerprint": entry["fingerprint"], "shape": entry["shape"], "tools": set(),
+            "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": None,
+        })
+        s["calls"] += 1
+        s["total_ms"] += entry["duration_ms"]
+        s["max_ms"] = max(s["max_ms"], entry["duration_ms"])
+        if entry.get("tool"):
+            s["tools"].add(entry["tool"])
+        if isinstance(entry.get("plan"), list):
+            s["plan"] = entry["plan"]  # o mais recente
+
+    candidates, used_indexes = {}, set()
+    for s in stats.values():
+        if s["plan"] is None:
+            continue
+        for node in _plan_nodes(s["plan"][0]["Plan"]):
+            if node.get("Index Name"):
+                used_indexes.add(node["Index Name"])
+            if node.get("Node Type") != "Seq Scan" or not node.get("Filter"):
+                continue
+            # só há linhas reais com ANALYZE (leituras); nos planos de escritas vale o tamanho da tabela
+            if "Actual Rows" in node:
+                scanned = node["Actual Rows"] + node.get("Rows Removed by Filter", 0)
+                if node["Actual Rows"] > scanned * ADVISOR_MAX_SELECTIVITY:
+                    continue
+            equality, ranged = _filter_columns(node["Filter"])
+            columns = tuple((equality + ranged)[:3])
+            if not columns:
+                continue
+            c = candidates.setdefault((node["Relation Name"], columns), {"queries": set(), "total_ms": 0.0, "calls": 0})
+            c["queries"].add(s["fingerprint"])
+            c["total_ms"] += s["total_ms"]
+            c["calls"] += s["calls"]
+
+    conn = psycopg2.connect(dsn or DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples >= %s;",
+                (ADVISOR_MIN_SCANNED_ROWS,),
+            )
+            large_tables = {row[0] for row in cur.fetchall()}
+            cur.execute("SELECT tablename, indexdef FROM pg_indexes WHERE schemaname = 'public';")
+            existing = {}
+            for table, indexdef in cur.fetchall():
+                existing.setdefault(table, []).append(_index_columns(indexdef))
+            cur.execute(
+                """
+                SELECT s.relname, s.indexrelname, pg_relation_size(s.indexrelid),
+                       (SELECT stats_reset FROM pg_stat_database WHERE datname = current_database())
+                FROM pg_stat_user_indexes s
+                JOIN pg_index i ON i.indexrelid = s.indexrelid
+                WHERE s.idx_scan = 0 AND NOT i.indisunique AND NOT i.indisprimary
+                ORDER BY pg_relation_size(s.indexrelid) DESC;
+                """
+            )
+            unused_rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    missing = []
+    for (table, columns), c in sorted(candidates.items(), key=lambda kv: -kv[1]["total_ms"]):
+        # tabela pequena (Seq Scan é o plano certo) ou já coberta por um índice que começa pelas mesmas colunas
+        if table not in large_tables or any(cols[:len(columns)] == list(columns) for cols in existing.get(table, [])):
+            continue
+        name = f"idx_{table}_{'_'.join(columns)}"[:63]
+        missing.append({
+            "table": table,
+            "columns": list(columns),
+            "ddl": f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({', '.join(columns)});",
+            "calls": c["calls"],
+            "total_ms": round(c["total_ms"], 1),
+            "queries": sorted(c["queries"]),
+        })
+
+    unused = [
+        {
+            "table": table,
+            "index": index,
+            "size_bytes": size,
+            "stats_since": str(reset) if reset else None,
+            "ddl": f"DROP INDEX CONCURRENTLY IF EXISTS {index};",
+        }
+        for table, index, size, reset in unused_rows
+        if index not in used_indexes
+    ]
+
+    ranked = sorted(stats.values(), key=lambda s: -s["total_ms"])[:top]
+    return {
+        "status": "ok",
+        "statements": len(entries),
+        "queries": [
+            {
+                "fingerprint": s["fingerprint"],
+                "tools": sorted(s["tools"]),
+                "calls": s["calls"],
+                "total_ms": round(s["total_ms"], 1),
+                "avg_ms": round(s["total_ms"] / s["calls"], 2),
+                "max_ms": round(s["max_ms"], 1),
+                "shape": s["shape"][:300],
+            }
+            for s in ranked
+        ],
+        "missing_indexes": missing,
+        "unused_indexes": unused,
+    }
+
+
+# ----- Resharding -----
+
+_SHARD_COPY_COLUMNS = [
+    "id", "amount", "type", "category_id", "description", "payment_method",
+    "occurred_at", "source_text", "idempotency_key", "user_id", "card_id", "from_account_id", "to_account_id",
+]
+# Tabelas referenciadas pelas transações (precisam existir no destino antes delas).
+# accounts.balance não é copiado: os triggers do destino o refazem e o move reconcilia no fim.
+_SHARD_COPY_REFERENCES = {
+    "cards": ["id", "user_id", "name", "closing_day", "due_day", "credit_limit", "created_at"],
+    "accounts": ["id", "user_id", "name", "kind", "opening_balance", "archived_delta", "created_at"],
+}
+# Tabelas que referenciam as transações (copiadas depois delas)
+_SHARD_COPY_DEPENDENTS = {
+    "scheduled_payments": [
+        "id", "user_id", "title", "amount", "due_date", "recurrence", "anchor_day", "category_id",
+        "from_account_id", "transaction_id", "paid_at", "created_at",
+    ],
+}
+
+
+# Tabelas derivadas por usuário, chaveadas pelo usuário e não por um id global (o BIGSERIAL delas
+# não é copiado): no destino são substituídas inteiras pelo que há na origem
+_SHARD_COPY_DERIVED = {
+    "spending_anomalies": [
+        "user_id", "category_id", "period", "period_start", "amount", "baseline", "score", "detected_at",
+    ],
+    "transaction_sketches": ["user_id", "month", "n", "total", "tdigest", "hll", "topk", "updated_at"],
+}
+
+
+def _replace_user_tables(source, target, user_id: str, tables: dict) -> None:
+    """Apaga as linhas do usuário no destino e regrava as da origem ({tabela: colunas})."""
+    with source.cursor() as src, target.cursor() as dst:
+        for table, columns in tables.items():
+            cols = ", ".join(columns)
+            src.execute(f"SELECT {cols} FROM {table} WHERE user_id = %s;", (user_id,))
+            # JSONB volta como dict/list: regrava serializado
+            rows = [
+                tuple(json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v for v in row)
+                for row in src.fetchall()
+            ]
+            dst.execute(f"DELETE FROM {table} WHERE user_id = %s;", (user_id,))
+            if rows:
+                execute_values(dst, f"INSERT INTO {table} ({cols}) VALUES %s", rows)
+        source.commit()
+        target.commit()
+
+
+def _upsert_user_rows(dst, table: str, columns: list, rows: list) -> None:
+    """
+    Upsert por id no destino; um id que lá já é de outro usuário (sequences sem o esquema
+    INCREMENT BY N) não é sobrescrito: a cópia falha e nada do lote é gravado.
+    """
+    cols = ", ".join(columns)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns if c != "id")
+    written = execute_values(
+        dst,
+        f"""
+        INSERT INTO {table} ({cols}) VALUES %s
+        ON CONFLICT (id) DO UPDATE SET {updates} WHERE {table}.user_id = EXCLUDED.user_id
+        RETURNING id
+        """,
+        rows,
+        fetch=True,
+    )
+    if len(written) < len(rows):
+        taken = sorted({row[0] for row in rows} - {r[0] for r in written})
+        raise RuntimeError(
+            f"{table}: ids {taken[:10]} já pertencem a outro usuário no shard de destino "
+            f"(configure a sequence com INCREMENT BY N, ver sql.txt)."
+        )
+
+
+def _copy_user_tables(source, target, user_id: str, tables: dict) -> None:
+    """Copia (upsert por id) as linhas do usuário nas tabelas dadas ({tabela: colunas})."""
+    with source.cursor() as src, target.cursor() as dst:
+        for table, columns in tables.items():
+            src.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = %s;", (user_id,))
+            rows = src.fetchall()
+            if rows:
+                _upsert_user_rows(dst, table, columns, rows)
+        source.commit()
+        target.commit()
+
+
+def _copy_user_rows(source, target, user_id: str, batch_size: int) -> int:
+    """Copia (upsert por id) as transações do usuário de source para target, em lotes por id."""
+    _copy_user_tables(source, target, user_id, _SHARD_COPY_REFERENCES)
+    cols = ", ".join(_SHARD_COPY_COLUMNS)
+    copied, last_id = 0, 0
+    with source.cursor() as src, target.cursor() as dst:
+        while True:
+            src.execute(
+                f"SELECT {cols} FROM transactions WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s;",
+                (user_id, last_id, batch_size),
+            )
+            rows = src.fetchall()
+            source.commit()
+            if not rows:
+                _copy_user_tables(source, target, user_id, _SHARD_COPY_DEPENDENTS)
+                _replace_user_tables(source, target, user_id, _SHARD_COPY_DERIVED)
+                return copied
+            _upsert_user_rows(dst, "transactions", _SHARD_COPY_COLUMNS, rows)
+            target.commit()
+            copied += len(rows)
+            last_id = rows[-1][0]
+
+
+def move_user_shard(user_id: str, target_shard: int, batch_size: int = 1000) -> dict:
+    """
+    Job administrativo (não é tool): move as transações de um usuário para outro shard, online
+    (com cartões, contas, contas a pagar e as tabelas derivadas: anomalias e sketches mensais).
+    1. copia em lotes enquanto o usuário segue usando o shard de origem;
+    2. marca moving em shard_directory (escritas do usuário falham com erro transitório)
+       e espera SHARD_DIRECTORY_TTL para todos os processos verem a marca;
+    3. recopia o que mudou e apaga do destino o que sumiu da origem;
+    4. aponta o diretório para o destino, espera o TTL de novo e apaga as linhas da origem.
+    """
+    if not SHARD_DATABASE_URLS:
+        return {"status": "error", "message": "Sharding desativado (SHARD_DATABASE_URLS vazio)."}
+    if not 0 <= target_shard < len(SHARD_DATABASE_URLS):
+        return {"status": "error", "message": f"Shard inválido: {target_shard}."}
+    _shard_directory.pop(user_id, None)
+    source_shard = _shard_index(user_id)
+    if source_shard == target_shard:
+        return {"status": "ok", "user_id": user_id, "from_shard": source_shard, "to_shard": target_shard, "rows": 0}
+
+    directory = psycopg2.connect(DATABASE_URL)
+    directory.autocommit = True
+    source = psycopg2.connect(SHARD_DATABASE_URLS[source_shard])
+    target = psycopg2.connect(SHARD_DATABASE_URLS[target_shard])
+    moving = switched = False
+    try:
+        with source.cursor() as cur:
+            cur.execute("SELECT 1 FROM transactions_archive_daily WHERE user_id = %s LIMIT 1;", (user_id,))
+            archived = cur.fetchone() is not None
+        source.commit()
+        if archived:
+            return {"status": "error", "message": "Usuário tem transações arquivadas em Parquet; mover o arquivo não é suportado."}
+
+        _copy_user_rows(source, target, user_id, batch_size)
+
+        with directory.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO shard_directory (user_id, shard, moving) VALUES (%s, %s, TRUE)
+                ON CONFLICT (user_id) DO UPDATE SET moving = TRUE;
+                """,
+                (user_id, source_shard),
+            )
+        moving = True
+        time.sleep(SHARD_DIRECTORY_TTL)
+
+        rows = _copy_user_rows(source, target, user_id, batch_size)
+        with source.cursor() as src, target.cursor() as dst:
+            src.execute("SELECT COALESCE(ARRAY_AGG(id), '{}') FROM transactions WHERE user_id = %s;", (user_id,))
+            ids = src.fetchone()[0]
+            dst.execute("DELETE FROM transactions WHERE user_id = %s AND NOT (id = ANY(%s));", (user_id, ids))
+            _reconcile_account_balances(dst, user_id)
+        source.commit()
+        target.commit()
+
+        with directory.cursor() as cur:
+            cur.execute("UPDATE shard_directory SET shard = %s, moving = FALSE WHERE user_id = %s;", (target_shard, user_id))
+        switched = True
+        # processos com o diretório antigo em cache ainda podem ler da origem até o TTL expirar
+        time.sleep(SHARD_DIRECTORY_TTL)
+        with source.cursor() as cur:
+            for table in list(_SHARD_COPY_DERIVED) + list(_SHARD_COPY_DEPENDENTS):
+                cur.execute(f"DELETE FROM {table} WHERE user_id = %s;", (user_id,))
+            cur.execute("DELETE FROM transactions WHERE user_id = %s;", (user_id,))
+            for table in _SHARD_COPY_REFERENCES:
+                cur.execute(f"DELETE FROM {table} WHERE user_id = %s;", (user_id,))
+        source.commit()
+
+        _shard_directory.pop(user_id, None)
+        _result_cache.bump_generation()
+        return {"status": "ok", "user_id": user_id, "from_shard": source_shard, "to_shard": target_shard, "rows": rows}
+
+    except Exception as e:
+        source.rollback()
+        target.rollback()
+        if moving and not switched:
+            try:
+                with directory.cursor() as cur:
+                    cur.execute("UPDATE shard_directory SET moving = FALSE WHERE user_id = %s;", (user_id,))
+            except Exception:
+                logger.exception("Falha ao liberar o usuário %s em shard_directory", user_id)
+        return {"status": "error", "message": str(e), "switched": switched}
+    finally:
+        for conn in (directory, source, target):
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+# ----- Change feed (LISTEN/NOTIFY) -----
+
+class ChangeFeed:
+    """
+    Escuta CHANGE_FEED_CHANNEL em uma conexão dedicada e repassa cada mudança aos assinantes:
+    uma por statement, {"table", "op", "count", "ids"} (ids: até 100 primeiros). Roda em thread
+    daemon e reconecta sozinha. Com sharding, escuta todos os shards (uma thread por banco).
+    """
+
+    def __init__(self, channel: str = CHANGE_FEED_CHANNEL):
+        self.channel = channel
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stop = threading.Event()
+
+    def subscribe(self, callback):
+        """Registra callback(change: dict); devolve uma função para cancelar a assinatura."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def start(self) -> None:
+        with self._lock:
+            if self._stop.is_set() or not any(t.is_alive() for t in self._threads):
+                # cada start tem seu próprio evento: threads de um stop() anterior que ainda
+                # estejam no select terminam sozinhas sem impedir as novas
+                self._stop = threading.Event()
+                self._threads = [
+                    threading.Thread(target=self._run, args=(dsn, self._stop), name=f"pg-change-feed-{i}", daemon=True)
+                    for i, dsn in enumerate(SHARD_DATABASE_URLS or [DATABASE_URL])
+                ]
+                for thread in self._threads:
+                    thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _dispatch(self, payload: str) -> None:
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            change = {"raw": payload}
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(change)
+            except Exception:
+                logger.exception("Assinante do change feed falhou")
+
+    def _run(self, dsn: str, stop: threading.Event) -> None:
+        backoff = 1.0
+        while not stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}";')
+                # reconectou: o que mudou enquanto estávamos fora é desconhecido
+                self._dispatch(json.dumps({"table": "*", "op": "RESYNC", "count": None, "ids": None}))
+                backoff = 1.0
+                while not stop.is_set():
+                    if select.select([conn], [], [], 5)[0]:
+                        conn.poll()
+                        while conn.notifies and not stop.is_set():
+                            self._dispatch(conn.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("Change feed desconectado; tentando de novo em %.0fs", backoff)
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+change_feed = ChangeFeed()
+# O cache de leituras passa a ser invalidado também por escritas de outros processos
+change_feed.subscribe(lambda change: _result_cache.bump_generation())
+
+
+def warm_analytics_pool() -> None:
+    """Cria os processos do pool de análises em segundo plano (chame na inicialização do app)."""
+    _analytics_pool.warm()
+
+
+def start_change_feed() -> ChangeFeed:
+    """Inicia (uma vez) o listener de mudanças e devolve o feed para novos assinantes."""
+    change_feed.start()
+    return change_feed
+
+
+# Escritas que podem ir para o spool local com o banco indisponível
+_SPOOLED_WRITES = {
+    "add_transaction": add_transaction,
+    "update_transaction": update_transaction,
+    "pay_scheduled_payment": pay_scheduled_payment,
+}
+
+# Exporta a lista de tools
+TOOLS = [
+    add_transaction, query_transactions, total_balance, daily_balance, update_transaction,
+    aggregate_transactions, bulk_update_transactions, delete_transactions, forecast_balance,
+    simulate_purchase, list_anomalies, spending_profile, resolve_period, add_business_days,
+    register_card, card_statement, register_account, account_balances,
+    schedule_payment, list_due_payments, pay_scheduled_payment, project_outflows,
+]
+
+
+def _with_tool_name(name: str, func):
+    # marca os statements da tool no log de consultas; erros de roteamento/conexão que acontecem
+    # antes do try das tools (get_conn: shard em migração, disjuntor aberto) viram resposta de erro
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _tool_name.set(name)
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            return _error_result(e)
+        finally:
+            _tool_name.reset(token)
+    return wrapper
+
+
+for _tool in TOOLS:
+    _tool.func = _with_tool_name(_tool.name, _tool.func)
@@ -0,0 +1,538 @@
+"""
+Testes da lógica pura do pg_tools: nada aqui abre conexão com o banco.
+Rode da raiz do repositório: python -m pytest -q test_pg_tools.py
+"""
+import contextvars
+import datetime as dt
+import os
+import sys
+import time
+from decimal import Decimal
+
+import pytest
+
+os.environ.setdefault("QUERY_LOG", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "aulas"))
+
+import pg_tools  # noqa: E402
+
+
+def _no_db(*args, **kwargs):
+    raise AssertionError("não deveria abrir conexão")
+
+
+# ----- bulk_update_transactions / delete_transactions -----
+
+def test_bulk_update_dry_run_is_not_reported_as_unknown_value(monkeypatch):
+    dry = {"status": "ok", "dry_run": True, "matched": 2, "ids": [1, 2]}
+    monkeypatch.setattr(pg_tools, "_bulk_apply", lambda *args, **kwargs: dict(dry))
+    result = pg_tools.bulk_update_transactions.invoke(
+        {"text": "uber", "set_type_name": "EXPENSES", "set_category_name": "transporte", "dry_run": True}
+    )
+    assert result == dry
+
+
+def test_bulk_update_guard_reports_when_nothing_applied(monkeypatch):
+    monkeypatch.setattr(
+        pg_tools, "_bulk_apply",
+        lambda *args, **kwargs: {"status": "ok", "matched": 2, "rows_affected": 0, "ids": []},
+    )
+    result = pg_tools.bulk_update_transactions.invoke({"text": "uber", "set_category_name": "não existe"})
+    assert result["status"] == "error"
+
+
+def test_bulk_update_without_set_fields(monkeypatch):
+    monkeypatch.setattr(pg_tools, "get_conn", _no_db)
+    result = pg_tools.bulk_update_transactions.invoke({"text": "uber"})
+    assert result["status"] == "error"
+
+
+def test_bulk_apply_rejects_missing_or_blank_filters(monkeypatch):
+    monkeypatch.setattr(pg_tools, "get_conn", _no_db)
+    for filters in ({}, {"text": None}, {"text": "  ", "payment_method": ""}):
+        result = pg_tools._bulk_apply("SELECT id FROM allowed", [], filters, dry_run=False, max_rows=10)
+        assert result["status"] == "error"
+
+
+def test_bulk_apply_owner_filter_alone_is_not_a_filter(monkeypatch):
+    monkeypatch.setattr(pg_tools, "get_conn", _no_db)
+    token = pg_tools._user_id.set("u1")
+    try:
+        result = pg_tools._bulk_apply("SELECT id FROM allowed", [], {"text": " "}, dry_run=True, max_rows=10)
+    finally:
+        pg_tools._user_id.reset(token)
+    assert result["status"] == "error"
+
+
+def test_delete_transactions_requires_a_filter(monkeypatch):
+    monkeypatch.setattr(pg_tools, "get_conn", _no_db)
+    assert pg_tools.delete_transactions.invoke({"text": ""})["status"] == "error"
+
+
+def test_scoped_key_prefixes_the_user():
+    assert pg_tools._scoped_key("k") == "k"
+    token = pg_tools._user_id.set("u1")
+    try:
+        assert pg_tools._scoped_key("k") == "u1:k"
+    finally:
+        pg_tools._user_id.reset(token)
+
+
+# ----- anomalias -----
+
+def test_score_anomalies_without_categories():
+    import numpy as np
+
+    start = dt.date(2025, 1, 6)  # segunda-feira
+    assert pg_tools._score_anomalies([], np.zeros((0, 0)), start=start, since=start) == []
+    assert pg_tools._score_anomalies([], np.zeros((0, 90)), start=start, since=start) == []
+
+
+def test_score_anomalies_with_short_history():
+    import numpy as np
+
+    start = dt.date(2025, 1, 6)
+    for days in (0, 3, 10, pg_tools.ANOMALY_DAILY_WINDOW):
+        daily = np.full((2, days), 10.0)
+        assert pg_tools._score_anomalies([1, 2], daily, start=start, since=start) == []
+
+
+def test_score_anomalies_flags_a_spike():
+    import numpy as np
+
+    start = dt.date(2025, 1, 6)
+    daily = np.full((2, 60), 10.0)
+    daily[1, 50] = 500.0
+    found = pg_tools._score_anomalies([7, 8], daily, start=start, since=start)
+    days = [f for f in found if f[1] == "day"]
+    assert days == [(8, "day", start + dt.timedelta(days=50), 500.0, 10.0, 99.0)]
+    # `since` corta os períodos anteriores
+    later = start + dt.timedelta(days=51)
+    assert [f for f in pg_tools._score_anomalies([7, 8], daily, start=start, since=later) if f[1] == "day"] == []
+
+
+def test_robust_scores_shapes_and_flat_history():
+    import numpy as np
+
+    series = np.array([[5.0] * 10 + [5.0, 8.0], [1.0, 2.0] * 5 + [1.5, 2.0]])
+    median, score = pg_tools._robust_scores(series, 10)
+    assert median.shape == score.shape == (2, 2)
+    assert score[0, 0] == 0.0  # sem desvio e sem aumento
+    assert np.isinf(score[0, 1])  # sem desvio e acima da mediana
+    assert np.all(np.isfinite(score[1]))
+
+
+# ----- sketches -----
+
+def test_tdigest_quantiles_merge_and_json():
+    empty = pg_tools._TDigest()
+    assert empty.quantile(0.5) is None
+
+    low, high = pg_tools._TDigest(), pg_tools._TDigest()
+    for value in range(1, 501):
+        low.add(float(value))
+    for value in range(501, 1001):
+        high.add(float(value))
+    low.merge(high)
+    assert low.count() == 1000
+    assert abs(low.quantile(0.5) - 500) <= 10
+    assert abs(low.quantile(0.99) - 990) <= 5
+    assert low.quantile(0.0) == 1.0 and low.quantile(1.0) == 1000.0
+
+    restored = pg_tools._TDigest.from_json(low.to_json())
+    assert restored.quantile(0.9) == low.quantile(0.9)
+    assert pg_tools._TDigest.from_json(None).count() == 0
+
+
+def test_hyperloglog_estimate_merge_and_json():
+    a, b = pg_tools._HyperLogLog(), pg_tools._HyperLogLog()
+    assert a.estimate() == 0
+    for i in range(3000):
+        a.add(f"item {i}")
+    for i in range(2000, 5000):
+        b.add(f"item {i}")
+    a.merge(b)
+    assert abs(a.estimate() - 5000) <= 5000 * 0.05
+
+    small = pg_tools._HyperLogLog()
+    for i in range(20):
+        small.add(str(i % 10))
+    assert small.estimate() == 10  # correção de cardinalidade pequena
+
+    restored = pg_tools._HyperLogLog.from_json(a.to_json())
+    assert restored.p == a.p and restored.estimate() == a.estimate()
+
+
+def test_space_saving_top_and_merge():
+    a = pg_tools._SpaceSaving(capacity=3)
+    for key in ["uber"] * 5 + ["ifood"] * 3 + ["padaria", "farmácia"]:
+        a.add(key, 10.0)
+    assert a.top(1)[0][0] == "uber"
+    assert len(a.counters) == 3
+
+    b = pg_tools._SpaceSaving(capacity=3)
+    for key in ["ifood"] * 4:
+        b.add(key, 20.0)
+    a.merge(b)
+    top = dict(a.top(2))
+    assert set(top) == {"uber", "ifood"}
+    assert top["ifood"][0] >= 7 and top["ifood"][2] == 110.0
+
+    restored = pg_tools._SpaceSaving.from_json(a.to_json())
+    assert restored.top(3) == a.top(3)
+
+
+# ----- calendário -----
+
+def test_period_range_weeks_months_quarters():
+    today = dt.date(2025, 5, 14)  # quarta-feira
+    assert pg_tools._period_range("this_week", today) == (dt.date(2025, 5, 12), dt.date(2025, 5, 18))
+    assert pg_tools._period_range("last_week", today) == (dt.date(2025, 5, 5), dt.date(2025, 5, 11))
+    assert pg_tools._period_range("last_month", today) == (dt.date(2025, 4, 1), dt.date(2025, 4, 30))
+    assert pg_tools._period_range("next_month", today) == (dt.date(2025, 6, 1), dt.date(2025, 6, 30))
+    assert pg_tools._period_range("this_quarter", today) == (dt.date(2025, 4, 1), dt.date(2025, 6, 30))
+    assert pg_tools._period_range("last_30_days", today) == (dt.date(2025, 4, 15), today)
+
+
+def test_period_range_across_year_boundaries():
+    assert pg_tools._period_range("last_month", dt.date(2025, 1, 31)) == (dt.date(2024, 12, 1), dt.date(2024, 12, 31))
+    assert pg_tools._period_range("last_quarter", dt.date(2025, 2, 10)) == (dt.date(2024, 10, 1), dt.date(2024, 12, 31))
+    assert pg_tools._period_range("this_month", dt.date(2024, 2, 29)) == (dt.date(2024, 2, 1), dt.date(2024, 2, 29))
+    assert pg_tools._period_range("last_year", dt.date(2024, 2, 29)) == (dt.date(2023, 1, 1), dt.date(2023, 12, 31))
+
+
+def test_period_range_covers_every_period():
+    today = dt.date(2025, 12, 31)
+    for period in pg_tools.PERIODS:
+        start, end = pg_tools._period_range(period, today)
+        assert start <= end
+    assert pg_tools._period_range("fortnight", today) is None
+
+
+# ----- cartões -----
+
+def test_statement_dict_status():
+    today = dt.date(2025, 5, 14)
+    closing, due = dt.date(2025, 5, 5), dt.date(2025, 5, 12)
+    assert pg_tools._statement_dict(None, None, None, None, 0, today) is None
+
+    open_ = pg_tools._statement_dict(dt.date(2025, 6, 5), dt.date(2025, 6, 12), None, 10, 1, today)
+    assert open_["status"] == "open" and open_["pay_until"] == "2025-06-12"
+
+    past_due = pg_tools._statement_dict(closing, due, None, 100, 3, today)
+    assert past_due == {
+        "closing_date": "2025-05-05", "due_date": "2025-05-12", "pay_until": "2025-05-12",
+        "amount": 100.0, "count": 3, "status": "past_due",
+    }
+    # vencimento num fim de semana: paga até o próximo dia útil sem ficar atrasada
+    closed = pg_tools._statement_dict(closing, due, dt.date(2025, 5, 14), 100, 3, today)
+    assert closed["status"] == "closed" and closed["pay_until"] == "2025-05-14"
+
+
+# ----- contas -----
+
+def test_account_direction_rule():
+    ok = pg_tools._account_direction_ok
+    assert ok(2, 1, None) and ok(2, None, None) and not ok(2, None, 1) and not ok(2, 1, 2)
+    assert ok(1, None, 1) and ok(1, None, None) and not ok(1, 1, None)
+    assert ok(3, 1, 2) and ok(3, None, None) and not ok(3, 1, None) and not ok(3, None, 2)
+
+
+def test_update_transaction_rejects_same_account_on_both_sides(monkeypatch):
+    monkeypatch.setattr(pg_tools, "get_conn", _no_db)
+    result = pg_tools.update_transaction.invoke({"id": 1, "from_account_id": 3, "to_account_id": 3})
+    assert result["status"] == "error"
+
+
+# ----- contas a pagar -----
+
+def test_next_due_keeps_the_month_end_anchor():
+    monthly = [dt.date(2025, 1, 31)]
+    for _ in range(3):
+        monthly.append(pg_tools._next_due(monthly[-1], "monthly", 31))
+    assert monthly[1:] == [dt.date(2025, 2, 28), dt.date(2025, 3, 31), dt.date(2025, 4, 30)]
+    # sem âncora, vale o dia do vencimento atual
+    assert pg_tools._next_due(dt.date(2025, 2, 28), "monthly", None) == dt.date(2025, 3, 28)
+    assert pg_tools._next_due(dt.date(2025, 12, 15), "monthly", 15) == dt.date(2026, 1, 15)
+
+
+def test_next_due_weekly_and_yearly():
+    assert pg_tools._next_due(dt.date(2025, 12, 29), "weekly", None) == dt.date(2026, 1, 5)
+    assert pg_tools._next_due(dt.date(2024, 2, 29), "yearly", 29) == dt.date(2025, 2, 28)
+    assert pg_tools._next_due(dt.date(2027, 2, 28), "yearly", 29) == dt.date(2028, 2, 29)
+
+
+# ----- log de consultas e advisor de índices -----
+
+def test_sql_shape_replaces_literals_and_collapses_values():
+    assert pg_tools._sql_shape("SELECT * FROM t\n  WHERE a = 'it''s' AND b >= 10.5") == "SELECT * FROM t WHERE a = ? AND b >= ?"
+    assert pg_tools._sql_shape(b"INSERT INTO t (a, b) VALUES (1, 'x'), (2, 'y'), (3, 'z')") == "INSERT INTO t (a, b) VALUES (...)"
+    # uma única tupla e identificadores com dígitos ficam como estão
+    assert pg_tools._sql_shape("SELECT col1 FROM t2 WHERE id IN (1, 2)") == "SELECT col1 FROM t2 WHERE id IN (?, ?)"
+
+
+def test_filter_columns_from_plan_filters():
+    condition = "((user_id = 'u1'::text) AND (amount >= 10::numeric) AND (type = ANY ('{1,2}'::integer[])))"
+    assert pg_tools._filter_columns(condition) == (["user_id", "type"], ["amount"])
+    assert pg_tools._filter_columns("(description ~~* '%uber%'::text)") == ([], [])
+
+
+def test_index_columns_from_indexdef():
+    indexdef = 'CREATE INDEX idx ON public.transactions USING btree (user_id, "occurred_at" DESC) WHERE (user_id IS NOT NULL)'
+    assert pg_tools._index_columns(indexdef) == ["user_id", "occurred_at"]
+    # vírgulas dentro de expressões e do WHERE do índice parcial não separam colunas
+    assert pg_tools._index_columns(
+        "CREATE INDEX idx ON t USING btree (lower(name), user_id) WHERE (type = ANY (ARRAY[1, 2]))"
+    ) == ["lower(name)", "user_id"]
+    assert pg_tools._index_columns("CREATE INDEX idx ON t") == []
+
+
+def test_query_log_keeps_only_types_and_redacts_plan_literals():
+    assert pg_tools._loggable(["uber", 12.5, None, {"k": "segredo"}]) == ["str", "float", None, {"k": "str"}]
+    plan = [{"Plan": {"Filter": "((user_id = 'u1'::text) AND (description ~~* '%it''s%'::text))", "Plans": []}}]
+    assert pg_tools._redact_plan(plan) == [{"Plan": {"Filter": "((user_id = '?'::text) AND (description ~~* '?'::text))", "Plans": []}}]
+    assert pg_tools._filter_columns(pg_tools._redact_plan(plan)[0]["Plan"]["Filter"]) == (["user_id"], [])
+
+
+# ----- aggregate_transactions -----
+
+def test_merge_aggregates_combines_postgres_and_archive_groups():
+    rows = [
+        # Postgres e Parquet devolvem o mesmo mês; avg é refeito por _sum/_n, não pela média das médias
+        {"month": "2024-01", "sum": 30.0, "count": 1, "min": 30.0, "max": 30.0, "avg": 30.0, "_sum": 30.0, "_n": 1},
+        {"month": "2024-01", "sum": 30.0, "count": 3, "min": 5.0, "max": 20.0, "avg": 10.0, "_sum": 30.0, "_n": 3},
+        {"month": "2023-12", "sum": 0, "count": 0, "min": None, "max": None, "avg": None, "_sum": 0, "_n": 0},
+        {"month": "2023-12", "sum": 8.0, "count": 1, "min": 8.0, "max": 8.0, "avg": 8.0, "_sum": 8.0, "_n": 1},
+        {"month": None, "sum": 1.0, "count": 1, "min": 1.0, "max": 1.0, "avg": 1.0, "_sum": 1.0, "_n": 1},
+    ]
+    merged = pg_tools._merge_aggregates(["month"], ["sum", "count", "min", "max", "avg"], rows)
+    assert merged == [
+        {"month": "2023-12", "sum": 8.0, "count": 1, "min": 8.0, "max": 8.0, "avg": 8.0},
+        {"month": "2024-01", "sum": 60.0, "count": 4, "min": 5.0, "max": 30.0, "avg": 15.0},
+        {"month": None, "sum": 1.0, "count": 1, "min": 1.0, "max": 1.0, "avg": 1.0},
+    ]
+
+
+def test_merge_aggregates_avg_of_empty_group_is_none():
+    rows = [{"type": 2, "avg": None, "_sum": 0, "_n": 0}, {"type": 2, "avg": None, "_sum": 0, "_n": 0}]
+    assert pg_tools._merge_aggregates(["type"], ["avg"], rows) == [{"type": 2, "avg": None}]
+
+
+def test_metric_sql_named_metrics_and_percentiles():
+    assert pg_tools._metric_sql(" SUM ") == "COALESCE(SUM(t.amount), 0)"
+    assert pg_tools._metric_sql("p90") == "PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY t.amount)"
+    assert pg_tools._metric_sql("P5") == "PERCENTILE_CONT(0.05) WITHIN GROUP (ORDER BY t.amount)"
+    assert pg_tools._metric_sql("p100") is None
+    assert pg_tools._metric_sql("median") is None
+
+
+# ----- retorno compacto -----
+
+def test_compact_result_drops_null_columns_and_rounds():
+    results = [
+        {"id": 1, "amount": Decimal("10.005"), "note": None, "occurred_at_local": dt.datetime(2024, 1, 2, 9, 30, 15)},
+        {"id": 2, "amount": 2.5, "note": None, "occurred_at_local": dt.datetime(2024, 1, 3, 18, 0)},
+    ]
+    assert pg_tools._compact_result(results) == {
+        "status": "ok",
+        "columns": ["id", "amount", "occurred_at_local"],
+        "rows": [[1, 10.01, "2024-01-02 09:30"], [2, 2.5, "2024-01-03 18:00"]],
+        "count": 2,
+    }
+    assert pg_tools._compact_result([]) == {"status": "ok", "columns": [], "rows": [], "count": 0}
+
+
+def test_compact_result_cuts_rows_past_the_token_budget(monkeypatch):
+    monkeypatch.setattr(pg_tools, "RESULT_TOKEN_BUDGET", 10)  # ~40 chars: só a primeira linha cabe
+    results = [{"id": i, "amount": 10.0, "occurred_at_local": dt.date(2024, 1, i)} for i in range(1, 6)]
+    out = pg_tools._compact_result(results)
+    assert out["rows"] == [[1, 10.0, "2024-01-01"]]
+    assert out["count"] == 5 and out["more_rows"] == 4
+    # o resumo cobre também as linhas cortadas; ids ficam de fora
+    assert out["summary"] == {
+        "amount_sum": 50.0, "occurred_at_local_min": "2024-01-01", "occurred_at_local_max": "2024-01-05",
+    }
+
+
+def test_compact_result_keeps_one_row_even_over_budget(monkeypatch):
+    monkeypatch.setattr(pg_tools, "RESULT_TOKEN_BUDGET", 1)
+    out = pg_tools._compact_result([{"description": "x" * 200}, {"description": "y"}])
+    assert out["rows"] == [["x" * pg_tools.TEXT_MAX_CHARS + "…"]]
+    assert out["more_rows"] == 1 and out["summary"] == {}
+
+
+# ----- cache, spool e disjuntor -----
+
+def test_result_cache_generation_invalidates_entries():
+    cache = pg_tools._ResultCache(maxsize=2, ttl=60)
+    cache.put("a", 1, cache.generation)
+    assert cache.get("a") == 1
+    cache.bump_generation()
+    assert cache.get("a") is None
+    # leitura feita antes de uma escrita concorrente não entra no cache
+    cache.put("b", 2, cache.generation - 1)
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_result_cache_ttl_and_lru():
+    expired = pg_tools._ResultCache(maxsize=2, ttl=0)
+    expired.put("a", 1, expired.generation)
+    assert expired.get("a") is None
+
+    cache = pg_tools._ResultCache(maxsize=2, ttl=60)
+    for key in ("a", "b"):
+        cache.put(key, key, cache.generation)
+    cache.get("a")
+    cache.put("c", "c", cache.generation)  # "b" é o menos usado
+    assert cache.get("b") is None and cache.get("a") == "a" and cache.get("c") == "c"
+
+
+def test_write_spool_replay_stops_when_database_still_down(tmp_path, monkeypatch):
+    spool = pg_tools._WriteSpool(str(tmp_path / "spool" / "writes.jsonl"))
+    statuses = {"ok": {"status": "ok"}, "dup": {"status": "confirm", "possible_duplicates": [7]},
+                "bad": {"status": "error", "message": "x"}, "down": {"status": "unavailable"}}
+    monkeypatch.setattr(pg_tools._WriteSpool, "_apply", staticmethod(lambda entry: statuses[entry["args"]["k"]]))
+    for k in ("ok", "dup", "bad", "down", "ok"):
+        spool.append("add_transaction", {"k": k})
+    assert spool.pending() == 5
+
+    result = spool.replay()
+    assert result["replayed"] == 1 and result["failed"] == 1 and result["pending"] == 2
+    assert [(e["args"], e["possible_duplicates"]) for e in result["needs_confirmation"]] == [({"k": "dup"}, [7])]
+    # o que não foi aplicado continua no arquivo, na ordem
+    assert spool.pending() == 2
+
+    statuses["down"] = {"status": "ok"}
+    assert spool.replay() == {"replayed": 2, "failed": 0, "needs_confirmation": [], "pending": 0}
+    assert spool.pending() == 0
+
+
+def test_circuit_breaker_opens_after_consecutive_failures(monkeypatch):
+    monkeypatch.setattr(pg_tools, "CIRCUIT_FAILURES", 2)
+    probes = []
+    monkeypatch.setattr(pg_tools._CircuitBreaker, "_probe", lambda self: probes.append(self.dsn))
+    breaker = pg_tools._CircuitBreaker("dsn-teste")
+    breaker.record_failure()
+    breaker.record_success()  # sucesso zera a contagem
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(pg_tools.DatabaseUnavailable):
+        breaker.check()
+    breaker.record_failure()  # já aberto: não dispara outra sonda
+    time.sleep(0.1)
+    assert probes == ["dsn-teste"]
+
+
+# ----- previsão de saldo -----
+
+def _flow_rows():
+    # (dia local, tipo, valor, texto) como o _load_flow_history devolve
+    rows = []
+    for month, amount in ((3, 4999.6), (4, 5000.0), (5, 5000.4), (6, 5000.2)):
+        rows.append((dt.date(2024, month, 5), 1, amount, "salario"))
+    for month in (3, 4, 5, 6):
+        rows.append((dt.date(2024, month, 10), 2, 1500.0, "aluguel"))
+    # mensal, mas parou há mais de 45 dias
+    for month in (10, 11, 12):
+        rows.append((dt.date(2023, month, 15), 2, 90.0, "academia"))
+    # só dois meses
+    rows += [(dt.date(2024, 5, 1), 2, 40.0, "streaming"), (dt.date(2024, 6, 1), 2, 40.0, "streaming")]
+    # mesmo valor uma vez por mês, mas o texto aparece várias vezes no mês: não é recorrência
+    for month in (3, 4, 5):
+        rows.append((dt.date(2024, month, 2), 2, 30.0, "uber"))
+    rows += [(dt.date(2024, 3, 15), 2, 12.0, "uber"), (dt.date(2024, 4, 20), 2, 47.0, "uber"),
+             (dt.date(2024, 5, 22), 2, 8.0, "uber")]
+    return rows
+
+
+def test_detect_recurring_monthly_entries():
+    recurring = pg_tools._detect_recurring(_flow_rows(), dt.date(2024, 6, 20))
+    assert recurring == [
+        {"label": "salario", "amount": 5000.2, "day": 5, "months": 4, "indexes": [0, 1, 2, 3]},
+        {"label": "aluguel", "amount": -1500.0, "day": 10, "months": 4, "indexes": [4, 5, 6, 7]},
+    ]
+
+
+def test_fit_flow_model_separates_recurring_from_residual():
+    import numpy as np
+
+    today = dt.date(2024, 6, 20)
+    rows = _flow_rows()
+    start = today - dt.timedelta(days=pg_tools.FORECAST_HISTORY_DAYS)
+    day_index = np.array([(r[0] - start).days for r in rows], dtype=np.int64)
+    types = np.array([r[1] for r in rows], dtype=np.int8)
+    amounts = np.array([r[2] for r in rows])
+
+    model = pg_tools._fit_flow_model(today, 1000.0, [r[3] for r in rows], day_index, types, amounts)
+    assert [(r["label"], r["amount"]) for r in model["recurring"]] == [("salario", 5000.2), ("aluguel", -1500.0)]
+    assert all("indexes" not in r for r in model["recurring"])
+    # resíduo diário do primeiro lançamento (academia, 15/10/2023) até hoje, sem salário e aluguel
+    assert len(model["residual"]) == (today - dt.date(2023, 10, 15)).days + 1
+    assert model["residual"][0] == -90.0
+    assert model["residual"].sum() == -(3 * 90.0 + 2 * 40.0 + 3 * 30.0 + 12.0 + 47.0 + 8.0)
+    assert model["weekday_mean"].shape == (7,)
+    assert model["sigma"] == float(model["residual"].std())
+
+
+def _weekly_residual(weeks: int = 4):
+    # índice -1 é hoje; o dia seguinte (≡ len mod 7) recebe +100 e os demais -10
+    size = 7 * weeks + 1
+    return [100.0 if (i - size) % 7 == 0 else -10.0 for i in range(size)]
+
+
+def test_simulate_paths_draws_whole_weeks_aligned_with_tomorrow():
+    import numpy as np
+
+    residual = np.array(_weekly_residual())
+    recurring = np.zeros(14)
+    recurring[10] = -500.0
+    purchase = np.zeros(14)
+    purchase[0] = 300.0
+    # toda semana do histórico é igual: todos os cenários dão 1100, 1040, 1140, 1120, 610 ... 580
+    result = pg_tools._simulate_paths(1000.0, 500.0, residual, recurring, purchase)
+    assert result == {
+        "risk_without": 0.0,
+        "risk_with": 1.0,
+        "lowest_with": {"p10": 280.0, "p50": 280.0, "p90": 280.0},
+        "end_p50_without": 580.0,
+        "end_p50_with": 280.0,
+    }
+
+
+def test_simulate_paths_is_deterministic_with_the_seed(monkeypatch):
+    import numpy as np
+
+    monkeypatch.setattr(pg_tools, "SIMULATION_PATHS", 200)
+    residual = np.array(_weekly_residual(8))
+    residual[3::7] -= 150.0 * np.arange(len(residual[3::7]))  # semanas diferentes entre si
+    recurring = np.zeros(30)
+    purchase = np.zeros(30)
+    purchase[[0, 29]] = 200.0
+    first = pg_tools._simulate_paths(500.0, 0.0, residual, recurring, purchase)
+    assert pg_tools._simulate_paths(500.0, 0.0, residual, recurring, purchase) == first
+    assert 0.0 < first["risk_without"] <= first["risk_with"] < 1.0
+    assert first["lowest_with"]["p10"] <= first["lowest_with"]["p50"] <= first["lowest_with"]["p90"]
+    assert first["end_p50_with"] == pytest.approx(first["end_p50_without"] - 400.0)
+
+
+# ----- idempotência -----
+
+def _key_in(session_id, turn_id, amount=25.0, source_text="Gastei 25 no  Uber", occurred_at=None):
+    def run():
+        pg_tools.set_session(session_id, turn_id=turn_id, deadline_seconds=0)
+        return pg_tools._idempotency_key(amount, source_text, occurred_at)
+    return contextvars.copy_context().run(run)
+
+
+def test_idempotency_key_collides_only_for_retries_in_the_same_turn():
+    key = _key_in("s1", "t1")
+    # retry do mesmo turno (texto com outra caixa/espaços, valor como string numérica)
+    assert _key_in("s1", "t1", amount="25", source_text="gastei 25 no uber ") == key
+    assert _key_in("s1", "t2") != key
+    assert _key_in("s2", "t1") != key
+    assert _key_in("s1", "t1", amount=25.5) != key
+    # com occurred_at explícito, o turno não entra na chave
+    assert _key_in("s1", "t1", occurred_at="2024-05-01T10:00") == _key_in("s1", "t2", occurred_at="2024-05-01T10:00")